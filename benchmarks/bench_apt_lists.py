@@ -0,0 +1,143 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Measure looking up available packages in apt's package lists.
+
+Synthetic lists the size of an Ubuntu archive's main and universe components
+stand in for a machine after `apt-get update`. Forking `apt-cache show` for
+every package, as the apt library used to, is compared with the index of the
+lists: built by scanning them (cold), loaded from disk in a new hook process
+(saved), and kept in memory within a hook (warm).
+"""
+
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import timeit
+from pathlib import Path
+from unittest import mock
+
+from charms.operator_libs_linux.v0 import apt
+
+COMPONENTS = {"main": 6000, "universe": 60000}
+LOOKUPS = 20
+NUMBER = 5
+LIST = "archive.example.com_ubuntu_dists_jammy"
+
+
+def make_lists(path: Path) -> list:
+    """Write package lists and return the names of some of their packages"""
+    rng = random.Random(0)
+    names = []
+    for component, packages in COMPONENTS.items():
+        stanzas = []
+        for i in range(packages):
+            name = f"{component}-package{i}"
+            names.append(name)
+            description = "\n".join(f" line {n} of the long description" for n in range(6))
+            stanzas.append(
+                f"Package: {name}\n"
+                f"Architecture: {'all' if i % 3 == 0 else 'amd64'}\n"
+                f"Version: {rng.randint(0, 9)}.{rng.randint(0, 99)}-{rng.randint(1, 5)}\n"
+                "Priority: optional\n"
+                "Section: misc\n"
+                "Maintainer: Bench <bench@example.com>\n"
+                f"Installed-Size: {rng.randint(10, 10000)}\n"
+                f"Depends: libc6 (>= 2.34), {component}-package{rng.randrange(packages)}\n"
+                f"Filename: pool/{component}/{name}_1.0-1_amd64.deb\n"
+                f"Size: {rng.randint(1000, 100000)}\n"
+                f"SHA256: {rng.getrandbits(256):064x}\n"
+                f"Description: synthetic package {i}\n{description}\n"
+            )
+        (path / f"{LIST}_{component}_binary-amd64_Packages").write_text("\n".join(stanzas))
+    (path / f"{LIST}_Release").write_text(
+        "Origin: Bench\nSuite: jammy\nCodename: jammy\nArchitectures: amd64\n"
+        f"Components: {' '.join(COMPONENTS)}\n"
+    )
+    return rng.sample(names, LOOKUPS)
+
+
+def apt_cache_options(root: Path) -> list:
+    """Point apt-cache at the synthetic lists instead of the system's"""
+    (root / "sources.list").write_text(
+        f"deb [trusted=yes] http://archive.example.com/ubuntu jammy {' '.join(COMPONENTS)}\n"
+    )
+    (root / "status").touch()
+    (root / "cache").mkdir()
+    options = {
+        "Dir::State::Lists": root / "lists",
+        "Dir::State::status": root / "status",
+        "Dir::Cache": root / "cache",
+        # As on a machine, apt-cache keeps its binary cache of the lists between runs
+        "Dir::Cache::pkgcache": root / "cache/pkgcache.bin",
+        "Dir::Cache::srcpkgcache": root / "cache/srcpkgcache.bin",
+        "Dir::Etc::SourceList": root / "sources.list",
+        "Dir::Etc::SourceParts": root / "sources.list.d",
+    }
+    return [arg for name, value in options.items() for arg in ("-o", f"{name}={value}")]
+
+
+def lookup_apt_cache(options: list, names: list) -> None:
+    """The previous behaviour: fork `apt-cache show` for every package"""
+    for name in names:
+        subprocess.check_output(["apt-cache", *options, "show", name])
+
+
+def lookup_cold(names: list) -> None:
+    """The first lookups after the lists were updated, scanning them"""
+    if os.path.exists(apt.APT_INDEX_PATH):
+        os.unlink(apt.APT_INDEX_PATH)
+    lookup_saved(names)
+
+
+def lookup_saved(names: list) -> None:
+    """The first lookups in a new hook, loading the index from disk"""
+    apt.clear_caches()
+    lookup_warm(names)
+
+
+def lookup_warm(names: list) -> None:
+    """Later lookups in the same hook, against the index in memory"""
+    for name in names:
+        apt.DebianPackage.from_apt_cache(name)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        (root / "lists").mkdir()
+        names = make_lists(root / "lists")
+        options = apt_cache_options(root)
+        patches = [
+            mock.patch.object(apt, "APT_LISTS_PATH", str(root / "lists")),
+            mock.patch.object(apt, "APT_INDEX_PATH", str(root / "packages.json")),
+            # Only measure the lookups, not the architecture query
+            mock.patch.object(apt, "check_output", return_value="amd64\n"),
+        ]
+        for patch in patches:
+            patch.start()
+        try:
+            print(f"{sum(COMPONENTS.values())} available packages, {LOOKUPS} lookups")
+            print(f"{'method':<24} {'total (ms)':>11} {'per lookup (us)':>16}")
+            methods = [
+                ("apt-cache show", lambda: lookup_apt_cache(options, names)),
+                ("cold", lambda: lookup_cold(names)),
+                ("saved", lambda: lookup_saved(names)),
+                ("warm", lambda: lookup_warm(names)),
+            ]
+            if not shutil.which("apt-cache"):
+                methods.pop(0)
+            for name, method in methods:
+                seconds = min(timeit.repeat(method, number=NUMBER, repeat=3)) / NUMBER
+                print(f"{name:<24} {seconds * 1e3:>11.2f} {seconds / LOOKUPS * 1e6:>16.1f}")
+            seconds = min(timeit.repeat(lambda: apt.candidate_packages(names), number=NUMBER))
+            print(f"{'candidate_packages()':<24} {seconds / NUMBER * 1e3:>11.2f}")
+        finally:
+            for patch in reversed(patches):
+                patch.stop()
+
+
+if __name__ == "__main__":
+    main()
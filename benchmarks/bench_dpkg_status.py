@@ -0,0 +1,113 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Measure looking up installed packages in the dpkg status database.
+
+A synthetic status file of 5,000 packages stands in for a well populated
+machine. Forking `dpkg -l` for every package, as the apt library used to, is
+compared with parsing the status file once (cold) and with lookups against the
+index kept in memory while the file is unchanged (warm).
+"""
+
+import random
+import shutil
+import subprocess
+import tempfile
+import timeit
+from pathlib import Path
+from unittest import mock
+
+from charms.operator_libs_linux.v0 import apt
+
+PACKAGES = 5000
+LOOKUPS = 20
+NUMBER = 20
+
+
+def make_status(path: Path, packages: int) -> list:
+    """Write a dpkg status file and return the names of some installed packages"""
+    rng = random.Random(0)
+    stanzas = []
+    installed = []
+    for i in range(packages):
+        name = f"package{i}"
+        status = "deinstall ok config-files" if i % 50 == 0 else "install ok installed"
+        if status.endswith(" installed"):
+            installed.append(name)
+        epoch = "1:" if i % 20 == 0 else ""
+        description = "\n".join(f" line {n} of the long description" for n in range(8))
+        stanzas.append(
+            f"Package: {name}\n"
+            f"Status: {status}\n"
+            "Priority: optional\n"
+            "Section: misc\n"
+            f"Installed-Size: {rng.randint(10, 10000)}\n"
+            "Maintainer: Bench <bench@example.com>\n"
+            f"Architecture: {'all' if i % 3 == 0 else 'amd64'}\n"
+            f"Version: {epoch}{rng.randint(0, 9)}.{rng.randint(0, 99)}-{rng.randint(1, 5)}\n"
+            f"Depends: libc6 (>= 2.31), package{rng.randrange(packages)}\n"
+            f"Description: synthetic package {i}\n{description}\n"
+        )
+    path.write_text("\n".join(stanzas))
+    return rng.sample(installed, LOOKUPS)
+
+
+def lookup_dpkg(admindir: Path, names: list) -> None:
+    """The previous behaviour: fork `dpkg -l` for every package"""
+    for name in names:
+        subprocess.check_output(["dpkg", f"--admindir={admindir}", "-l", name])
+
+
+def lookup_cold(names: list) -> None:
+    """The first lookups in a hook, parsing the status file"""
+    apt.clear_caches()
+    lookup_warm(names)
+
+
+def lookup_warm(names: list) -> None:
+    """Later lookups in the same hook, against the index in memory"""
+    for name in names:
+        apt.DebianPackage.from_installed_package(name)
+
+
+def list_cold() -> list:
+    """List every installed package in a new hook"""
+    apt.clear_caches()
+    return apt.installed_packages()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        admindir = Path(tmp)
+        for path in ("info", "updates"):
+            (admindir / path).mkdir()
+        names = make_status(admindir / "status", PACKAGES)
+        patches = [
+            mock.patch.object(apt, "DPKG_STATUS_PATH", str(admindir / "status")),
+            # Only measure the lookups, not the architecture query
+            mock.patch.object(apt, "check_output", return_value="amd64\n"),
+        ]
+        for patch in patches:
+            patch.start()
+        try:
+            print(f"{PACKAGES} installed packages, {LOOKUPS} lookups")
+            print(f"{'method':<24} {'total (ms)':>11} {'per lookup (us)':>16}")
+            methods = [
+                ("dpkg -l", lambda: lookup_dpkg(admindir, names)),
+                ("cold", lambda: lookup_cold(names)),
+                ("warm", lambda: lookup_warm(names)),
+            ]
+            if not shutil.which("dpkg"):
+                methods.pop(0)
+            for name, method in methods:
+                seconds = min(timeit.repeat(method, number=NUMBER, repeat=3)) / NUMBER
+                print(f"{name:<24} {seconds * 1e3:>11.2f} {seconds / LOOKUPS * 1e6:>16.1f}")
+            seconds = min(timeit.repeat(list_cold, number=NUMBER, repeat=3)) / NUMBER
+            print(f"{'installed_packages()':<24} {seconds * 1e3:>11.2f}")
+        finally:
+            for patch in reversed(patches):
+                patch.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Compare redeploying the application with a full clone against an incremental fetch.
+
+A local bare repository with a long history stands in for the remote. It is
+served over `file://` so that git uses the same pack transfer it would use for
+a network remote, rather than hardlinking objects from a local path.
+"""
+
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from charm import HelloJujuCharm
+from git import Repo
+from ops.testing import Harness
+
+COMMITS = 20000
+FILES = 200
+ROUNDS = 5
+
+
+def make_remote(path: Path, commits: int) -> None:
+    """Create a bare repository with a long linear history using git fast-import"""
+    subprocess.check_call(["git", "init", "--quiet", "--bare", str(path)])
+    stream = []
+    for i in range(1, commits + 1):
+        blob = f"module {i % FILES}\n" + f"revision {i}\n" * 32
+        message = f"commit {i}\n"
+        stream.append(f"commit refs/heads/main\nmark :{i}\n")
+        stream.append(f"committer Bench <bench@example.com> {1600000000 + i} +0000\n")
+        stream.append(f"data {len(message)}\n{message}")
+        if i > 1:
+            stream.append(f"from :{i - 1}\n")
+        stream.append(f"M 644 inline src/file{i % FILES}.py\ndata {len(blob)}\n{blob}\n")
+    subprocess.run(
+        ["git", "--git-dir", str(path), "fast-import", "--quiet"],
+        input="".join(stream).encode(),
+        check=True,
+    )
+    subprocess.check_call(
+        ["git", "--git-dir", str(path), "symbolic-ref", "HEAD", "refs/heads/main"]
+    )
+
+
+def push_commit(remote: Path, work: Path, n: int) -> None:
+    """Add a single new commit to the remote"""
+    (work / "src" / "file0.py").write_text(f"module 0\nrevision {n}\n")
+    subprocess.check_call(["git", "-C", str(work), "commit", "--quiet", "-am", f"update {n}"])
+    subprocess.check_call(["git", "-C", str(work), "push", "--quiet", "origin", "main"])
+
+
+def bench_full_clone(url: str, app: Path) -> float:
+    """The previous behaviour: delete the checkout and clone from scratch"""
+    start = time.perf_counter()
+    if app.is_dir():
+        shutil.rmtree(app)
+    Repo.clone_from(url, app)
+    return time.perf_counter() - start
+
+
+def bench_incremental(charm: HelloJujuCharm, app: Path) -> float:
+    """Fetch only new objects into the mirror and check out the new commit"""
+    start = time.perf_counter()
+    charm._checkout_application(charm._fetch_application(), app)
+    return time.perf_counter() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remote = tmp / "remote.git"
+        work = tmp / "work"
+        url = f"file://{remote}"
+
+        start = time.perf_counter()
+        make_remote(remote, COMMITS)
+        print(f"created remote with {COMMITS} commits in {time.perf_counter() - start:.2f}s")
+        Repo.clone_from(url, work)
+        subprocess.check_call(["git", "-C", str(work), "config", "user.name", "Bench"])
+        subprocess.check_call(["git", "-C", str(work), "config", "user.email", "b@example.com"])
+
+        harness = Harness(HelloJujuCharm)
+        harness.begin()
+        charm = harness.charm
+        charm._stored.repo = url
+
+        with mock.patch("charm.MIRROR_PATH", tmp / "cache" / "app.git"):
+            first = bench_incremental(charm, tmp / "app")
+            print(f"initial mirror clone and checkout: {first:.3f}s")
+
+            full, incremental = [], []
+            for n in range(ROUNDS):
+                push_commit(remote, work, n)
+                full.append(bench_full_clone(url, tmp / "baseline"))
+                incremental.append(bench_incremental(charm, tmp / "app"))
+
+        harness.cleanup()
+
+    print(f"{'round':>5} {'full clone (s)':>15} {'incremental (s)':>16}")
+    for n, (f, i) in enumerate(zip(full, incremental)):
+        print(f"{n:>5} {f:>15.3f} {i:>16.3f}")
+    mean_full = sum(full) / ROUNDS
+    mean_incremental = sum(incremental) / ROUNDS
+    print(
+        f"mean: full clone {mean_full:.3f}s, incremental {mean_incremental:.3f}s "
+        f"({mean_full / mean_incremental:.1f}x faster)"
+    )
+
+
+if __name__ == "__main__":
+    main()
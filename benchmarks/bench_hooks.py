@@ -0,0 +1,357 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Measure the end to end cost of the charm's hooks.
+
+The charm is driven through `ops.testing.Harness` with realistic event
+sequences, from install to a database failover. Nothing in the charm is
+mocked; instead fake `apt-get`, `dpkg`, `systemctl`, `git`, `pip` and Juju
+hook tool executables are put first on PATH. Each fake sleeps for a
+configurable latency before doing just enough to keep the charm going: the
+package tools keep package lists and a dpkg status file, `git` hands over to
+the real git against a local repository, and `systemctl` maintains a fake
+gunicorn process tree for graceful reloads.
+
+The wall time of every hook and the number of processes it spawned are
+reported. Unlike wall times, process counts hardly depend on the machine, so
+with `--baseline` the benchmark fails when a hook typically spawns more
+processes than recorded there. This is how regressions in hook cost are
+caught in CI.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Tuple
+from unittest import mock
+
+import charm
+import tracing
+from charm import HelloJujuCharm, template_environment
+from charms.operator_libs_linux.v0 import apt
+from ops.testing import Harness
+
+ROUNDS = 10
+LATENCY = 0.01
+
+PRELUDE = """#!/bin/sh
+sleep "${{FAKE_LATENCY_{var}:-$FAKE_LATENCY}}"
+"""
+
+FAKES = {
+    "apt-get": """
+if [ "$1" = update ]; then
+    for name in python3-pip python3-virtualenv nginx; do
+        printf '%s\\n' "Package: $name" "Architecture: all" "Version: 1.0-1" ""
+    done > "$FAKE_STATE/lists/archive_dists_jammy_main_binary-amd64_Packages"
+fi
+install=
+for arg in "$@"; do
+    [ -n "$install" ] && printf '%s\\n' "Package: ${arg%%=*}" "Status: install ok installed" \\
+        "Architecture: all" "Version: 1.0-1" "" >> "$FAKE_STATE/dpkg/status"
+    [ "$arg" = install ] && install=1
+done
+exit 0
+""",
+    "dpkg": """
+case "$1" in
+    --print-architecture) echo amd64 ;;
+    --print-foreign-architectures) ;;
+esac
+""",
+    "systemctl": """
+case " $* " in
+    *".socket "*)
+        # The listening socket has no processes of its own
+        ;;
+    *" start "*|*" restart "*|*" reload "*|*" enable "*)
+        # Replace the fake gunicorn master and its workers
+        workers=$(sed -n 's/.*--workers \\([0-9]*\\).*/\\1/p' "$FAKE_UNIT")
+        pid=$(cat "$FAKE_STATE/next-pid" 2>/dev/null || echo 1000)
+        master=$pid
+        rm -rf "$FAKE_PROC"
+        mkdir -p "$FAKE_PROC" "$(dirname "$FAKE_PIDFILE")"
+        echo "$master" > "$FAKE_PIDFILE"
+        i=0
+        while [ "$i" -lt "${workers:-1}" ]; do
+            pid=$((pid + 1))
+            mkdir "$FAKE_PROC/$pid"
+            echo "$pid (gunicorn) S $master 0 0" > "$FAKE_PROC/$pid/stat"
+            i=$((i + 1))
+        done
+        echo $((pid + 1)) > "$FAKE_STATE/next-pid"
+        ;;
+esac
+exit 0
+""",
+    "git": """
+exec "$FAKE_GIT" "$@"
+""",
+    "pip": """
+exit 0
+""",
+    "python3": """
+if [ "$1" = -m ] && [ "$2" = virtualenv ]; then
+    mkdir -p "$3/bin"
+    ln -sf "$FAKE_BIN/pip" "$3/bin/pip3"
+    ln -sf "$FAKE_BIN/python3" "$3/bin/python3"
+elif [ "$1" = -m ] && [ "$2" = pip ]; then
+    shift 2
+    exec "$FAKE_BIN/pip" "$@"
+fi
+exit 0
+""",
+    "sudo": """
+exit 0
+""",
+    "open-port": """
+exit 0
+""",
+    "close-port": """
+exit 0
+""",
+    "leader-set": """
+for kv in "$@"; do
+    printf '%s' "${kv#*=}" > "$FAKE_STATE/leader/${kv%%=*}"
+done
+""",
+    "leader-get": """
+eval "key=\\${$#}"
+if [ -s "$FAKE_STATE/leader/$key" ]; then
+    echo "|-"
+    sed 's/^/  /' "$FAKE_STATE/leader/$key"
+fi
+""",
+}
+
+
+def install_fakes(bin_dir: Path) -> None:
+    """Write the fake executables into a directory"""
+    bin_dir.mkdir(parents=True)
+    for name, body in FAKES.items():
+        path = bin_dir / name
+        path.write_text(PRELUDE.format(var=name.upper().replace("-", "_")) + body)
+        path.chmod(0o755)
+
+
+def make_repository(path: Path) -> None:
+    """Create a small Flask-like application repository with two tagged releases"""
+    subprocess.check_call(["git", "init", "--quiet", str(path)])
+    for config in (["user.name", "Bench"], ["user.email", "bench@example.com"]):
+        subprocess.check_call(["git", "-C", str(path), "config", *config])
+    (path / "requirements.txt").write_text("Flask\nFlask-SQLAlchemy\npg8000\n")
+    (path / "init.py").write_text("from hello_juju import db\ndb.create_all()\n")
+    for tag in ("v1", "v2"):
+        (path / "hello_juju.py").write_text(f"VERSION = {tag!r}\n")
+        subprocess.check_call(["git", "-C", str(path), "add", "."])
+        subprocess.check_call(["git", "-C", str(path), "commit", "--quiet", "-m", tag])
+        subprocess.check_call(["git", "-C", str(path), "tag", tag])
+
+
+def relocate(root: Path) -> Tuple[Dict[str, Path], list]:
+    """Patch every filesystem location the charm uses into a scratch directory"""
+    app = root / "srv/app"
+    paths = {
+        "APP_PATH": app,
+        "RELEASES_PATH": root / "srv/app-releases",
+        "VENV_ROOT": app / "venv",
+        "VENVS_PATH": root / "srv/app-venvs",
+        "UNIT_PATH": root / "etc/systemd/system/hello-juju.service",
+        "SOCKET_PATH": root / "etc/systemd/system/hello-juju.socket",
+        "NGINX_PATH": root / "etc/nginx",
+        "NGINX_SITE_PATH": root / "etc/nginx/conf.d/hello-juju.conf",
+        "POLICY_RC_PATH": root / "usr/sbin/policy-rc.d",
+        "STATE_PATH": root / "var/lib/hello-juju",
+        "TRACE_PATH": root / "var/lib/hello-juju/traces",
+        "CACHE_PATH": root / "var/cache/hello-juju",
+        "MIRROR_PATH": root / "var/cache/hello-juju/app.git",
+        "WHEEL_CACHE_PATH": root / "var/cache/hello-juju/wheels",
+        "PID_PATH": root / "run/hello-juju/hello-juju.pid",
+        "PROC_PATH": root / "proc",
+    }
+    patches = [mock.patch(f"charm.{name}", path) for name, path in paths.items()]
+    # The fake apt-get writes package lists and records what it installs in a dpkg status file
+    patches.append(mock.patch.object(apt, "DPKG_STATUS_PATH", str(root / "fake/dpkg/status")))
+    patches.append(mock.patch.object(apt, "APT_LISTS_PATH", str(root / "fake/lists")))
+    patches.append(mock.patch.object(apt, "APT_INDEX_PATH", str(root / "fake/packages.json")))
+    patches.append(mock.patch.object(apt, "APT_UPDATE_STAMP_PATH", str(root / "fake/stamp")))
+    patches.append(mock.patch.object(apt, "APT_SOURCES_PATHS", (str(root / "fake/sources.list"),)))
+    # Methods bind the live release as a default argument when they are defined
+    for func in vars(HelloJujuCharm).values():
+        defaults = getattr(func, "__defaults__", None)
+        if defaults and charm.APP_PATH in defaults:
+            new = tuple(app if d == charm.APP_PATH else d for d in defaults)
+            patches.append(mock.patch.object(func, "__defaults__", new))
+    # The charm chowns files for www-data, which needs root
+    patches.append(mock.patch("os.chown"))
+    for path in ("etc/systemd/system", "var/lib/hello-juju"):
+        (root / path).mkdir(parents=True)
+    return paths, patches
+
+
+def run_hook(results: dict, name: str, emit) -> None:
+    """Run one hook, recording its wall time and the processes it spawned"""
+    # Every hook is a new process, so nothing is cached in memory between them
+    template_environment.cache_clear()
+    apt.clear_caches()
+    tracing.enable(name)
+    start = time.perf_counter()
+    emit()
+    elapsed = time.perf_counter() - start
+    spans = tracing.spans()
+    tracing.disable()
+    results[name]["times"].append(elapsed)
+    results[name]["processes"].append(len(spans))
+    results[name]["commands"].update(s["name"] for s in spans)
+
+
+def run_round(results: dict, url: str, root: Path) -> None:
+    """Drive one unit through a realistic lifetime"""
+    paths, patches = relocate(root)
+    for patch in patches:
+        patch.start()
+    os.environ.update(
+        FAKE_UNIT=str(paths["UNIT_PATH"]),
+        FAKE_PROC=str(paths["PROC_PATH"]),
+        FAKE_PIDFILE=str(paths["PID_PATH"]),
+    )
+    try:
+        harness = Harness(HelloJujuCharm)
+        harness.update_config({"application-repo": url, "port": 8080})
+        harness.set_leader(True)
+        harness.begin()
+        charm_ = harness.charm
+
+        run_hook(results, "install", charm_.on.install.emit)
+        run_hook(results, "config-changed", charm_.on.config_changed.emit)
+        run_hook(results, "start", charm_.on.start.emit)
+
+        relation = harness.add_relation("db", "postgresql")
+        run_hook(
+            results,
+            "db-relation-joined",
+            lambda: harness.add_relation_unit(relation, "postgresql/0"),
+        )
+        master = "host=10.0.0.{} dbname=hello-juju user=hello password=secret"
+        run_hook(
+            results,
+            "db-relation-changed",
+            lambda: harness.update_relation_data(
+                relation, "postgresql/0", {"database": "hello-juju", "master": master.format(1)}
+            ),
+        )
+        run_hook(
+            results,
+            "config-changed (redeploy)",
+            lambda: harness.update_config({"application-ref": "v1"}),
+        )
+        run_hook(
+            results, "config-changed (threads)", lambda: harness.update_config({"threads": 2})
+        )
+        run_hook(
+            results,
+            "db-relation-changed (failover)",
+            lambda: harness.update_relation_data(
+                relation, "postgresql/0", {"master": master.format(2)}
+            ),
+        )
+        harness.cleanup()
+    finally:
+        for patch in reversed(patches):
+            patch.stop()
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument(
+        "--latency", type=float, default=LATENCY, help="seconds each fake command takes"
+    )
+    parser.add_argument(
+        "--command-latency",
+        action="append",
+        default=[],
+        metavar="COMMAND=SECONDS",
+        help="override the latency of one fake command, e.g. apt-get=0.5",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="fail if a hook spawns more processes than recorded in this JSON file",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="write the process counts to --baseline"
+    )
+    args = parser.parse_args()
+
+    results = defaultdict(lambda: {"times": [], "processes": [], "commands": Counter()})
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        make_repository(tmp / "repo")
+        install_fakes(tmp / "bin")
+        environ = dict(os.environ)
+        os.environ.update(
+            FAKE_LATENCY=str(args.latency),
+            FAKE_BIN=str(tmp / "bin"),
+            FAKE_GIT=shutil.which("git"),
+            PATH=f"{tmp / 'bin'}{os.pathsep}{os.environ['PATH']}",
+        )
+        for override in args.command_latency:
+            command, latency = override.split("=", 1)
+            os.environ[f"FAKE_LATENCY_{command.upper().replace('-', '_')}"] = latency
+        try:
+            for n in range(args.rounds):
+                root = tmp / f"round{n}"
+                os.environ["FAKE_STATE"] = str(root / "fake")
+                for state in ("dpkg", "lists", "leader"):
+                    (root / "fake" / state).mkdir(parents=True)
+                run_round(results, f"file://{tmp / 'repo'}", root)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    print(f"{args.rounds} rounds, {args.latency * 1000:.0f}ms per fake command")
+    print(f"{'hook':<32} {'p50 (ms)':>9} {'p95 (ms)':>9} {'processes':>10}  by command")
+    counts = {}
+    for hook, result in results.items():
+        # Some libraries start helper processes lazily, so use the typical count
+        counts[hook] = percentile(result["processes"], 50)
+        commands = " ".join(
+            f"{name}:{count / args.rounds:.2g}" for name, count in result["commands"].most_common()
+        )
+        print(
+            f"{hook:<32} {percentile(result['times'], 50) * 1000:>9.1f} "
+            f"{percentile(result['times'], 95) * 1000:>9.1f} {counts[hook]:>10}  {commands}"
+        )
+
+    if args.baseline and args.update_baseline:
+        args.baseline.write_text(json.dumps(counts, indent=4) + "\n")
+    elif args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        regressions = [
+            f"{hook} spawned {count} processes, baseline is {baseline[hook]}"
+            for hook, count in counts.items()
+            if count > baseline.get(hook, count)
+        ]
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
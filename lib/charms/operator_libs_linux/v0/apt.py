@@ -103,15 +103,20 @@ if "deb-us.archive.ubuntu.com-xenial" not in repositories:
 """
 
 import fileinput
+import functools
 import glob
+import itertools
+import json
 import logging
+import mmap
 import os
 import re
 import subprocess
+import time
 from collections.abc import Mapping
 from enum import Enum
 from subprocess import PIPE, CalledProcessError, check_call, check_output
-from typing import Iterable, List, Optional, Tuple, Union
+from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
 from urllib.parse import urlparse
 
 logger = logging.getLogger(__name__)
@@ -124,11 +129,18 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 6
+LIBPATCH = 11
 
 
 VALID_SOURCE_TYPES = ("deb", "deb-src")
 OPTIONS_MATCHER = re.compile(r"\[.*?\]")
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+APT_LISTS_PATH = "/var/lib/apt/lists"
+APT_INDEX_PATH = "/var/cache/apt/operator-libs-linux-packages.json"
+# Touched after every successful update, by apt itself on Ubuntu and by `update`
+APT_UPDATE_STAMP_PATH = "/var/lib/apt/periodic/update-success-stamp"
+# Changes to any of these need the package lists to be updated
+APT_SOURCES_PATHS = ("/etc/apt/sources.list", "/etc/apt/sources.list.d", "/var/lib/dpkg/arch")
 
 
 class Error(Exception):
@@ -262,15 +274,68 @@ class DebianPackage:
 
     def _add(self) -> None:
         """Add a package to the system."""
-        self._apt(
+        self._add_all([self])
+
+    def _remove(self) -> None:
+        """Removes a package from the system. Implementation-specific."""
+        return self._remove_all([self])
+
+    @classmethod
+    def _add_all(cls, packages: List["DebianPackage"]) -> None:
+        """Add several packages to the system in a single `apt-get install` transaction.
+
+        Args:
+          packages: a list of `DebianPackage` objects to install
+
+        Raises:
+          PackageError if an error is encountered
+        """
+        cls._apt(
             "install",
-            "{}={}".format(self.name, self.version),
+            ["{}={}".format(p._apt_name(), p.version) for p in packages],
             optargs=["--option=Dpkg::Options::=--force-confold"],
         )
 
-    def _remove(self) -> None:
-        """Removes a package from the system. Implementation-specific."""
-        return self._apt("remove", "{}={}".format(self.name, self.version))
+    @classmethod
+    def _remove_all(cls, packages: List["DebianPackage"]) -> None:
+        """Remove several packages from the system in a single `apt-get remove` transaction.
+
+        Args:
+          packages: a list of `DebianPackage` objects to remove
+
+        Raises:
+          PackageError if an error is encountered
+        """
+        cls._apt("remove", ["{}={}".format(p._apt_name(), p.version) for p in packages])
+
+    @classmethod
+    def ensure_all(cls, packages: List["DebianPackage"], state: PackageState) -> None:
+        """Ensures that several packages are in a given state, using one apt transaction.
+
+        This is equivalent to calling `ensure` on every package, but the dpkg lock is
+        taken, dependencies are resolved and triggers are run only once.
+
+        Args:
+          packages: a list of `DebianPackage` objects to reconcile
+          state: a `PackageState` to reconcile the packages to
+
+        Raises:
+          PackageError from the underlying call to apt
+        """
+        pending = [p for p in packages if p._state is not state]
+        if pending:
+            if state not in (PackageState.Present, PackageState.Latest):
+                cls._remove_all(pending)
+            else:
+                cls._add_all(pending)
+        for p in packages:
+            p._state = state
+
+    def _apt_name(self) -> str:
+        """Returns the name apt knows the package by, qualified if it is for a foreign arch."""
+        if self._arch in ("", "all") or self._arch == _system_architecture():
+            return self._name
+        return "{}:{}".format(self._name, self._arch)
 
     @property
     def name(self) -> str:
@@ -395,51 +460,22 @@ class DebianPackage:
             version: an optional string if a specific version isr equested
             arch: an optional architecture, defaulting to `dpkg --print-architecture`.
                 If an architecture is not specified, this will be used for selection.
-        """
-        system_arch = check_output(
-            ["dpkg", "--print-architecture"], universal_newlines=True
-        ).strip()
-        arch = arch if arch else system_arch
 
-        # Regexps are a really terrible way to do this. Thanks dpkg
-        output = ""
-        try:
-            output = check_output(["dpkg", "-l", package], stderr=PIPE, universal_newlines=True)
-        except CalledProcessError:
-            raise PackageNotFoundError("Package is not installed: {}".format(package)) from None
-
-        # Pop off the output from `dpkg -l' because there's no flag to
-        # omit it`
-        lines = str(output).splitlines()[5:]
-
-        dpkg_matcher = re.compile(
-            r"""
-        ^(?P<package_status>\w+?)\s+
-        (?P<package_name>.*?)(?P<throwaway_arch>:\w+?)?\s+
-        (?P<version>.*?)\s+
-        (?P<arch>\w+?)\s+
-        (?P<description>.*)
-        """,
-            re.VERBOSE,
-        )
-
-        for line in lines:
-            try:
-                matches = dpkg_matcher.search(line).groupdict()
-                epoch, split_version = DebianPackage._get_epoch_from_version(matches["version"])
-                pkg = DebianPackage(
-                    matches["package_name"],
-                    split_version,
-                    epoch,
-                    matches["arch"],
-                    PackageState.Present,
-                )
-                if (pkg.arch == "all" or pkg.arch == arch) and (
-                    version == "" or str(pkg.version) == version
-                ):
-                    return pkg
-            except AttributeError:
-                logger.warning("dpkg matcher could not parse line: %s", line)
+        Packages are looked up in the dpkg status database, which is parsed once and kept in
+        memory until it changes.
+        """
+        package, arch = _resolve_arch(package, arch)
+
+        installed = _dpkg_status.index()
+        for candidate in (arch, "all"):
+            if (package, candidate) not in installed:
+                continue
+            epoch, split_version = DebianPackage._get_epoch_from_version(
+                installed[(package, candidate)]
+            )
+            pkg = DebianPackage(package, split_version, epoch, candidate, PackageState.Present)
+            if version == "" or str(pkg.version) == version:
+                return pkg
 
         # If we didn't find it, fail through
         raise PackageNotFoundError("Package {}.{} is not installed!".format(package, arch))
@@ -455,15 +491,32 @@ class DebianPackage:
             version: an optional string if a specific version isr equested
             arch: an optional architecture, defaulting to `dpkg --print-architecture`.
                 If an architecture is not specified, this will be used for selection.
+
+        Packages are looked up in an index of apt's package lists rather than with `apt-cache`,
+        and the newest matching version is returned.
         """
-        system_arch = check_output(
-            ["dpkg", "--print-architecture"], universal_newlines=True
-        ).strip()
-        arch = arch if arch else system_arch
+        package, arch = _resolve_arch(package, arch)
 
-        # Regexps are a really terrible way to do this. Thanks dpkg
-        keys = ("Package", "Architecture", "Version")
+        available = _apt_lists.index()
+        if available is None:
+            return cls._from_apt_cache_show(package, version, arch)
+
+        pkg = _candidate(package, version, arch, available.get(package, []))
+        if pkg:
+            return pkg
+
+        # If we didn't find it, fail through
+        raise PackageNotFoundError("Package {}.{} is not in the apt cache!".format(package, arch))
+
+    @classmethod
+    def _from_apt_cache_show(cls, package: str, version: str, arch: str) -> "DebianPackage":
+        """Look a package up with `apt-cache show`, for package lists which cannot be indexed.
 
+        Args:
+            package: a string representing the package
+            version: a string if a specific version is requested, or an empty string
+            arch: the architecture of the package
+        """
         try:
             output = check_output(
                 ["apt-cache", "show", package], stderr=PIPE, universal_newlines=True
@@ -500,7 +553,6 @@ class DebianPackage:
             ):
                 return pkg
 
-        # If we didn't find it, fail through
         raise PackageNotFoundError("Package {}.{} is not in the apt cache!".format(package, arch))
 
 
@@ -715,6 +767,304 @@ class Version:
         return not self.__eq__(other)
 
 
+class _DpkgStatus:
+    """An index of the installed packages, read from the dpkg status database.
+
+    `dpkg -l` is a fork per lookup with tabular output which has to be picked apart. Instead, the
+    status file is parsed in a single streaming pass into a mapping of `(name, arch)` to version,
+    which is kept until the file changes on disk. dpkg replaces the file whenever it changes the
+    database, so its inode, mtime and size identify a version of it.
+    """
+
+    _FIELDS = ("Package", "Status", "Version", "Architecture")
+
+    def __init__(self):
+        self._key = None
+        self._index = {}  # type: Dict[Tuple[str, str], str]
+
+    def clear(self) -> None:
+        """Forget the index, so that the status file is read again on the next lookup."""
+        self._key = None
+        self._index = {}
+
+    def index(self) -> Dict[Tuple[str, str], str]:
+        """Returns the installed packages as a mapping of `(name, arch)` to full version."""
+        try:
+            stat = os.stat(DPKG_STATUS_PATH)
+        except FileNotFoundError:
+            self.clear()
+            return self._index
+
+        key = (DPKG_STATUS_PATH, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._key:
+            with open(DPKG_STATUS_PATH, "r", encoding="utf-8", errors="replace") as f:
+                self._index = self._parse(f)
+            self._key = key
+        return self._index
+
+    @classmethod
+    def _parse(cls, stream: TextIO) -> Dict[Tuple[str, str], str]:
+        """Parse the stanzas of a dpkg status file, keeping the installed packages.
+
+        Args:
+          stream: an iterable of the lines of the status file
+        """
+        index = {}
+        fields = {}
+        # A trailing blank line closes the last stanza
+        for line in itertools.chain(stream, [""]):
+            if line[:1] in (" ", "\t"):
+                # Continuation of a multi-line field, such as a description
+                continue
+            if line.strip():
+                name, sep, value = line.partition(":")
+                if sep and name in cls._FIELDS:
+                    fields[name] = value.strip()
+                continue
+            # Packages which were removed, but not purged, are still listed
+            if "Package" in fields and fields.get("Status", "").split()[-1:] == ["installed"]:
+                index[(fields["Package"], fields.get("Architecture", ""))] = fields.get(
+                    "Version", ""
+                )
+            fields = {}
+        return index
+
+
+_dpkg_status = _DpkgStatus()
+
+
+class _AptLists:
+    """An index of the packages available from apt's package lists.
+
+    `apt-cache show` is a fork per lookup, and prints whole stanzas which then have to be split.
+    Instead, the `*_Packages` files which `apt-get update` leaves in the lists directory are
+    scanned through mmap for their Package, Architecture and Version fields only, into a mapping
+    of package name to the `(arch, version)` pairs available. That index is saved to disk along
+    with the mtime and size of every list it was built from, so that it is only rebuilt after the
+    lists change, and is kept in memory for the rest of the process.
+    """
+
+    # Matching from the newline which starts a field is much faster than anchoring with
+    # re.MULTILINE, which tries the pattern at every position
+    _FIELD_MATCHER = re.compile(rb"\n(Package|Architecture|Version):[ \t]*(\S+)")
+    _FIRST_FIELD_MATCHER = re.compile(rb"(Package):[ \t]*(\S+)")
+    _COMPRESSED_SUFFIXES = (".gz", ".xz", ".lz4", ".bz2", ".zst")
+
+    def __init__(self):
+        self._key = None
+        self._index = None  # type: Optional[Dict[str, List[List[str]]]]
+
+    def clear(self) -> None:
+        """Forget the index in memory, so that it is checked against the lists on next use."""
+        self._key = None
+        self._index = None
+
+    def index(self) -> Optional[Dict[str, List[List[str]]]]:
+        """Returns the available packages as a mapping of name to `(arch, full version)` pairs.
+
+        Returns None if some package lists are compressed, which the index does not cover.
+        """
+        lists = sorted(glob.glob(os.path.join(APT_LISTS_PATH, "*_Packages*")))
+        if any(path.endswith(self._COMPRESSED_SUFFIXES) for path in lists):
+            return None
+
+        key = {}
+        for path in lists:
+            if not path.endswith("_Packages"):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            key[os.path.basename(path)] = [stat.st_mtime_ns, stat.st_size]
+
+        if key != self._key:
+            self._index = self._load(key)
+            if self._index is None:
+                self._index = self._build(key)
+                self._save(key, self._index)
+            self._key = key
+        return self._index
+
+    @staticmethod
+    def _load(key: Dict[str, List[int]]) -> Optional[Dict[str, List[List[str]]]]:
+        """Load the index saved on disk, if it was built from the current lists."""
+        try:
+            with open(APT_INDEX_PATH, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(saved, dict) or saved.get("lists") != key:
+            return None
+        return saved["packages"]
+
+    @staticmethod
+    def _save(key: Dict[str, List[int]], index: Dict[str, List[List[str]]]) -> None:
+        """Save the index next to apt's own caches, replacing any previous one atomically."""
+        tmp = "{}.{}".format(APT_INDEX_PATH, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                f.write(json.dumps({"lists": key, "packages": index}))
+            os.replace(tmp, APT_INDEX_PATH)
+        except OSError as e:
+            # The index is only a cache, so it is rebuilt next time
+            logger.debug("could not save the apt package index: %s", e)
+
+    @classmethod
+    def _build(cls, key: Dict[str, List[int]]) -> Dict[str, List[List[str]]]:
+        """Scan the package lists for the fields of every package."""
+        index = {}
+
+        def add(name, fields):
+            if name is not None and b"Version" in fields:
+                entry = [fields.get(b"Architecture", b"").decode(), fields[b"Version"].decode()]
+                entries = index.setdefault(name.decode(), [])
+                if entry not in entries:
+                    entries.append(entry)
+
+        for filename in key:
+            with open(os.path.join(APT_LISTS_PATH, filename), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    # Package is the first field of every stanza
+                    name, fields = None, {}
+                    first = cls._FIRST_FIELD_MATCHER.match(m)
+                    matches = cls._FIELD_MATCHER.finditer(m)
+                    for match in itertools.chain([first] if first else [], matches):
+                        if match.group(1) == b"Package":
+                            add(name, fields)
+                            name, fields = match.group(2), {}
+                        else:
+                            fields[match.group(1)] = match.group(2)
+                    add(name, fields)
+        return index
+
+
+_apt_lists = _AptLists()
+
+
+@functools.lru_cache(maxsize=None)
+def _system_architecture() -> str:
+    """Returns the native architecture of the system, which is asked of dpkg once per process."""
+    return check_output(["dpkg", "--print-architecture"], universal_newlines=True).strip()
+
+
+@functools.lru_cache(maxsize=None)
+def _foreign_architectures() -> Tuple[str, ...]:
+    """Returns the foreign architectures enabled with `dpkg --add-architecture`, asked once."""
+    output = check_output(["dpkg", "--print-foreign-architectures"], universal_newlines=True)
+    return tuple(output.split())
+
+
+def _resolve_arch(package: str, arch: Optional[str] = "") -> Tuple[str, str]:
+    """Split a package name from its architecture qualifier and settle on an architecture.
+
+    Args:
+        package: the name of a package, optionally qualified with an architecture as in
+            `libc6:i386`
+        arch: an optional architecture, which takes precedence over a qualifier. Defaults to
+            the native architecture.
+
+    Returns: a tuple of the package name and the architecture to look it up for
+
+    Raises:
+        PackageNotFoundError if dpkg has not been configured for the architecture, so that no
+            package for it can be installed
+    """
+    name, _, qualifier = package.partition(":")
+    arch = arch or qualifier or _system_architecture()
+    if arch != "all" and arch != _system_architecture() and arch not in _foreign_architectures():
+        raise PackageNotFoundError(
+            "Package {}.{} is not available, as dpkg is not configured for {}".format(
+                name, arch, arch
+            )
+        )
+    return name, arch
+
+
+def clear_caches() -> None:
+    """Forget everything cached about the system, such as its architectures and packages.
+
+    The package indexes already follow changes to the files they are built from, but the
+    architectures are only asked of dpkg once per process. This is meant for tests, or after
+    running `dpkg --add-architecture`.
+    """
+    _system_architecture.cache_clear()
+    _foreign_architectures.cache_clear()
+    _dpkg_status.clear()
+    _apt_lists.clear()
+
+
+def _candidate(
+    name: str, version: str, arch: str, entries: List[List[str]]
+) -> Optional[DebianPackage]:
+    """Pick the newest available package matching a version and architecture.
+
+    Args:
+        name: the name of the package
+        version: a string if a specific version is requested, or an empty string
+        arch: the architecture of the package
+        entries: the `(arch, full version)` pairs available for the package
+
+    Returns: a `DebianPackage` if one matches, or None
+    """
+    candidates = []
+    for entry_arch, full_version in entries:
+        if entry_arch not in (arch, "all"):
+            continue
+        epoch, split_version = DebianPackage._get_epoch_from_version(full_version)
+        pkg = DebianPackage(name, split_version, epoch, entry_arch, PackageState.Available)
+        if version == "" or str(pkg.version) == version:
+            candidates.append(pkg)
+    return max(candidates, key=lambda p: p.version, default=None)
+
+
+def candidate_packages(
+    package_names: Union[str, List[str]], arch: Optional[str] = ""
+) -> Dict[str, DebianPackage]:
+    """Returns the newest version of several packages available from apt's package lists.
+
+    Args:
+        package_names: the name or names of the packages, optionally qualified with an
+            architecture as in `libc6:i386`
+        arch: an optional architecture, defaulting to `dpkg --print-architecture`
+
+    Returns: a dict of the requested names to `DebianPackage`, leaving out packages which are
+        not available for the architecture
+    """
+    if isinstance(package_names, str):
+        package_names = [package_names]
+
+    available = _apt_lists.index()
+    packages = {}
+    for package in package_names:
+        try:
+            name, name_arch = _resolve_arch(package, arch)
+            if available is None:
+                packages[package] = DebianPackage._from_apt_cache_show(name, "", name_arch)
+                continue
+        except (PackageNotFoundError, PackageError):
+            continue
+        pkg = _candidate(name, "", name_arch, available.get(name, []))
+        if pkg:
+            packages[package] = pkg
+    return packages
+
+
+def installed_packages() -> List[DebianPackage]:
+    """Returns every package installed on the system.
+
+    The dpkg status database is read once and reused until it changes, so this is cheap to call
+    repeatedly, and far cheaper than looking up many packages one at a time.
+    """
+    packages = []
+    for (name, arch), full_version in _dpkg_status.index().items():
+        epoch, version = DebianPackage._get_epoch_from_version(full_version)
+        packages.append(DebianPackage(name, version, epoch, arch, PackageState.Present))
+    return packages
+
+
 def add_package(
     package_names: Union[str, List[str]],
     version: Optional[str] = "",
@@ -748,24 +1098,19 @@ def add_package(
             "Explicit version should not be set if more than one package is being added!"
         )
 
-    for p in package_names:
-        pkg, success = _add(p, version, arch)
-        if success:
-            packages["success"].append(pkg)
-        else:
-            logger.warning("failed to locate and install/update '%s'", pkg)
-            packages["retry"].append(p)
+    found, missing = _add(package_names, version, arch)
+    packages["success"].extend(found)
+    for p in missing:
+        logger.warning("failed to locate and install/update '%s'", p)
+        packages["retry"].append(p)
 
     if packages["retry"] and not cache_refreshed:
         logger.info("updating the apt-cache and retrying installation of failed packages.")
         update()
 
-        for p in packages["retry"]:
-            pkg, success = _add(p, version, arch)
-            if success:
-                packages["success"].append(pkg)
-            else:
-                packages["failed"].append(p)
+        found, missing = _add(packages["retry"], version, arch)
+        packages["success"].extend(found)
+        packages["failed"].extend(missing)
 
     if packages["failed"]:
         raise PackageError("Failed to install packages: {}".format(", ".join(packages["failed"])))
@@ -774,26 +1119,32 @@ def add_package(
 
 
 def _add(
-    name: str,
+    names: List[str],
     version: Optional[str] = "",
     arch: Optional[str] = "",
-) -> Tuple[Union[DebianPackage, str], bool]:
-    """Adds a package.
+) -> Tuple[List[DebianPackage], List[str]]:
+    """Adds packages.
+
+    Every package is located first, and those which are not yet present are then
+    installed together in a single transaction.
 
     Args:
-        name: the name(s) of the package(s)
+        names: the names of the packages
         version: an (Optional) version as a string. Defaults to the latest known
-        arch: an optional architecture for the package
+        arch: an optional architecture for the packages
 
-    Returns: a tuple of `DebianPackage` if found, or a :str: if it is not, and
-        a boolean indicating success
+    Returns: a tuple of the `DebianPackage`s which were found and are now present,
+        and the names of the packages which could not be found
     """
-    try:
-        pkg = DebianPackage.from_system(name, version, arch)
-        pkg.ensure(state=PackageState.Present)
-        return pkg, True
-    except PackageNotFoundError:
-        return name, False
+    found = []
+    missing = []
+    for name in names:
+        try:
+            found.append(DebianPackage.from_system(name, version, arch))
+        except PackageNotFoundError:
+            missing.append(name)
+    DebianPackage.ensure_all(found, PackageState.Present)
+    return found, missing
 
 
 def remove_package(
@@ -815,18 +1166,70 @@ def remove_package(
 
     for p in package_names:
         try:
-            pkg = DebianPackage.from_installed_package(p)
-            pkg.ensure(state=PackageState.Absent)
-            packages.append(pkg)
+            packages.append(DebianPackage.from_installed_package(p))
         except PackageNotFoundError:
             logger.info("package '%s' was requested for removal, but it was not installed.", p)
 
+    # Remove everything in a single transaction
+    DebianPackage.ensure_all(packages, PackageState.Absent)
+
     return packages if len(packages) > 1 else packages[0]
 
 
-def update() -> None:
-    """Updates the apt cache via `apt-get update`."""
+def update(max_age: Optional[float] = None) -> bool:
+    """Updates the apt cache via `apt-get update`.
+
+    Args:
+        max_age: an optional number of seconds for which the package lists are fresh. If they
+            were updated more recently than that, and no sources or architectures were changed
+            since, the update is skipped. By default the lists are always updated.
+
+    Returns: True if the package lists were updated, or False if they were fresh
+    """
+    if max_age is not None and _lists_fresh(max_age):
+        logger.debug("apt package lists were updated in the last %ss, not updating", max_age)
+        return False
+
     check_call(["apt-get", "update"], stderr=PIPE, stdout=PIPE)
+    try:
+        os.makedirs(os.path.dirname(APT_UPDATE_STAMP_PATH), exist_ok=True)
+        with open(APT_UPDATE_STAMP_PATH, "a"):
+            os.utime(APT_UPDATE_STAMP_PATH)
+    except OSError as e:
+        logger.debug("could not record the apt update: %s", e)
+    return True
+
+
+def _lists_fresh(max_age: float) -> bool:
+    """Check whether the package lists were updated recently, and with the current sources.
+
+    The lists themselves do not tell when they were fetched, as apt keeps them untouched when the
+    mirror has nothing new, and gives them the modification time of the mirror's copy otherwise.
+    Instead the stamp touched after every successful update is compared against the sources.
+
+    Args:
+        max_age: the number of seconds for which the package lists are fresh
+    """
+    try:
+        updated = os.stat(APT_UPDATE_STAMP_PATH).st_mtime
+    except FileNotFoundError:
+        return False
+    if time.time() - updated > max_age:
+        return False
+    if not glob.glob(os.path.join(APT_LISTS_PATH, "*_Packages*")):
+        return False
+
+    for source in APT_SOURCES_PATHS:
+        # The mtime of a directory changes when one of its files is added or removed
+        paths = [source, *glob.glob(os.path.join(source, "*"))]
+        for path in paths:
+            try:
+                if os.stat(path).st_mtime > updated:
+                    logger.debug("%s changed since the last apt update", path)
+                    return False
+            except FileNotFoundError:
+                continue
+    return True
 
 
 class InvalidSourceError(Error):
@@ -11,20 +11,41 @@ Operator Framework. It deploys a simple Python Flask web application and
 implements a relation to the PostgreSQL charm.
 """
 
+import functools
+import hashlib
+import json
 import logging
+import math
 import os
+import re
 import shutil
+import socket
+import sysconfig
+import tarfile
+import time
 from pathlib import Path
-from subprocess import check_call, check_output
+from subprocess import CalledProcessError, check_call, check_output
+from http.client import HTTPConnection, HTTPException
+from typing import Optional
 
+import loadtest
 import ops.lib
+import tracing
 from charms.operator_libs_linux.v0 import apt, passwd, systemd
-from git import Repo
-from jinja2 import Template
+from git import Head, Repo
+from git.exc import GitCommandError, InvalidGitRepositoryError, NoSuchPathError
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from ops.charm import CharmBase
 from ops.framework import StoredState
 from ops.main import main
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+from ops.model import (
+    ActiveStatus,
+    BlockedStatus,
+    MaintenanceStatus,
+    ModelError,
+    WaitingStatus,
+)
+from pipeline import Pipeline
 
 # See: https://github.com/canonical/ops-lib-pgsql
 pgsql = ops.lib.use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
@@ -32,8 +53,139 @@ pgsql = ops.lib.use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
 logger = logging.getLogger(__name__)
 
 APP_PATH = Path("/srv/app")
+RELEASES_PATH = Path("/srv/app-releases")
 VENV_ROOT = Path(f"{APP_PATH}/venv")
+# Virtualenvs shared by every release with the same interpreter and dependencies
+VENVS_PATH = Path("/srv/app-venvs")
 UNIT_PATH = Path("/etc/systemd/system/hello-juju.service")
+SOCKET_PATH = Path("/etc/systemd/system/hello-juju.socket")
+# Where gunicorn listens when nginx proxies to it, outside its RuntimeDirectory
+# which systemd removes whenever the service stops
+GUNICORN_SOCKET_PATH = Path("/run/hello-juju.sock")
+NGINX_PATH = Path("/etc/nginx")
+NGINX_SITE_PATH = Path(f"{NGINX_PATH}/conf.d/hello-juju.conf")
+NGINX_CACHE_PATH = Path("/var/cache/nginx/hello-juju")
+# Stops packages from starting their services while they are installed
+POLICY_RC_PATH = Path("/usr/sbin/policy-rc.d")
+STATE_PATH = Path("/var/lib/hello-juju")
+CACHE_PATH = Path("/var/cache/hello-juju")
+MIRROR_PATH = Path(f"{CACHE_PATH}/app.git")
+# Only branches and tags are mirrored, hosted forges often publish many more refs
+MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+WHEEL_CACHE_PATH = Path(f"{CACHE_PATH}/wheels")
+# Optional resource holding the application tree and a wheelhouse, for offline deploys
+BUNDLE_RESOURCE = "application-bundle"
+# Packages installed into the virtualenv alongside the application's requirements
+EXTRA_PACKAGES = ["gunicorn"]
+# Additional packages needed by each supported gunicorn worker class
+WORKER_CLASS_PACKAGES = {"sync": [], "gthread": [], "gevent": ["gevent"]}
+CGROUP_PATH = Path("/sys/fs/cgroup")
+PROC_PATH = Path("/proc")
+PID_PATH = Path("/run/hello-juju/hello-juju.pid")
+# Seconds to wait for gunicorn to replace its workers after a reload
+RELOAD_TIMEOUT = 60
+# Chrome trace files written by hooks when the trace-hooks option is set
+TRACE_PATH = Path(f"{STATE_PATH}/traces")
+# Peer relation the leader uses to share state with the other units
+PEER_RELATION = "cluster"
+# Read-only page requested to check that a restarted unit serves requests again;
+# the root page would count the check as a visit
+HEALTH_CHECK_PATH = "/greetings"
+# Seconds a restarted unit has to pass its health check
+HEALTH_CHECK_TIMEOUT = 60
+# Connections per gevent worker when the pool size is derived, SQLAlchemy's own default
+GEVENT_POOL_SIZE = 5
+# Seconds for which apt's package lists are recent enough to install from without an update
+APT_UPDATE_MAX_AGE = 60 * 60
+
+
+@functools.lru_cache(maxsize=None)
+def template_environment(template_dir: str) -> Environment:
+    """Return the Jinja environment shared by every render in this process
+
+    Parsed templates are cached by the environment for the rest of the hook, and
+    their compiled bytecode is kept in the charm's state directory for later hooks.
+    """
+    bytecode_cache = None
+    try:
+        cache_dir = Path(f"{STATE_PATH}/jinja")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(str(cache_dir))
+    except OSError:
+        logger.debug("template bytecode cache unavailable, compiling templates in memory")
+    return Environment(loader=FileSystemLoader(template_dir), bytecode_cache=bytecode_cache)
+
+
+def available_cpus() -> int:
+    """Return the number of CPUs this unit may use, honouring cpusets and cgroup CPU quotas"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    quota = period = None
+    try:
+        # cgroup v2 exposes "<quota> <period>", where the quota may be "max"
+        quota, period = Path(f"{CGROUP_PATH}/cpu.max").read_text().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1 uses separate files, with a quota of -1 meaning unlimited
+            quota = Path(f"{CGROUP_PATH}/cpu/cpu.cfs_quota_us").read_text().strip()
+            period = Path(f"{CGROUP_PATH}/cpu/cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            pass
+
+    if quota not in (None, "max", "-1"):
+        cpus = min(cpus, max(1, math.ceil(int(quota) / int(period))))
+    return cpus
+
+
+def bundle_member_safe(member: tarfile.TarInfo, root: Optional[str] = None) -> bool:
+    """Return whether an application bundle member stays inside the release directory
+
+    Given the directory being extracted into, the paths are also resolved against
+    the links already extracted there, which a chain of links could otherwise use
+    to step outside it one level at a time.
+    """
+    if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+        return False
+    if os.path.isabs(member.name) or os.path.normpath(member.name).startswith(".."):
+        return False
+    if member.issym():
+        # Symlink targets are relative to the directory holding the link
+        target = os.path.join(os.path.dirname(member.name), member.linkname)
+    elif member.islnk():
+        # Hard link targets are relative to the root of the archive
+        target = member.linkname
+    else:
+        target = None
+    if target is not None and (
+        os.path.isabs(member.linkname) or os.path.normpath(target).startswith("..")
+    ):
+        return False
+    if root is None:
+        return True
+
+    root = os.path.realpath(root)
+    paths = [member.name] if target is None else [member.name, target]
+    for path in paths:
+        real = os.path.realpath(os.path.join(root, path))
+        if real != root and not real.startswith(root + os.sep):
+            return False
+    return True
+
+
+class UnixHTTPConnection(HTTPConnection):
+    """HTTP connection to a server listening on a unix socket"""
+
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
 
 
 class HelloJujuCharm(CharmBase):
@@ -46,7 +198,28 @@ class HelloJujuCharm(CharmBase):
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.start, self._on_start)
         self.framework.observe(self.on.config_changed, self._on_config_changed)
-        self._stored.set_default(repo="", port="", conn_str="")
+        self.framework.observe(self.on.upgrade_charm, self._on_upgrade_charm)
+        self.framework.observe(self.on.rollback_action, self._on_rollback_action)
+        self.framework.observe(self.on.hook_profile_action, self._on_hook_profile_action)
+        self.framework.observe(self.on.load_test_action, self._on_load_test_action)
+        # Restarts are rolled across the units, a few at a time, by the leader
+        self.framework.observe(self.on[PEER_RELATION].relation_changed, self._on_cluster_changed)
+        self.framework.observe(self.on[PEER_RELATION].relation_departed, self._on_cluster_changed)
+        self.framework.observe(self.on.leader_elected, self._on_cluster_changed)
+        self.framework.observe(self.on.update_status, self._on_cluster_changed)
+        self._stored.set_default(
+            repo="",
+            ref="",
+            port="",
+            conn_str="",
+            standbys=[],
+            schema="",
+            master_deferred=0,
+            releases=[],
+            gunicorn={},
+            restart="",
+            proxy=False,
+        )
 
         # Initialise the PostgreSQL Client for the "db" relation
         self.db = pgsql.PostgreSQLClient(self, "db")
@@ -54,52 +227,250 @@ class HelloJujuCharm(CharmBase):
             self.db.on.database_relation_joined, self._on_database_relation_joined
         )
         self.framework.observe(self.db.on.master_changed, self._on_database_master_changed)
+        self.framework.observe(self.db.on.standby_changed, self._on_database_standby_changed)
+
+        # Record every command this hook runs, and save them once the hook is done
+        if self.config["trace-hooks"]:
+            tracing.enable(Path(os.environ.get("JUJU_DISPATCH_PATH", "unknown")).name)
+            self.framework.observe(self.framework.on.commit, self._on_commit)
 
     def _on_install(self, _):
         """Install prerequisites for the application"""
-        # Install some Python packages using apt
         self.unit.status = MaintenanceStatus("installing pip and virtualenv")
-        self._install_apt_packages(["python3-pip", "python3-virtualenv"])
-        # Clone application code and install dependencies, setup initial db
-        self._setup_application()
-        # Template out the systemd service file
-        self._render_systemd_unit()
+        # Template out the systemd service and socket files
+        self._render_systemd_units()
+        # Clone application code and install dependencies, setup initial db. The
+        # application's dependencies can only be installed once pip is available
+        bundle = self._application_bundle()
+        pipeline = self._application_pipeline(bundle, after=["apt", "prefetch-wheels"])
+        # Install some Python packages using apt while the code is being fetched
+        pipeline.add(
+            "apt", lambda: self._install_apt_packages(["python3-pip", "python3-virtualenv"])
+        )
+        pipeline.add("prefetch-wheels", lambda: self._prefetch_wheels(bundle), after=["apt"])
+        try:
+            self._run_application_pipeline(pipeline)
+        except (apt.PackageNotFoundError, apt.PackageError) as e:
+            logger.error("could not install packages: %s", e)
+            self.unit.status = BlockedStatus("Failed to install packages")
 
     def _on_start(self, _):
         """Start the workload"""
         check_call(["open-port", f"{self._stored.port}/TCP"])
-        # Enable and start the "hello-juju" systemd unit
+        # Enable and start the socket, which holds the listening port, and the
+        # "hello-juju" service it passes the socket to
+        systemd.service_resume("hello-juju.socket")
         systemd.service_resume("hello-juju")
+        if self.config["proxy"]:
+            systemd.service_resume("nginx")
+            self._stored.proxy = True
         self.unit.status = ActiveStatus()
 
     def _on_config_changed(self, _):
         """Handle changes to the application configuration"""
         restart = False
+        reload = False
+
+        if self.config["worker-class"] not in WORKER_CLASS_PACKAGES:
+            self.unit.status = BlockedStatus(
+                f"invalid worker-class '{self.config['worker-class']}'"
+            )
+            return
+        if self.config["workers"] != "auto" and not self.config["workers"].isdigit():
+            self.unit.status = BlockedStatus(f"invalid workers '{self.config['workers']}'")
+            return
+        pool_size = self.config["db-pool-size"]
+        if pool_size != "auto" and not pool_size.isdigit():
+            self.unit.status = BlockedStatus(f"invalid db-pool-size '{pool_size}'")
+            return
+        if not re.fullmatch(r"[0-9]+[kKmMgG]?", self.config["proxy-cache-size"]):
+            self.unit.status = BlockedStatus(
+                f"invalid proxy-cache-size '{self.config['proxy-cache-size']}'"
+            )
+            return
 
-        # Check if the application repo has been changed
-        if self.config["application-repo"] != self._stored.repo:
+        # Check if the application repo or the requested revision has been changed,
+        # or if no release was ever deployed, for example after a failed install
+        live_requirements = self._live_requirements_hash()
+        if (
+            self.config["application-repo"] != self._stored.repo
+            or self.config["application-ref"] != self._stored.ref
+            or not APP_PATH.exists()
+        ):
             logger.info("application repo changed, installing")
-            self._stored.repo = self.config["application-repo"]
             self._setup_application()
-            restart = True
+            # Gunicorn's master process keeps the virtualenv it was started from,
+            # so only code changes can be picked up by a reload
+            if self._live_requirements_hash() != live_requirements:
+                restart = True
+            else:
+                reload = True
+
+        if self._gunicorn_options() != dict(self._stored.gunicorn):
+            logger.info("gunicorn config changed, configuring")
+            # Some worker classes need extra packages in the live release's venv
+            if APP_PATH.exists():
+                self._install_dependencies()
+
+        # The connection pool follows the worker settings, new pool options only
+        # need fresh workers to take effect
+        if self._stored.conn_str and APP_PATH.exists() and self._render_settings_file():
+            logger.info("database pool config changed, configuring")
+            reload = True
 
         if self.config["port"] != self._stored.port:
             logger.info("port config changed, configuring")
             # Close the existing application port
             check_call(["close-port", f"{self._stored.port}/TCP"])
-            # Reconfigure the systemd unit to specify the new port
             self._stored.port = self.config["port"]
-            self._render_systemd_unit()
             # Ensure the correct port is opened for the application
             check_call(["open-port", f"{self._stored.port}/TCP"])
+
+        if self.config["proxy"] and not Path(f"{NGINX_PATH}/nginx.conf").exists():
+            self._install_nginx()
+            if not Path(f"{NGINX_PATH}/nginx.conf").exists():
+                # The status says why the package could not be installed
+                return
+        proxy_changed = self._render_proxy_config()
+
+        # Reconfigure the systemd units with the current port and worker settings,
+        # gunicorn only needs restarting if a unit actually changed. The socket
+        # keeps listening while only the service restarts, so no connections are
+        # refused meanwhile
+        changed = self._render_systemd_units()
+        if "hello-juju.service" in changed:
             restart = True
 
-        if restart:
-            logger.info("restarting hello-juju application")
-            systemd.service_restart("hello-juju")
+        # Switching the proxy on or off moves the socket, and nginx is started or
+        # stopped along with it; otherwise nginx picks up its new config gracefully
+        if proxy_changed and self._stored.proxy and self.config["proxy"]:
+            logger.info("reloading nginx")
+            systemd.service_reload("nginx", restart_on_failure=True)
+
+        restarted = True
+        if "hello-juju.socket" in changed:
+            restarted = self._request_restart("socket")
+        elif restart:
+            restarted = self._request_restart("service")
+        elif reload:
+            # Gunicorn picks up the new release behind the symlink without
+            # dropping connections
+            self._reload_application()
+
+        if restarted:
+            self.unit.status = ActiveStatus()
 
+    def _on_upgrade_charm(self, _):
+        """Redeploy the application when a new bundle resource has been attached"""
+        bundle = self._application_bundle()
+        if not bundle:
+            return
+        release = self._bundle_release(bundle)
+        if self._stored.releases and self._stored.releases[-1] == release.name:
+            logger.info("application bundle unchanged")
+            return
+
+        logger.info("application bundle changed, installing")
+        live_requirements = self._live_requirements_hash()
+        self._setup_application()
+        if self._live_requirements_hash() != live_requirements:
+            if not self._request_restart("service"):
+                return
+        else:
+            self._reload_application()
         self.unit.status = ActiveStatus()
 
+    def _on_rollback_action(self, event):
+        """Switch the application back to the previously deployed release
+
+        The release rolled back from is kept as the previous one, so running the
+        action again rolls forward to it.
+        """
+        if len(self._stored.releases) < 2:
+            event.fail("no previous release to roll back to")
+            return
+
+        current = self._stored.releases[-1]
+        release = Path(f"{RELEASES_PATH}/{self._stored.releases[-2]}")
+        # The database may have moved since this release was built
+        if self._stored.conn_str:
+            self._render_settings_file(release)
+        live_requirements = self._live_requirements_hash()
+        self._activate_release(release)
+        self._record_release(release)
+        if self._live_requirements_hash() != live_requirements:
+            systemd.service_restart("hello-juju")
+        else:
+            self._reload_application()
+        event.set_results({"release": release.name, "previous": current})
+
+    def _on_hook_profile_action(self, event):
+        """Report the slowest commands run by recent hooks"""
+        spans = tracing.slowest(TRACE_PATH, event.params["limit"])
+        if not spans:
+            event.fail("no hook traces found, enable the trace-hooks option first")
+            return
+        lines = [
+            "{:>10.1f}ms  {}  {} (exit {})".format(
+                span["dur"] / 1000,
+                span["args"]["phase"],
+                " ".join(span["args"]["command"]),
+                span["args"]["returncode"],
+            )
+            for span in spans
+        ]
+        event.set_results(
+            {"traces": len(list(TRACE_PATH.glob("*.json"))), "slowest": "\n".join(lines)}
+        )
+
+    def _on_load_test_action(self, event):
+        """Measure how much traffic the local gunicorn listener can serve"""
+        if not self._stored.port:
+            event.fail("the application is not listening yet")
+            return
+        params = event.params
+        # Behind the proxy, load gunicorn itself rather than nginx's cache
+        unix_socket = str(GUNICORN_SOCKET_PATH) if self._stored.proxy else None
+        event.log(
+            f"sending requests to {unix_socket or f'port {self._stored.port}'} "
+            f"for {params['duration']}s with {params['concurrency']} connections"
+        )
+        result = loadtest.run(
+            "127.0.0.1",
+            self._stored.port,
+            params["duration"],
+            params["concurrency"],
+            params["path"],
+            unix_socket=unix_socket,
+        )
+        event.set_results(
+            {
+                "requests": result.requests,
+                "errors": result.errors,
+                "error-rate": f"{result.error_rate:.4f}",
+                "throughput": f"{result.throughput:.1f}",
+                "latency-ms": {
+                    f"p{p}": f"{result.percentile(p) * 1000:.1f}" for p in (50, 95, 99)
+                },
+            }
+        )
+
+    def _on_cluster_changed(self, _):
+        """Hand out restart slots on the leader, and restart once this unit holds one
+
+        The leader also republishes the schema it initialised, for peers that
+        joined after it did so.
+        """
+        if self._stored.conn_str and self._stored.schema and self.unit.is_leader():
+            if self._schema_fingerprint() == self._stored.schema:
+                self._publish_schema(self._stored.schema)
+        self._grant_restarts()
+        self._check_restart_grant()
+
+    def _on_commit(self, _):
+        """Write out the commands traced during this hook"""
+        logger.info("hook trace written to %s", tracing.write(TRACE_PATH))
+
     def _on_database_relation_joined(self, event):
         """Handle the event where this application is joined with a database"""
         if self.unit.is_leader():
@@ -112,116 +483,892 @@ class HelloJujuCharm(CharmBase):
             # Leader has not yet set the database name/requirements.
             return
 
+        # Failovers arrive as bursts of events, and every deferred event is emitted
+        # again before each later hook. Event keys only grow, so an event older than
+        # the last one deferred has been superseded by it
+        if int(event.handle.key) < self._stored.master_deferred:
+            logger.info("dropping master_changed superseded by a newer deferred event")
+            return
+
         # event.master will be none if the master database is unavailable,
         # or a pgsql.ConnectingString instance
-        if event.master:
-            self.unit.status = MaintenanceStatus("configuring database settings")
-            # Store the connection uri in state
-            # Replace the first part of the URL with pg8000 equivalent
-            self._stored.conn_str = event.master.uri.replace(
-                "postgresql://", "postgresql+pg8000://"
-            )
-            # Render the settings file with the database connection details
-            self._render_settings_file()
-            # Ensure the database tables are created in the master
-            self._create_database_tables()
-            # Restart the service
-            systemd.service_restart("hello-juju")
-            # Set back to active status
+        if not event.master:
+            # Defer this event until the master is available
+            self._defer_master_changed(event)
+            return
+
+        # The relation data is read when the event runs, so a deferred or repeated
+        # event often carries connection details that have already been applied
+        conn_str = self._pg8000_uri(event.master.uri)
+        standbys = sorted(self._pg8000_uri(s.uri) for s in event.standbys)
+        if conn_str == self._stored.conn_str and standbys == list(self._stored.standbys):
+            logger.info("database connection already applied")
             self.unit.status = ActiveStatus()
+            return
+
+        # Only the leader initialises the schema, the other units wait until it
+        # has published this database rather than all connecting to it at once.
+        # Units may have checked out different application code, so they compare
+        # the database rather than a fingerprint of their own schema code
+        database = hashlib.sha256(conn_str.encode()).hexdigest()
+        if not self.unit.is_leader() and self._published_database() != database:
+            self.unit.status = WaitingStatus("waiting for leader to initialise database")
+            self._defer_master_changed(event)
+            return
+
+        self.unit.status = MaintenanceStatus("configuring database settings")
+        # Store the connection uri in state
+        self._stored.conn_str = conn_str
+        self._stored.standbys = standbys
+        # Render the settings file with the database connection details
+        if self._render_settings_file():
+            # Ensure the database tables are created in the master
+            self.unit.status = MaintenanceStatus("creating database tables")
+            self._record_schema(
+                self._create_database_tables(
+                    APP_PATH, self.unit.is_leader(), self._published_schema()
+                )
+            )
+            # New settings only need fresh workers, not a new master process
+            self._reload_application()
         else:
-            # Defer this event until the master is available
-            event.defer()
+            logger.info("database settings unchanged")
+        # Set back to active status
+        self.unit.status = ActiveStatus()
+
+    def _defer_master_changed(self, event):
+        """Defer a master_changed event, superseding any deferred before it"""
+        self._stored.master_deferred = int(event.handle.key)
+        event.defer()
+
+    def _on_database_standby_changed(self, event):
+        """Handle the case where the set of PostgreSQL hot standbys changes"""
+        if event.database != self.app.name:
+            return
+
+        # Sorted so that the same standbys in a different order render identically
+        standbys = sorted(self._pg8000_uri(s.uri) for s in event.standbys)
+        if standbys == list(self._stored.standbys):
+            logger.info("database standbys already applied")
             return
+        self._stored.standbys = standbys
+        logger.info("database has %d standby(s)", len(self._stored.standbys))
+        # Without a master there are no settings yet, the standbys are rendered
+        # along with the master once it is available
+        if self._stored.conn_str and self._render_settings_file():
+            self._reload_application()
+
+    def _pg8000_uri(self, uri: str) -> str:
+        """Replace the first part of a connection URL with the pg8000 equivalent"""
+        return uri.replace("postgresql://", "postgresql+pg8000://")
 
     def _setup_application(self):
-        """Clone a Flask application into place and setup it's dependencies"""
+        """Build a release of the Flask application and make it live"""
         self.unit.status = MaintenanceStatus("fetching application code")
+        self._run_application_pipeline(self._application_pipeline(self._application_bundle()))
+
+    def _application_pipeline(self, bundle: Optional[Path], after: list = None) -> Pipeline:
+        """Build the steps that deploy a release of the Flask application
+
+        The steps run in threads, so everything they need from the ops model is
+        looked up here, and they return what is to be recorded in it afterwards
+        by `_run_application_pipeline`. The configured repo and ref are deployed,
+        and only recorded as deployed once every step has succeeded.
 
-        # Delete the application directory if it exists already
-        if Path(APP_PATH).is_dir():
-            shutil.rmtree("/srv/app")
+        Args:
+            bundle: the attached application bundle, or None to fetch the code with git
+            after: names of additional steps, added to the pipeline by the caller,
+                that must finish before the application's dependencies are installed
+        """
+        pipeline = Pipeline("setup")
+        repo, ref = self.config["application-repo"], self.config["application-ref"]
+        leader = self.unit.is_leader()
+        published = self._published_schema()
 
-        # If this is the first time, set the repo in the stored state
-        if not self._stored.repo:
-            self._stored.repo = self.config["application-repo"]
+        def checkout():
+            # Each release is built next to the live one, which keeps serving meanwhile
+            commit = pipeline.results["fetch"]
+            release = Path(f"{RELEASES_PATH}/{commit}")
+            self._checkout_application(commit, release)
+            return release
 
-        # Fetch the code using git
-        Repo.clone_from(self._stored.repo, APP_PATH)
+        def settings():
+            # If a connection string exists (and relation is defined) then
+            # render the settings file for the new app with the connection details
+            if self._stored.conn_str:
+                self._render_settings_file(pipeline.results["checkout"])
+
+        if bundle:
+            # Air-gapped deploys unpack the code and its wheels from the attached resource
+            pipeline.add("checkout", lambda: self._extract_bundle(bundle))
+        else:
+            # Fetch the code using git, only transferring objects we don't already have
+            pipeline.add("fetch", lambda: self._fetch_application(repo, ref))
+            pipeline.add("checkout", checkout, after=["fetch"])
         # Install application dependencies
-        check_output(["python3", "-m", "virtualenv", f"{VENV_ROOT}"])
-        check_output([f"{VENV_ROOT}/bin/pip3", "install", "gunicorn"])
-        check_output(
-            [f"{VENV_ROOT}/bin/pip3", "install", "-r", f"{APP_PATH}/requirements.txt", "--force"]
+        pipeline.add(
+            "dependencies",
+            lambda: self._install_dependencies(pipeline.results["checkout"]),
+            after=["checkout", *(after or [])],
         )
+        pipeline.add("settings", settings, after=["checkout"])
+        # Create required database tables
+        pipeline.add(
+            "database",
+            lambda: self._create_database_tables(pipeline.results["checkout"], leader, published),
+            after=["dependencies", "settings"],
+        )
+        # Make the new release live
+        pipeline.add(
+            "activate",
+            lambda: self._activate_release(pipeline.results["checkout"]),
+            after=["database"],
+        )
+        return pipeline
 
-        # If a connection string exists (and relation is defined) then
-        # render the settings file for the new app with the connection details
-        if self._stored.conn_str:
-            self._render_settings_file()
+    def _run_application_pipeline(self, pipeline: Pipeline):
+        """Run the deploy steps, then record their outcome from the main thread"""
+        pipeline.run()
+        # Only a successful deploy counts as applied, anything else is retried by
+        # the next config-changed
+        self._stored.repo = self.config["application-repo"]
+        self._stored.ref = self.config["application-ref"]
+        self._record_schema(pipeline.results["database"])
+        # Remember the new release and clean up old ones
+        self._record_release(pipeline.results["checkout"])
+        self._prune_releases()
 
-        # Create required database tables
-        self._create_database_tables()
+    def _fetch_application(self, repo: str, ref: str) -> str:
+        """Update the local mirror of the application repo and resolve the commit to deploy"""
+        try:
+            mirror = Repo(MIRROR_PATH)
+            # Point the mirror at the configured remote; objects shared with
+            # the previous remote are kept, so only new history is transferred
+            mirror.remote().set_url(repo)
+            mirror.remote().fetch(MIRROR_REFSPECS, prune=True)
+            if not ref:
+                self._follow_remote_head(mirror, repo)
+        except (NoSuchPathError, InvalidGitRepositoryError):
+            mirror = self._clone_mirror(repo)
+        except GitCommandError:
+            # An unreachable remote fails the same way as a corrupt mirror, and
+            # only the latter is worth throwing the mirror away for
+            try:
+                mirror.git.fsck("--connectivity-only")
+            except GitCommandError:
+                mirror.close()
+                mirror = self._clone_mirror(repo)
+            else:
+                mirror.close()
+                raise
 
-    def _install_apt_packages(self, packages: list):
-        """Simple wrapper around 'apt-get install -y"""
+        # Closing the repo stops GitPython's persistent cat-file processes now,
+        # rather than whenever the object happens to be garbage collected
+        with mirror:
+            return mirror.commit(ref or "HEAD").hexsha
+
+    def _clone_mirror(self, repo: str) -> Repo:
+        """Replace the local mirror of the application repo with a fresh clone"""
+        logger.info("no usable application mirror found, cloning %s", repo)
+        # Remove whatever is left of a corrupt mirror before cloning
+        if MIRROR_PATH.exists():
+            shutil.rmtree(MIRROR_PATH)
+        return Repo.clone_from(repo, MIRROR_PATH, bare=True)
+
+    def _follow_remote_head(self, mirror: Repo, repo: str):
+        """Point the mirror's HEAD at the remote's default branch
+
+        Fetching doesn't move HEAD, so it would dangle once the remote switches its
+        default branch and the old one is pruned.
+        """
+        for line in mirror.git.ls_remote("--symref", repo, "HEAD").splitlines():
+            ref, _, name = line.partition("\t")
+            kind, _, branch = ref.partition(" ")
+            if name == "HEAD" and kind == "ref:":
+                mirror.head.reference = Head(mirror, branch)
+                return
+
+    def _checkout_application(self, commit: str, release: Path):
+        """Check out the given commit from the local mirror into a release directory"""
         try:
-            apt.update()
-            apt.add_package(packages)
-        except apt.PackageNotFoundError:
-            logger.error("a specified package not found in package cache or on system")
-            self.unit.status = BlockedStatus("Failed to install packages")
-        except apt.PackageError:
-            logger.error("could not install package")
-            self.unit.status = BlockedStatus("Failed to install packages")
+            with Repo(release) as app:
+                app.git.checkout("--force", commit)
+            return
+        except (NoSuchPathError, InvalidGitRepositoryError, GitCommandError):
+            logger.info("release checkout unusable, cloning from the local mirror")
+
+        # Delete the release directory if it exists already
+        if release.is_dir():
+            shutil.rmtree(release)
+        # A shared clone borrows objects from the mirror rather than copying them
+        with Repo.clone_from(str(MIRROR_PATH), release, shared=True, no_checkout=True) as app:
+            app.git.checkout("--force", commit)
+
+    def _application_bundle(self) -> Optional[Path]:
+        """Return the path of the attached application bundle, or None without one"""
+        try:
+            bundle = self.model.resources.fetch(BUNDLE_RESOURCE)
+        except (ModelError, NameError):
+            return None
+        # An empty file stands in for a resource that was never uploaded
+        if not bundle.is_file() or bundle.stat().st_size == 0:
+            return None
+        return bundle
+
+    def _bundle_release(self, bundle: Path) -> Path:
+        """Return the release directory for an application bundle, named after its digest"""
+        digest = hashlib.sha256()
+        with open(bundle, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return Path(f"{RELEASES_PATH}/bundle-{digest.hexdigest()}")
+
+    def _extract_bundle(self, bundle: Path) -> Path:
+        """Unpack an application bundle into its release directory
+
+        The archive is read as a stream and each member is written straight into
+        place, so the bundle is never staged or copied on the unit.
+        """
+        release = self._bundle_release(bundle)
+        if release.is_dir():
+            logger.info("application bundle already extracted to %s", release)
+            return release
+
+        # Extract next to the release and rename it into place once complete, so
+        # an interrupted extraction is never mistaken for a usable release
+        partial = Path(f"{release}.partial")
+        if partial.exists():
+            shutil.rmtree(partial)
+        partial.mkdir(parents=True)
+        # Python versions with extraction filters vet members themselves as well
+        options = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        with tarfile.open(bundle, mode="r|*") as tar:
+            for member in tar:
+                if not bundle_member_safe(member, str(partial)):
+                    raise ValueError(f"unsafe path in application bundle: {member.name}")
+                tar.extract(member, partial, **options)
+        os.replace(partial, release)
+        logger.info("extracted application bundle to %s", release)
+        return release
+
+    def _activate_release(self, release: Path):
+        """Atomically point the application path at the given release
+
+        The release history is left to `_record_release`.
+        """
+        # Deployments from before release directories have a real directory here
+        if APP_PATH.is_dir() and not APP_PATH.is_symlink():
+            shutil.rmtree(APP_PATH)
+
+        # Renaming a symlink over the old one is atomic, unlike replacing it in place
+        link = Path(f"{APP_PATH}.new")
+        if link.is_symlink():
+            link.unlink()
+        link.symlink_to(release)
+        os.replace(link, APP_PATH)
+        logger.info("activated release %s", release.name)
+
+    def _record_release(self, release: Path):
+        """Move the given release to the end of the history, as the live one"""
+        if release.name in self._stored.releases:
+            self._stored.releases.remove(release.name)
+        self._stored.releases.append(release.name)
+
+    def _prune_releases(self):
+        """Remove all but the most recently activated releases"""
+        while len(self._stored.releases) > max(self.config["releases-to-keep"], 1):
+            self._stored.releases.pop(0)
+
+        if RELEASES_PATH.is_dir():
+            for release in RELEASES_PATH.iterdir():
+                if release.name not in self._stored.releases:
+                    logger.info("removing release %s", release.name)
+                    shutil.rmtree(release)
+        self._prune_virtualenvs()
+
+    def _prune_virtualenvs(self):
+        """Remove the shared virtualenvs no kept release links to"""
+        if not VENVS_PATH.is_dir():
+            return
+        used = {
+            Path(f"{RELEASES_PATH}/{name}/venv").resolve() for name in self._stored.releases
+        }
+        # The live release may predate release directories or still be in the history
+        used.add(VENV_ROOT.resolve())
+        for venv in VENVS_PATH.iterdir():
+            if venv.resolve() not in used:
+                logger.info("removing virtualenv %s", venv.name)
+                shutil.rmtree(venv)
+
+    def _reload_application(self) -> bool:
+        """Gracefully reload gunicorn, waiting until a new set of workers has started
+
+        Gunicorn starts new workers on SIGHUP and only then stops the old ones, so
+        no requests are dropped. If the reload cannot be issued the service is
+        restarted instead.
+        """
+        logger.info("reloading hello-juju application")
+        old_workers = self._worker_pids()
+        if not systemd.service_reload("hello-juju"):
+            logger.warning("could not reload hello-juju, restarting it instead")
+            return systemd.service_restart("hello-juju")
+
+        expected = self._stored.gunicorn.get("workers", 1)
+        deadline = time.monotonic() + RELOAD_TIMEOUT
+        while time.monotonic() < deadline:
+            workers = self._worker_pids()
+            if len(workers) >= expected and workers.isdisjoint(old_workers):
+                logger.info("hello-juju reloaded with %d new workers", len(workers))
+                return True
+            time.sleep(0.5)
+
+        logger.warning("timed out waiting for new hello-juju workers after reload")
+        return False
+
+    def _worker_pids(self) -> set:
+        """Return the pids of the gunicorn master's worker processes"""
+        try:
+            master = PID_PATH.read_text().strip()
+        except OSError:
+            return set()
+
+        workers = set()
+        for stat in PROC_PATH.glob("[0-9]*/stat"):
+            try:
+                # The command name is in parentheses and may contain spaces
+                fields = stat.read_text().rsplit(")", 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            if fields[1] == master:
+                workers.add(int(stat.parent.name))
+        return workers
+
+    def _live_requirements_hash(self) -> str:
+        """Return the requirements hash of the live release's virtualenv, if any"""
+        try:
+            return Path(f"{VENV_ROOT}/.requirements-hash").read_text()
+        except OSError:
+            return ""
+
+    def _extra_packages(self) -> list:
+        """Return the packages installed alongside the application's requirements"""
+        return EXTRA_PACKAGES + WORKER_CLASS_PACKAGES.get(self.config["worker-class"], [])
 
-    def _render_systemd_unit(self):
-        """Render the systemd unit for Gunicorn to a file"""
-        # Open the template systemd unit file
-        with open("templates/hello-juju.service.j2", "r") as t:
-            template = Template(t.read())
+    def _gunicorn_options(self) -> dict:
+        """Return the gunicorn worker settings rendered into the systemd unit"""
+        worker_class = self.config["worker-class"]
+        workers = self.config["workers"]
+        if workers == "auto":
+            # Async workers multiplex connections, so one per CPU is enough;
+            # gunicorn recommends (2 x CPUs) + 1 for sync and threaded workers
+            cpus = available_cpus()
+            workers = cpus if worker_class == "gevent" else 2 * cpus + 1
+        return {
+            "workers": int(workers),
+            "threads": self.config["threads"],
+            "worker_class": worker_class,
+            "keepalive": self.config["keepalive"],
+            "timeout": self.config["timeout"],
+        }
 
+    def _engine_options(self) -> dict:
+        """Return the SQLAlchemy engine options rendered into the application settings"""
+        gunicorn = self._gunicorn_options()
+        pool_size = self.config["db-pool-size"]
+        if pool_size == "auto":
+            # Every worker process has its own pool. Sync and threaded workers handle
+            # one request per thread, so a pool of that size never makes a request
+            # wait and the unit holds at most workers x threads connections
+            if gunicorn["worker_class"] == "gevent":
+                pool_size = GEVENT_POOL_SIZE
+            else:
+                pool_size = gunicorn["threads"]
+        options = {
+            "pool_size": int(pool_size),
+            "max_overflow": self.config["db-max-overflow"],
+            "pool_recycle": self.config["db-pool-recycle"],
+            "pool_pre_ping": self.config["db-pool-pre-ping"],
+        }
+        if self.config["db-statement-timeout"] > 0:
+            # Sent by pg8000 as a run-time parameter when each connection starts
+            options["connect_args"] = {
+                "startup_params": {"statement_timeout": str(self.config["db-statement-timeout"])}
+            }
+        return options
+
+    def _requirements_hash(self, release: Path = APP_PATH) -> str:
+        """Hash the application requirements together with the interpreter ABI"""
+        digest = hashlib.sha256()
+        digest.update(sysconfig.get_config_var("SOABI").encode())
+        digest.update(" ".join(self._extra_packages()).encode())
+        digest.update(Path(f"{release}/requirements.txt").read_bytes())
+        return digest.hexdigest()
+
+    def _install_dependencies(self, release: Path = APP_PATH):
+        """Link the release to a virtualenv with its dependencies, building it if needed
+
+        Virtualenvs are keyed by the requirements hash and shared between releases,
+        so code-only changes reuse the live release's virtualenv as is.
+        """
+        start = time.monotonic()
+        requirements_hash = self._requirements_hash(release)
+        venv = Path(f"{VENVS_PATH}/{sysconfig.get_config_var('SOABI')}-{requirements_hash[:16]}")
+        stamp = Path(f"{venv}/.requirements-hash")
+
+        if stamp.is_file() and stamp.read_text() == requirements_hash:
+            logger.info(
+                "requirements hash %s hit, reusing virtualenv (%.1fs)",
+                requirements_hash[:12],
+                time.monotonic() - start,
+            )
+        else:
+            self._build_virtualenv(release, venv)
+            stamp.write_text(requirements_hash)
+            logger.info(
+                "requirements hash %s miss, installed dependencies in %.1fs",
+                requirements_hash[:12],
+                time.monotonic() - start,
+            )
+        self._link_virtualenv(release, venv)
+
+    def _build_virtualenv(self, release: Path, venv: Path):
+        """Install the release's dependencies into a virtualenv, reusing cached wheels"""
+        if not Path(f"{venv}/bin/python3").exists():
+            check_output(["python3", "-m", "virtualenv", f"{venv}"])
+
+        wheels = self._wheel_cache_path()
+        requirements = ["-r", f"{release}/requirements.txt", *self._extra_packages()]
+        install = [f"{venv}/bin/pip3", "install", "--no-index", "--find-links", f"{wheels}"]
+        wheelhouse = Path(f"{release}/wheelhouse")
+        if wheelhouse.is_dir():
+            # Bundled releases ship every wheel they need, so no index is ever used
+            check_output([*install, "--find-links", f"{wheelhouse}", *requirements])
+        else:
+            try:
+                check_output([*install, *requirements])
+            except CalledProcessError:
+                # Some wheels are missing from the cache, build or download only those
+                logger.info("wheel cache incomplete, fetching missing wheels")
+                check_output(
+                    [
+                        f"{venv}/bin/pip3",
+                        "wheel",
+                        "--wheel-dir",
+                        f"{wheels}",
+                        "--find-links",
+                        f"{wheels}",
+                        *requirements,
+                    ]
+                )
+                check_output([*install, *requirements])
+
+    def _link_virtualenv(self, release: Path, venv: Path):
+        """Atomically point the release's venv directory at a shared virtualenv"""
+        link = Path(f"{release}/venv")
+        if link.is_symlink() and link.resolve() == venv.resolve():
+            return
+        # Releases from before shared virtualenvs have their own in place
+        if link.is_dir() and not link.is_symlink():
+            shutil.rmtree(link)
+
+        tmp = Path(f"{release}/venv.new")
+        if tmp.is_symlink():
+            tmp.unlink()
+        tmp.symlink_to(venv)
+        os.replace(tmp, link)
+
+    def _wheel_cache_path(self) -> Path:
+        """Return the wheel cache for the interpreter ABI, creating it if needed"""
+        # Wheels are only usable by the interpreter ABI they were built for
+        wheels = Path(f"{WHEEL_CACHE_PATH}/{sysconfig.get_config_var('SOABI')}")
+        wheels.mkdir(parents=True, exist_ok=True)
+        return wheels
+
+    def _prefetch_wheels(self, bundle: Optional[Path]):
+        """Populate the wheel cache with the extra packages before a virtualenv exists"""
+        if bundle:
+            logger.info("application bundle attached, its wheelhouse provides the extra packages")
+            return
+        wheels = self._wheel_cache_path()
+        check_output(
+            [
+                "python3",
+                "-m",
+                "pip",
+                "wheel",
+                "--wheel-dir",
+                f"{wheels}",
+                "--find-links",
+                f"{wheels}",
+                *self._extra_packages(),
+            ]
+        )
+
+    def _install_apt_packages(self, packages: list):
+        """Simple wrapper around 'apt-get install -y
+
+        Raises apt.PackageNotFoundError or apt.PackageError, for the caller to set
+        the unit status from the main thread.
+        """
+        apt.update(max_age=APT_UPDATE_MAX_AGE)
+        apt.add_package(packages)
+
+    def _render_systemd_units(self) -> set:
+        """Render the systemd service and socket units for Gunicorn
+
+        Returns the names of the units that changed.
+        """
         # If this is the first time, set the port in the stored state
         if not self._stored.port:
             self._stored.port = self.config["port"]
 
         # Render the template files with the correct values
-        rendered = template.render(
-            port=self._stored.port, project_root=APP_PATH, user="www-data", group="www-data"
+        options = self._gunicorn_options()
+        service = self._template("hello-juju.service.j2").render(
+            project_root=APP_PATH,
+            venv_root=VENV_ROOT,
+            user="www-data",
+            group="www-data",
+            **options,
+        )
+        # With the proxy in front, gunicorn only listens for nginx
+        if self.config["proxy"]:
+            listen = str(GUNICORN_SOCKET_PATH)
+        else:
+            listen = f"0.0.0.0:{self._stored.port}"
+        socket = self._template("hello-juju.socket.j2").render(
+            listen=listen, backlog=self.config["backlog"]
         )
-        # Write the rendered file out to disk
-        with open(UNIT_PATH, "w+") as t:
-            t.write(rendered)
+        self._stored.gunicorn = options
 
-        # Ensure correct permissions are set on the service
-        os.chmod(UNIT_PATH, 0o755)
-        # Reload systemd units
-        systemd.daemon_reload()
+        # Write the rendered files out to disk with the correct permissions
+        changed = set()
+        if self._write_file(UNIT_PATH, service, 0o755):
+            changed.add("hello-juju.service")
+        if self._write_file(SOCKET_PATH, socket, 0o644):
+            changed.add("hello-juju.socket")
+        if changed:
+            # Reload systemd units
+            systemd.daemon_reload()
+        return changed
 
-    def _render_settings_file(self):
-        """Render the application settings file with database connection details"""
-        # Open the template settings files
-        with open("templates/settings.py.j2", "r") as t:
-            template = Template(t.read())
+    def _restart_socket(self):
+        """Restart the socket unit, and with it gunicorn, to listen on a new address
+
+        nginx and the socket take turns on the application port when the proxy is
+        switched on or off.
+        """
+        # systemd refuses to restart a socket while the service it activated runs
+        systemd.service_stop("hello-juju")
+        if self._stored.proxy and not self.config["proxy"]:
+            logger.info("stopping nginx")
+            systemd.service_pause("nginx")
+            self._stored.proxy = False
+        systemd.service_restart("hello-juju.socket")
+        systemd.service_start("hello-juju")
+        if self.config["proxy"] and not self._stored.proxy:
+            logger.info("starting nginx")
+            systemd.service_resume("nginx")
+            self._stored.proxy = True
+
+    def _install_nginx(self):
+        """Install nginx without letting the package start it with its default site"""
+        self.unit.status = MaintenanceStatus("installing nginx")
+        # The default site would take port 80, which the application may be using
+        policy = not POLICY_RC_PATH.exists()
+        if policy:
+            self._write_file(POLICY_RC_PATH, "#!/bin/sh\nexit 101\n", 0o755)
+        try:
+            self._install_apt_packages(["nginx"])
+        except (apt.PackageNotFoundError, apt.PackageError) as e:
+            logger.error("could not install nginx: %s", e)
+            self.unit.status = BlockedStatus("Failed to install packages")
+        finally:
+            if policy:
+                POLICY_RC_PATH.unlink()
+        default = Path(f"{NGINX_PATH}/sites-enabled/default")
+        if default.is_symlink() or default.exists():
+            default.unlink()
+
+    def _render_proxy_config(self) -> bool:
+        """Render the nginx site proxying to gunicorn, or remove it without the proxy
+
+        Returns whether the site changed.
+        """
+        if not self.config["proxy"]:
+            try:
+                NGINX_SITE_PATH.unlink()
+            except FileNotFoundError:
+                return False
+            return True
+
+        rendered = self._template("nginx.conf.j2").render(
+            port=self.config["port"],
+            socket_path=GUNICORN_SOCKET_PATH,
+            cache_path=NGINX_CACHE_PATH,
+            cache_size=self.config["proxy-cache-size"],
+            cache_ttl=self.config["proxy-cache-ttl"],
+        )
+        return self._write_file(NGINX_SITE_PATH, rendered, 0o644)
+
+    def _request_restart(self, kind: str) -> bool:
+        """Restart the application once the leader hands this unit a restart slot
+
+        `kind` is "service" to restart gunicorn, or "socket" to restart the
+        listening socket along with it. Units ask for a slot by bumping the
+        restart-request counter in their peer data; the leader grants at most
+        max-concurrent-restarts of them at once in the app data, and a slot is
+        freed when its unit copies the counter to restart-done after passing a
+        health check. Returns whether the restart has already happened.
+        """
+        # A socket restart also restarts the service, so it supersedes a pending one
+        if self._stored.restart != "socket":
+            self._stored.restart = kind
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers:
+            # Nothing to coordinate with, restart straight away
+            self._restart()
+            return True
+
+        data = peers.data[self.unit]
+        request = data.get("restart-request", "0")
+        # A request still waiting for its slot covers this restart as well
+        if request == data.get("restart-done", "0"):
+            data["restart-request"] = str(int(request) + 1)
+        logger.info("waiting for a restart slot")
+        self.unit.status = WaitingStatus("waiting for a restart slot")
+        self._grant_restarts()
+        return self._check_restart_grant()
+
+    def _grant_restarts(self):
+        """Free the restart slots of finished units and grant them to waiting ones"""
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers or not self.unit.is_leader():
+            return
+
+        units = {unit.name: peers.data[unit] for unit in {self.unit, *peers.units}}
+        current = peers.data[self.app].get("restart-grants", "{}")
+        # Units that passed their health check, or left, no longer hold a slot
+        grants = {
+            name: request
+            for name, request in json.loads(current).items()
+            if name in units and units[name].get("restart-done", "0") != request
+        }
+        waiting = sorted(
+            name
+            for name, data in units.items()
+            if name not in grants
+            and data.get("restart-request", "0") != data.get("restart-done", "0")
+        )
+        free = max(max(self.config["max-concurrent-restarts"], 1) - len(grants), 0)
+        for name in waiting[:free]:
+            logger.info("granting a restart slot to %s", name)
+            grants[name] = units[name]["restart-request"]
+
+        grants = json.dumps(grants, sort_keys=True)
+        if grants != current:
+            peers.data[self.app]["restart-grants"] = grants
+
+    def _check_restart_grant(self) -> bool:
+        """Restart if this unit was granted a slot, and free it once the unit is healthy
+
+        Returns whether this unit has no restart left to do.
+        """
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers:
+            return True
+        data = peers.data[self.unit]
+        request = data.get("restart-request", "0")
+        if request == data.get("restart-done", "0"):
+            return True
+        grants = json.loads(peers.data[self.app].get("restart-grants", "{}"))
+        if grants.get(self.unit.name) != request:
+            return False
+
+        # A unit that failed its health check has already restarted, it only
+        # checks again until the application recovers
+        if self._stored.restart:
+            self._restart()
+        if not self._healthy():
+            self.unit.status = BlockedStatus("application unhealthy after restart")
+            return False
+        logger.info("application healthy after restart, freeing the restart slot")
+        data["restart-done"] = request
+        self.unit.status = ActiveStatus()
+        # The leader does not see its own peer data change
+        self._grant_restarts()
+        return True
+
+    def _restart(self):
+        """Carry out the pending restart of the application"""
+        if self._stored.restart == "socket":
+            logger.info("restarting hello-juju socket and application")
+            self._restart_socket()
+        else:
+            logger.info("restarting hello-juju application")
+            systemd.service_restart("hello-juju")
+        self._stored.restart = ""
+
+    def _healthy(self) -> bool:
+        """Wait until the application on this unit serves a request successfully
+
+        Behind the proxy gunicorn is asked directly on its socket, as nginx may
+        answer from its cache whether gunicorn works or not.
+        """
+        if self._stored.proxy:
+            address = str(GUNICORN_SOCKET_PATH)
+            connect = functools.partial(UnixHTTPConnection, address)
+        else:
+            address = f"127.0.0.1:{self._stored.port}"
+            connect = functools.partial(HTTPConnection, "127.0.0.1", self._stored.port)
+        deadline = time.monotonic() + HEALTH_CHECK_TIMEOUT
+        while True:
+            connection = connect(timeout=5)
+            try:
+                connection.request("GET", HEALTH_CHECK_PATH)
+                status = connection.getresponse().status
+                if status < 400:
+                    return True
+                error = f"HTTP status {status}"
+            except (OSError, HTTPException) as e:
+                error = e
+            finally:
+                connection.close()
+            if time.monotonic() >= deadline:
+                logger.warning("health check of %s failed: %s", address, error)
+                return False
+            time.sleep(0.5)
+
+    def _render_settings_file(self, release: Path = APP_PATH) -> bool:
+        """Render the application settings file with database connection details
+
+        Returns whether the file on disk changed.
+        """
+        # Load the template settings files
+        template = self._template("settings.py.j2")
 
         # Render the template file with the correct values
-        rendered = template.render(conn_str=self._stored.conn_str)
+        rendered = template.render(
+            conn_str=self._stored.conn_str,
+            standbys=list(self._stored.standbys),
+            engine_options=self._engine_options(),
+        )
 
-        # Write the rendered file out to disk
-        with open(f"{APP_PATH}/settings.py", "w+") as t:
-            t.write(rendered)
-        # Ensure correct permissions are set on the file
-        os.chmod(f"{APP_PATH}/settings.py", 0o644)
         # Get the uid/gid for the www-data user
         u = passwd.user_exists("www-data")
-        # Set the correct ownership for the settings file
-        os.chown(f"{APP_PATH}/settings.py", uid=u.pw_uid, gid=u.pw_gid)
-
-    def _create_database_tables(self):
-        """Initialise the database and populate with initial tables required"""
-        self.unit.status = MaintenanceStatus("creating database tables")
-        # Call the application's `init.py` file to instantiate the database tables
-        check_call(["sudo", "-u", "www-data", f"{VENV_ROOT}/bin/python3", f"{APP_PATH}/init.py"])
+        # Write the rendered file out to disk with the correct permissions and ownership
+        return self._write_file(
+            Path(f"{release}/settings.py"), rendered, 0o644, uid=u.pw_uid, gid=u.pw_gid
+        )
+
+    def _template(self, name: str):
+        """Load a template from the charm's templates directory"""
+        return template_environment(str(self.charm_dir / "templates")).get_template(name)
+
+    def _write_file(
+        self, path: Path, content: str, mode: int, uid: int = None, gid: int = None
+    ) -> bool:
+        """Atomically replace a file unless it already has the given content
+
+        Returns whether the file was written.
+        """
+        digest = hashlib.sha256(content.encode()).digest()
+        try:
+            if hashlib.sha256(path.read_bytes()).digest() == digest:
+                return False
+        except OSError:
+            pass
+
+        # Write next to the target and rename over it, so readers never see a
+        # partially written file
+        tmp = Path(f"{path.parent}/.{path.name}.tmp")
+        with open(tmp, "w") as t:
+            t.write(content)
+        os.chmod(tmp, mode)
+        if uid is not None:
+            os.chown(tmp, uid=uid, gid=gid)
+        os.replace(tmp, path)
+        return True
+
+    def _create_database_tables(self, release: Path, leader: bool, published: str):
+        """Initialise the database and populate with initial tables required
+
+        The database is only initialised when the schema code or the database differ
+        from the last initialisation. Without a database relation every unit has its
+        own local database; a related database is shared, so only the leader
+        initialises it.
+
+        This runs as a pipeline step, so leadership and the fingerprint published by
+        the leader are passed in. Returns the fingerprint of the schema now in the
+        database, for `_record_schema`, or None when it is left to the leader.
+        """
+        shared = bool(self._stored.conn_str)
+        if shared and not leader:
+            logger.info("leaving database initialisation to the leader")
+            return None
+
+        fingerprint = self._schema_fingerprint(release)
+        known = {self._stored.schema}
+        if shared:
+            known.add(published)
+        if fingerprint in known:
+            logger.info("schema fingerprint %s unchanged, skipping init.py", fingerprint[:12])
+        else:
+            # Call the application's `init.py` file to instantiate the database tables
+            check_call(
+                ["sudo", "-u", "www-data", f"{release}/venv/bin/python3", f"{release}/init.py"]
+            )
+        return fingerprint
+
+    def _record_schema(self, fingerprint: Optional[str]):
+        """Remember the schema in the database, publishing it to the peers if shared"""
+        if fingerprint is None:
+            return
+        self._stored.schema = fingerprint
+        if self._stored.conn_str:
+            self._publish_schema(fingerprint)
+
+    def _schema_fingerprint(self, release: Path = APP_PATH) -> str:
+        """Hash the application's schema code together with the target database
+
+        Without a database relation the application keeps its database inside the
+        release, so every release has its own database to initialise.
+        """
+        digest = hashlib.sha256()
+        digest.update((self._stored.conn_str or str(Path(release).resolve())).encode())
+        migrations = Path(f"{release}/migrations")
+        files = sorted(migrations.rglob("*")) if migrations.is_dir() else []
+        for path in [Path(f"{release}/init.py"), *files]:
+            if path.is_file():
+                digest.update(str(path.relative_to(release)).encode())
+                digest.update(path.read_bytes())
+        return digest.hexdigest()
+
+    def _published_schema(self) -> str:
+        """Return the schema fingerprint last initialised by the leader, if any"""
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers:
+            return ""
+        return peers.data[self.app].get("schema-fingerprint", "")
+
+    def _published_database(self) -> str:
+        """Return a digest of the database last initialised by the leader, if any"""
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers:
+            return ""
+        return peers.data[self.app].get("schema-database", "")
+
+    def _publish_schema(self, fingerprint: str):
+        """Tell the other units which schema and database the leader initialised"""
+        peers = self.model.get_relation(PEER_RELATION)
+        if not peers:
+            return
+        database = hashlib.sha256(self._stored.conn_str.encode()).hexdigest()
+        # Each write is a relation-set, so values the peers already have are skipped
+        data = peers.data[self.app]
+        for key, value in (("schema-fingerprint", fingerprint), ("schema-database", database)):
+            if data.get(key) != value:
+                data[key] = value
 
 
 if __name__ == "__main__":  # pragma: no cover
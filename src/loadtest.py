@@ -0,0 +1,161 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Generate HTTP load against a local listener.
+
+A fixed number of asyncio workers issue GET requests back to back over
+keep-alive connections for a given duration, recording the latency of every
+request. The listener is reached over TCP, or over a unix socket when one is
+given. Only the standard library is used, so the load test can run on any
+unit without installing a separate tool.
+"""
+
+import asyncio
+import functools
+import math
+import time
+from typing import List, Optional, Tuple
+
+# Seconds to wait for a single response before counting it as an error
+REQUEST_TIMEOUT = 10
+
+
+class Result:
+    """Latencies and error counts collected during a load test"""
+
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.latencies = []
+        self.errors = 0
+
+    @property
+    def requests(self) -> int:
+        """Number of requests completed, successfully or not"""
+        return len(self.latencies) + self.errors
+
+    @property
+    def throughput(self) -> float:
+        """Successful requests per second"""
+        return len(self.latencies) / self.duration if self.duration else 0.0
+
+    @property
+    def error_rate(self) -> float:
+        """Fraction of requests that failed"""
+        return self.errors / self.requests if self.requests else 0.0
+
+    def percentile(self, p: float) -> float:
+        """Latency in seconds below which `p` percent of successful requests completed"""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+
+def run(
+    host: str,
+    port: int,
+    duration: float,
+    concurrency: int,
+    path: str = "/",
+    unix_socket: Optional[str] = None,
+) -> Result:
+    """Load the listener at `host`:`port` for `duration` seconds with `concurrency` workers
+
+    With `unix_socket`, connections are made to that socket instead, and `host`
+    and `port` only name the server in the requests.
+    """
+    return asyncio.run(_run(host, port, duration, concurrency, path, unix_socket))
+
+
+async def _run(
+    host: str,
+    port: int,
+    duration: float,
+    concurrency: int,
+    path: str,
+    unix_socket: Optional[str],
+) -> Result:
+    start = time.monotonic()
+    deadline = start + duration
+    worker_results = await asyncio.gather(
+        *(_worker(host, port, path, deadline, unix_socket) for _ in range(concurrency))
+    )
+    result = Result(time.monotonic() - start)
+    for latencies, errors in worker_results:
+        result.latencies.extend(latencies)
+        result.errors += errors
+    return result
+
+
+async def _worker(
+    host: str, port: int, path: str, deadline: float, unix_socket: Optional[str]
+) -> Tuple[List[float], int]:
+    """Issue requests until the deadline, reconnecting whenever a connection is closed"""
+    request = (
+        f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+        "User-Agent: hello-juju-load-test\r\nAccept: */*\r\n\r\n"
+    ).encode()
+    if unix_socket:
+        connect = functools.partial(asyncio.open_unix_connection, unix_socket)
+    else:
+        connect = functools.partial(asyncio.open_connection, host, port)
+    latencies = []
+    errors = 0
+    reader = writer = None
+
+    while time.monotonic() < deadline:
+        begin = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(connect(), REQUEST_TIMEOUT)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(_read_response(reader), REQUEST_TIMEOUT)
+        except (
+            OSError,
+            ValueError,
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+        ):
+            status, keep_alive = None, False
+
+        if status is not None and status < 400:
+            latencies.append(time.monotonic() - begin)
+        else:
+            errors += 1
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+
+    if writer is not None:
+        writer.close()
+    return latencies, errors
+
+
+async def _read_response(reader: asyncio.StreamReader) -> Tuple[int, bool]:
+    """Read one HTTP/1.x response, returning its status and whether the connection stays open"""
+    status_line = await reader.readuntil(b"\r\n")
+    version, status = status_line.decode("latin-1").split(None, 2)[:2]
+    headers = {}
+    while True:
+        line = await reader.readuntil(b"\r\n")
+        if line == b"\r\n":
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = headers.get("connection", "") != "close" and version == "HTTP/1.1"
+    if "chunked" in headers.get("transfer-encoding", ""):
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    else:
+        # Without a length the body ends when the server closes the connection
+        await reader.read()
+        keep_alive = False
+    return int(status), keep_alive
@@ -0,0 +1,105 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Run dependent setup steps concurrently.
+
+Steps are plain callables registered with the names of the steps that must
+finish before they start. Independent steps run side by side in a thread
+pool, and the wall time of every step is recorded so the critical path of a
+hook can be read from the unit log.
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """A dependency graph of named steps executed in a thread pool"""
+
+    def __init__(self, name: str, max_workers: int = 4):
+        self.name = name
+        self.max_workers = max_workers
+        self.results = {}
+        self.timings = {}
+        self._steps = {}
+        self._after = {}
+
+    def add(self, name: str, func: Callable, after: Iterable[str] = ()):
+        """Register a step that starts once all steps in `after` have finished"""
+        if name in self._steps:
+            raise ValueError(f"step '{name}' is already defined")
+        self._steps[name] = func
+        self._after[name] = list(after)
+
+    def run(self) -> Dict[str, float]:
+        """Run every step, returning the wall time in seconds taken by each one
+
+        The first exception raised by a step is re-raised once the steps
+        already running have finished; steps that have not started are skipped.
+        """
+        for name, after in self._after.items():
+            unknown = [a for a in after if a not in self._steps]
+            if unknown:
+                raise ValueError(f"step '{name}' depends on unknown steps {unknown}")
+
+        start = time.monotonic()
+        pending = dict(self._after)
+        running = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [n for n, a in pending.items() if all(d in self.timings for d in a)]
+                    for name in ready:
+                        del pending[name]
+                        running[executor.submit(self._run_step, name, start)] = name
+                if not running:
+                    if pending and error is None:
+                        raise ValueError(f"dependency cycle between steps {sorted(pending)}")
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    if future.exception() is not None and error is None:
+                        error = future.exception()
+
+        if error is not None:
+            raise error
+
+        logger.info(
+            "%s critical path: %s (%.2fs)",
+            self.name,
+            " -> ".join(self.critical_path()),
+            time.monotonic() - start,
+        )
+        return {name: end - begin for name, (begin, end) in self.timings.items()}
+
+    def critical_path(self) -> List[str]:
+        """The chain of steps, ending with the last to finish, that determined the total time"""
+        if not self.timings:
+            return []
+        step = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [step]
+        while self._after[step]:
+            step = max(self._after[step], key=lambda n: self.timings[n][1])
+            path.append(step)
+        return list(reversed(path))
+
+    def _run_step(self, name: str, start: float):
+        """Run a single step and record when it started and finished"""
+        begin = time.monotonic() - start
+        with tracing.phase(f"{self.name}:{name}"):
+            self.results[name] = self._steps[name]()
+        end = time.monotonic() - start
+        logger.info(
+            "%s step %s took %.2fs (started at +%.2fs)", self.name, name, end - begin, begin
+        )
+        self.timings[name] = (begin, end)
@@ -0,0 +1,169 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+"""Trace the external commands run during a hook.
+
+Once enabled, every process started through `subprocess.Popen` is recorded
+with its start time, duration, exit code and the phase of the hook that
+started it. This covers the charm itself as well as the operator_libs_linux
+libraries and GitPython, which all create their processes through `Popen`.
+Spans are written out as Chrome trace JSON, which can be opened in
+chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+_spans = []
+_originals = {}
+_hook = ""
+_hook_start = 0.0
+
+
+def enable(hook: str) -> None:
+    """Start recording the processes spawned by this hook"""
+    global _hook, _hook_start
+    _hook = hook
+    _hook_start = time.time()
+    if _originals:
+        return
+    _originals.update(
+        __init__=subprocess.Popen.__init__,
+        wait=subprocess.Popen.wait,
+        poll=subprocess.Popen.poll,
+    )
+    # Patching the class, rather than the name in the subprocess module, also
+    # covers modules that imported Popen directly
+    subprocess.Popen.__init__ = _traced_init
+    subprocess.Popen.wait = _traced_wait
+    subprocess.Popen.poll = _traced_poll
+
+
+def disable() -> None:
+    """Stop recording and discard any spans that have not been written"""
+    for name, func in _originals.items():
+        setattr(subprocess.Popen, name, func)
+    _originals.clear()
+    with _lock:
+        _spans.clear()
+
+
+def enabled() -> bool:
+    """Whether processes are currently being recorded"""
+    return bool(_originals)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Attribute the processes started by this thread within the block to a phase"""
+    stack = _local.__dict__.setdefault("phases", [])
+    stack.append(name)
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+def current_phase() -> str:
+    """The hook and the nested phases of this thread, separated by slashes"""
+    return "/".join([_hook, *getattr(_local, "phases", [])])
+
+
+def spans() -> List[dict]:
+    """The spans recorded so far, in the Chrome trace event format"""
+    with _lock:
+        return list(_spans)
+
+
+def write(directory: Path, keep: int = 100) -> Path:
+    """Write the recorded spans to a new trace file, keeping the `keep` most recent files
+
+    The hook itself is added as a span enclosing the processes it started.
+    """
+    hook = {
+        "name": _hook,
+        "cat": "hook",
+        "ph": "X",
+        "ts": int(_hook_start * 1e6),
+        "dur": int((time.time() - _hook_start) * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.main_thread().ident,
+        "args": {},
+    }
+    directory.mkdir(parents=True, exist_ok=True)
+    path = Path(f"{directory}/{int(_hook_start * 1000)}-{_hook.replace('/', '-')}.json")
+    path.write_text(json.dumps({"traceEvents": [hook, *spans()]}))
+    for old in sorted(directory.glob("*.json"))[:-keep]:
+        old.unlink()
+    return path
+
+
+def slowest(directory: Path, limit: int = 10) -> List[dict]:
+    """Return the slowest process spans across all trace files in a directory"""
+    events = []
+    for path in sorted(directory.glob("*.json")):
+        try:
+            trace = json.loads(path.read_text())
+        except (OSError, ValueError):
+            logger.warning("skipping unreadable trace %s", path)
+            continue
+        events.extend(e for e in trace.get("traceEvents", []) if e.get("cat") == "process")
+    return sorted(events, key=lambda e: e["dur"], reverse=True)[:limit]
+
+
+def _traced_init(self, args, *a, **kw):
+    argv = [args] if isinstance(args, (str, bytes, os.PathLike)) else list(args)
+    argv = [os.fsdecode(arg) for arg in argv]
+    self._trace = {
+        "name": os.path.basename(argv[0]) if argv else "",
+        "cat": "process",
+        "ph": "X",
+        "ts": int(time.time() * 1e6),
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": {"command": argv, "phase": current_phase()},
+        "start": time.perf_counter(),
+    }
+    try:
+        _originals["__init__"](self, args, *a, **kw)
+    except OSError as e:
+        # The command never ran, for example because it doesn't exist
+        self._trace["args"]["error"] = str(e)
+        _finish(self._trace, None)
+        raise
+
+
+def _traced_wait(self, *a, **kw):
+    try:
+        return _originals["wait"](self, *a, **kw)
+    finally:
+        _finish(getattr(self, "_trace", None), self.returncode)
+
+
+def _traced_poll(self):
+    returncode = _originals["poll"](self)
+    _finish(getattr(self, "_trace", None), returncode)
+    return returncode
+
+
+def _finish(span: dict, returncode: int) -> None:
+    """Record a span once its process has exited"""
+    if span is None or "start" not in span:
+        return
+    if returncode is None and "error" not in span["args"]:
+        return
+    span["dur"] = int((time.perf_counter() - span.pop("start")) * 1e6)
+    span["args"]["returncode"] = returncode
+    with _lock:
+        _spans.append(span)
@@ -0,0 +1,397 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import call, patch
+
+from charms.operator_libs_linux.v0 import apt
+from charms.operator_libs_linux.v0.apt import DebianPackage, PackageState
+
+
+STATUS = """\
+Package: nginx
+Status: install ok installed
+Architecture: amd64
+Version: 1.18.0-6ubuntu14
+Description: small, powerful, scalable web/proxy server
+ Nginx ("engine X") is a high-performance web and reverse proxy server.
+ Architecture: i386
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.35-0ubuntu3
+
+Package: git
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 1:2.34.1-1ubuntu1
+
+Package: tzdata
+Status: hold ok installed
+Architecture: all
+Version: 2024a-0ubuntu0.22.04
+"""
+
+
+PACKAGES = """\
+Package: nginx
+Architecture: amd64
+Version: 1.18.0-6ubuntu14
+Description: small, powerful, scalable web/proxy server
+ Version: 0.1
+
+Package: nginx
+Architecture: amd64
+Version: 1.18.0-6ubuntu14.4
+
+Package: nginx
+Architecture: i386
+Version: 1.20.0-1
+
+Package: python3-pip
+Architecture: all
+Version: 22.0.2+dfsg-1ubuntu0.4
+"""
+LIST = "archive.ubuntu.com_ubuntu_dists_jammy"
+
+
+def package(name, state=PackageState.Available, arch="all"):
+    return DebianPackage(name, "1.0-1", "", arch, state)
+
+
+def dpkg(args, **kwargs):
+    """A stand-in for `dpkg` on an amd64 system with i386 enabled"""
+    return {"--print-architecture": "amd64\n", "--print-foreign-architectures": "i386\n"}[args[1]]
+
+
+class TestApt(unittest.TestCase):
+    def setUp(self):
+        self.known = {}
+
+        def from_system(name, version="", arch=""):
+            if name not in self.known:
+                raise apt.PackageNotFoundError(name)
+            return self.known[name]
+
+        patcher = patch.object(DebianPackage, "from_system", side_effect=from_system)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(DebianPackage, "from_installed_package", side_effect=from_system)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(apt, "check_output", side_effect=dpkg)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        apt.clear_caches()
+        self.addCleanup(apt.clear_caches)
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_add_package_single_transaction(self, _call):
+        self.known = {
+            "nginx": package("nginx"),
+            "git": package("git", PackageState.Present),
+            "python3-venv": package("python3-venv"),
+        }
+        pkgs = apt.add_package(["nginx", "git", "python3-venv"])
+        self.assertEqual([p.name for p in pkgs], ["nginx", "git", "python3-venv"])
+        self.assertTrue(all(p.present for p in pkgs))
+        # Only the missing packages are installed, all in one apt-get call
+        _call.assert_called_once_with(
+            [
+                "apt-get",
+                "-y",
+                "--option=Dpkg::Options::=--force-confold",
+                "install",
+                "nginx=1.0-1",
+                "python3-venv=1.0-1",
+            ],
+            stderr=-1,
+            stdout=-1,
+        )
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_add_package_foreign_architecture(self, _call):
+        self.known = {"libc6:i386": package("libc6", arch="i386"), "nginx": package("nginx")}
+        apt.add_package(["libc6:i386", "nginx"])
+        # apt-get is told the architecture of packages which are not native
+        self.assertEqual(_call.call_args.args[0][-2:], ["libc6:i386=1.0-1", "nginx=1.0-1"])
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_add_package_retries_after_update(self, _call):
+        self.known = {"nginx": package("nginx")}
+
+        def update():
+            self.known["git"] = package("git")
+
+        with patch("charms.operator_libs_linux.v0.apt.update", side_effect=update) as _update:
+            pkgs = apt.add_package(["nginx", "git"])
+        _update.assert_called_once_with()
+        self.assertEqual([p.name for p in pkgs], ["nginx", "git"])
+        self.assertEqual(
+            [c.args[0][-1] for c in _call.call_args_list], ["nginx=1.0-1", "git=1.0-1"]
+        )
+
+        # Names still missing after the refresh are reported together
+        with patch("charms.operator_libs_linux.v0.apt.update"):
+            with self.assertRaises(apt.PackageError) as e:
+                apt.add_package(["nginx", "missing", "absent"])
+        self.assertIn("missing, absent", e.exception.message)
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_remove_package_single_transaction(self, _call):
+        self.known = {
+            "nginx": package("nginx", PackageState.Present),
+            "git": package("git", PackageState.Present),
+        }
+        pkgs = apt.remove_package(["nginx", "missing", "git"])
+        self.assertEqual([p.name for p in pkgs], ["nginx", "git"])
+        self.assertFalse(any(p.present for p in pkgs))
+        self.assertEqual(
+            _call.call_args_list,
+            [
+                call(
+                    ["apt-get", "-y", "remove", "nginx=1.0-1", "git=1.0-1"],
+                    stderr=-1,
+                    stdout=-1,
+                )
+            ],
+        )
+
+
+class TestDpkgStatus(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.status = Path(tmp.name) / "status"
+        self.status.write_text(STATUS)
+        for patcher in (
+            patch.object(apt, "DPKG_STATUS_PATH", str(self.status)),
+            patch.object(apt, "check_output", side_effect=dpkg),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        apt.clear_caches()
+        self.addCleanup(apt.clear_caches)
+
+    def test_from_installed_package(self):
+        pkg = DebianPackage.from_installed_package("nginx")
+        self.assertEqual(pkg.fullversion, "1.18.0-6ubuntu14.amd64")
+        self.assertTrue(pkg.present)
+        # Packages for all architectures match any architecture
+        self.assertEqual(DebianPackage.from_installed_package("tzdata").arch, "all")
+        # Foreign architectures are only found when asked for
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_installed_package("libc6")
+        self.assertEqual(DebianPackage.from_installed_package("libc6:i386").arch, "i386")
+        self.assertEqual(DebianPackage.from_installed_package("libc6", arch="i386").arch, "i386")
+        # A removed package whose configuration files remain is not installed
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_installed_package("git")
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_installed_package("nginx", version="1.20.0-1")
+
+    def test_architectures_asked_once(self):
+        for name in ("nginx", "tzdata", "libc6:i386"):
+            DebianPackage.from_installed_package(name)
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_installed_package("libc6:armhf")
+        self.assertEqual(
+            [c.args[0] for c in apt.check_output.call_args_list],
+            [["dpkg", "--print-architecture"], ["dpkg", "--print-foreign-architectures"]],
+        )
+
+        # Until the caches are cleared, as after `dpkg --add-architecture`
+        apt.clear_caches()
+        DebianPackage.from_installed_package("nginx")
+        self.assertEqual(apt.check_output.call_count, 3)
+
+    def test_installed_packages(self):
+        self.assertEqual(
+            sorted((p.name, p.arch, str(p.version)) for p in apt.installed_packages()),
+            [
+                ("libc6", "i386", "2.35-0ubuntu3"),
+                ("nginx", "amd64", "1.18.0-6ubuntu14"),
+                ("tzdata", "all", "2024a-0ubuntu0.22.04"),
+            ],
+        )
+
+    def test_index_follows_changes(self):
+        with patch("builtins.open", wraps=open) as _open:
+            apt.installed_packages()
+            DebianPackage.from_installed_package("nginx")
+            # The status file is only read once while it is unchanged
+            self.assertEqual(_open.call_count, 1)
+
+        # dpkg replaces the status file when it installs a package
+        replacement = self.status.with_name("status-new")
+        replacement.write_text(
+            STATUS + "\nPackage: git\nStatus: install ok installed\n"
+            "Architecture: amd64\nVersion: 1:2.34.1-1ubuntu1\n"
+        )
+        os.replace(replacement, self.status)
+        pkg = DebianPackage.from_installed_package("git")
+        self.assertEqual(str(pkg.version), "1:2.34.1-1ubuntu1")
+
+        self.status.unlink()
+        self.assertEqual(apt.installed_packages(), [])
+
+
+class TestAptLists(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.lists = Path(tmp.name) / "lists"
+        self.lists.mkdir()
+        (self.lists / f"{LIST}_main_binary-amd64_Packages").write_text(PACKAGES)
+        (self.lists / f"{LIST}_InRelease").write_text("")
+        self.index = Path(tmp.name) / "index.json"
+        for patcher in (
+            patch.object(apt, "APT_LISTS_PATH", str(self.lists)),
+            patch.object(apt, "APT_INDEX_PATH", str(self.index)),
+            patch.object(apt, "check_output", side_effect=dpkg),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        apt.clear_caches()
+        self.addCleanup(apt.clear_caches)
+
+    def test_from_apt_cache(self):
+        # The newest version for the architecture is the candidate
+        pkg = DebianPackage.from_apt_cache("nginx")
+        self.assertEqual(pkg.fullversion, "1.18.0-6ubuntu14.4.amd64")
+        self.assertEqual(pkg.state, PackageState.Available)
+        pkg = DebianPackage.from_apt_cache("nginx", version="1.18.0-6ubuntu14")
+        self.assertEqual(pkg.fullversion, "1.18.0-6ubuntu14.amd64")
+        self.assertEqual(DebianPackage.from_apt_cache("nginx:i386").arch, "i386")
+        self.assertEqual(DebianPackage.from_apt_cache("python3-pip").arch, "all")
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_apt_cache("nginx", version="0.1")
+        with self.assertRaises(apt.PackageNotFoundError):
+            DebianPackage.from_apt_cache("missing")
+        # No apt-cache processes were needed
+        self.assertEqual({c.args[0][0] for c in apt.check_output.call_args_list}, {"dpkg"})
+
+    def test_candidate_packages(self):
+        packages = apt.candidate_packages(["nginx", "python3-pip", "missing"])
+        self.assertEqual(
+            {name: str(p.version) for name, p in packages.items()},
+            {"nginx": "1.18.0-6ubuntu14.4", "python3-pip": "22.0.2+dfsg-1ubuntu0.4"},
+        )
+        self.assertEqual(apt.candidate_packages("nginx", arch="i386")["nginx"].arch, "i386")
+
+    def test_index_saved_and_rebuilt(self):
+        apt.candidate_packages("nginx")
+        self.assertTrue(self.index.exists())
+
+        # A new process loads the saved index instead of scanning the lists
+        apt.clear_caches()
+        with patch.object(apt._AptLists, "_build") as _build:
+            apt.candidate_packages("nginx")
+        _build.assert_not_called()
+
+        # An update of the lists rebuilds the index
+        (self.lists / f"{LIST}_universe_binary-amd64_Packages").write_text(
+            "Package: gunicorn\nArchitecture: all\nVersion: 20.1.0-2\n"
+        )
+        self.assertIn("gunicorn", apt.candidate_packages(["gunicorn"]))
+        apt.clear_caches()
+        with patch.object(apt._AptLists, "_build") as _build:
+            self.assertIn("gunicorn", apt.candidate_packages(["gunicorn"]))
+        _build.assert_not_called()
+
+    def test_compressed_lists_fall_back_to_apt_cache(self):
+        path = self.lists / f"{LIST}_main_binary-amd64_Packages"
+        path.rename(path.with_name(path.name + ".lz4"))
+
+        def check_output(args, **kwargs):
+            if args[0] == "dpkg":
+                return dpkg(args)
+            if args[2] != "nginx":
+                raise apt.CalledProcessError(100, args)
+            return PACKAGES.split("\n\n")[1]
+
+        apt.check_output.side_effect = check_output
+        pkg = DebianPackage.from_apt_cache("nginx")
+        self.assertEqual(pkg.fullversion, "1.18.0-6ubuntu14.4.amd64")
+        self.assertEqual(list(apt.candidate_packages(["nginx", "missing"])), ["nginx"])
+
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.stamp = self.root / "periodic/update-success-stamp"
+        (self.root / "lists").mkdir()
+        (self.root / "lists" / f"{LIST}_main_binary-amd64_Packages").write_text(PACKAGES)
+        (self.root / "sources.list.d").mkdir()
+        (self.root / "sources.list").write_text("deb http://archive.ubuntu.com/ubuntu jammy\n")
+        for patcher in (
+            patch.object(apt, "APT_LISTS_PATH", str(self.root / "lists")),
+            patch.object(apt, "APT_UPDATE_STAMP_PATH", str(self.stamp)),
+            patch.object(
+                apt,
+                "APT_SOURCES_PATHS",
+                (str(self.root / "sources.list"), str(self.root / "sources.list.d")),
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # Everything was configured an hour ago
+        for path in self.root.glob("**/*"):
+            os.utime(path, (time.time() - 3600,) * 2)
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_update(self, _call):
+        # Without a maximum age the lists are always updated, and the update recorded
+        self.assertTrue(apt.update())
+        _call.assert_called_once_with(["apt-get", "update"], stderr=-1, stdout=-1)
+        self.assertTrue(self.stamp.exists())
+        self.assertTrue(apt.update())
+        self.assertEqual(_call.call_count, 2)
+
+        # Recently updated lists are left alone
+        _call.reset_mock()
+        self.assertFalse(apt.update(max_age=60))
+        _call.assert_not_called()
+
+        # Unless they are too old
+        os.utime(self.stamp, (time.time() - 120,) * 2)
+        self.assertTrue(apt.update(max_age=60))
+        self.assertEqual(_call.call_count, 1)
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_update_after_source_changes(self, _call):
+        apt.update()
+        _call.reset_mock()
+        self.assertFalse(apt.update(max_age=60))
+
+        # A new repository is added
+        time.sleep(0.01)
+        (self.root / "sources.list.d/nginx.list").write_text("deb http://nginx.org jammy nginx\n")
+        self.assertTrue(apt.update(max_age=60))
+        self.assertFalse(apt.update(max_age=60))
+
+        # A repository is removed
+        time.sleep(0.01)
+        (self.root / "sources.list.d/nginx.list").unlink()
+        self.assertTrue(apt.update(max_age=60))
+
+        # The lists are missing, as in a freshly built image
+        for path in (self.root / "lists").iterdir():
+            path.unlink()
+        self.assertTrue(apt.update(max_age=60))
+        self.assertEqual(_call.call_count, 3)
+
+    @patch("charms.operator_libs_linux.v0.apt.check_call")
+    def test_update_failure(self, _call):
+        _call.side_effect = apt.CalledProcessError(100, ["apt-get", "update"])
+        with self.assertRaises(apt.CalledProcessError):
+            apt.update(max_age=60)
+        # A failed update does not make the lists fresh
+        self.assertFalse(self.stamp.exists())
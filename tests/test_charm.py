@@ -3,15 +3,45 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import hashlib
+import io
+import json
+import socketserver
+import subprocess
+import sysconfig
+import tarfile
+import tempfile
+import threading
 import unittest
+from http.server import BaseHTTPRequestHandler
 from pathlib import Path
+from subprocess import CalledProcessError
 from unittest import mock
-from unittest.mock import Mock, call, mock_open, patch
+from unittest.mock import Mock, call
 
-from charm import APP_PATH, UNIT_PATH, VENV_ROOT, HelloJujuCharm
+import loadtest
+import tracing
+from charm import (
+    APP_PATH,
+    APT_UPDATE_MAX_AGE,
+    MIRROR_PATH,
+    MIRROR_REFSPECS,
+    NGINX_PATH,
+    NGINX_SITE_PATH,
+    POLICY_RC_PATH,
+    SOCKET_PATH,
+    UNIT_PATH,
+    VENV_ROOT,
+    HelloJujuCharm,
+    available_cpus,
+    bundle_member_safe,
+    template_environment,
+)
 from charms.operator_libs_linux.v0 import apt
-from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
+from git.exc import GitCommandError, InvalidGitRepositoryError, NoSuchPathError
+from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.testing import Harness
+from pipeline import Pipeline
 
 RENDERED_SETTINGS = """
 
@@ -22,52 +52,155 @@ RENDERED_SETTINGS = """
 ###############################################
 
 DATABASE_URI = "postgresql://test_connection_string"
-TRACK_MODIFICATIONS = False"""
+TRACK_MODIFICATIONS = False
+ENGINE_OPTIONS = {'max_overflow': 0, 'pool_pre_ping': True, 'pool_recycle': 3600, \
+'pool_size': 1}
+
+# Read-only hot standbys of the database. Queries that can tolerate replication
+# lag may be sent to these when READ_ROUTING is "replicas"; with no standbys all
+# queries go to DATABASE_URI and READ_ROUTING is "master".
+READ_ROUTING = "master"
+READ_REPLICA_URIS = []"""
 
 RENDERED_SYSTEMD_UNIT = """[Unit]
 Description=Hello Juju web application
-After=network.target
+Requires=hello-juju.socket
+After=network.target hello-juju.socket
 
 [Service]
 WorkingDirectory = /srv/app
 Restart = always
 RestartSec = 5
+RuntimeDirectory = hello-juju
+LogsDirectory = hello-juju
 ExecStart=/srv/app/venv/bin/gunicorn \\
             -u www-data \\
             -g www-data \\
-            --access-logfile /srv/app/access.log \\
-            --error-logfile /srv/app/error.log \\
-            --bind 0.0.0.0:80 \\
+            --chdir /srv/app \\
+            --workers 5 \\
+            --threads 1 \\
+            --worker-class sync \\
+            --keep-alive 2 \\
+            --timeout 30 \\
+            --access-logfile /var/log/hello-juju/access.log \\
+            --error-logfile /var/log/hello-juju/error.log \\
+            --pid /run/hello-juju/hello-juju.pid \\
             hello_juju:app
 ExecReload = /bin/kill -s HUP $MAINPID
 ExecStop = /bin/kill -s TERM $MAINPID
-ExecStartPre = /bin/mkdir /srv/app/run
-PIDFile = /srv/app/run/hello-juju.pid
-ExecStopPost = /bin/rm -rf /srv/app/run
+PIDFile = /run/hello-juju/hello-juju.pid
 
 [Install]
 WantedBy = multi-user.target"""
 
+RENDERED_SYSTEMD_SOCKET = """[Unit]
+Description=Hello Juju web application socket
+
+[Socket]
+ListenStream=0.0.0.0:80
+Backlog=2048
+
+[Install]
+WantedBy=sockets.target"""
+
+RENDERED_NGINX_CONFIG = """# Responses are cached briefly, so that bursts of identical requests are
+# served by nginx while the application stays current. The index records
+# every visit, so it is never cached
+proxy_cache_path /var/cache/nginx/hello-juju levels=1:2 keys_zone=hello_juju:10m
+                 max_size=100m inactive=10m use_temp_path=off;
+
+map $uri $hello_juju_no_cache {
+    default 0;
+    / 1;
+}
+
+upstream hello_juju {
+    server unix:/run/hello-juju.sock;
+    keepalive 32;
+}
+
+server {
+    listen 80;
+
+    location / {
+        proxy_pass http://hello_juju;
+        # Keep upstream connections open between requests
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+        proxy_set_header X-Forwarded-Proto $scheme;
+
+        # Read whole requests and responses, so slow clients never hold a worker
+        proxy_request_buffering on;
+        proxy_buffering on;
+
+        proxy_cache hello_juju;
+        proxy_cache_methods GET HEAD;
+        proxy_cache_bypass $hello_juju_no_cache;
+        proxy_no_cache $hello_juju_no_cache;
+        proxy_cache_valid 200 301 302 1s;
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating;
+        proxy_cache_background_update on;
+        add_header X-Cache-Status $upstream_cache_status;
+    }
+}"""
+
 
 class TestCharm(unittest.TestCase):
     def setUp(self):
+        # Keep charm state, such as the template bytecode cache, out of the system
+        state = tempfile.TemporaryDirectory()
+        self.addCleanup(state.cleanup)
+        self.state_path = Path(state.name)
+        patcher = mock.patch("charm.STATE_PATH", self.state_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        template_environment.cache_clear()
+        self.addCleanup(template_environment.cache_clear)
+
         self.harness = Harness(HelloJujuCharm)
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
     @mock.patch("charm.HelloJujuCharm._install_apt_packages")
-    @mock.patch("charm.HelloJujuCharm._setup_application")
-    @mock.patch("charm.HelloJujuCharm._render_systemd_unit")
+    @mock.patch("charm.HelloJujuCharm._prefetch_wheels")
+    @mock.patch("charm.HelloJujuCharm._run_application_pipeline")
+    @mock.patch("charm.HelloJujuCharm._application_pipeline")
+    @mock.patch("charm.HelloJujuCharm._render_systemd_units")
     @mock.patch("charm.check_call")
-    def test_on_install(self, _call, _render, _setup, _install):
+    def test_on_install(self, _call, _render, _pipeline, _run, _prefetch, _install):
+        order = []
+        _install.side_effect = lambda _: order.append("apt")
+        _prefetch.side_effect = lambda _: order.append("prefetch-wheels")
+        _run.side_effect = lambda pipeline: pipeline.run()
+        _pipeline.return_value = Pipeline("setup")
+        _pipeline.return_value.add(
+            "dependencies",
+            lambda: order.append("dependencies"),
+            after=["apt", "prefetch-wheels"],
+        )
         self.harness.charm.on.install.emit()
         self.assertEqual(
             self.harness.charm.unit.status, MaintenanceStatus("installing pip and virtualenv")
         )
+        # Dependencies are only installed once apt and the wheel prefetch are done
+        _pipeline.assert_called_once_with(None, after=["apt", "prefetch-wheels"])
         _install.assert_called_with(["python3-pip", "python3-virtualenv"])
-        _setup.assert_called_once()
+        _prefetch.assert_called_once_with(None)
+        self.assertEqual(order, ["apt", "prefetch-wheels", "dependencies"])
         _render.assert_called_once()
 
+        # Packages that can't be installed block the unit, from the main thread
+        _pipeline.return_value = Pipeline("setup")
+        _pipeline.return_value.add("dependencies", Mock(), after=["apt", "prefetch-wheels"])
+        _install.side_effect = apt.PackageNotFoundError
+        self.harness.charm.on.install.emit()
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("Failed to install packages")
+        )
+
     @mock.patch("charms.operator_libs_linux.v0.systemd.service_resume")
     @mock.patch("charm.check_call")
     def test_on_start(self, _call, _resume):
@@ -77,40 +210,94 @@ class TestCharm(unittest.TestCase):
         self.harness.charm.on.start.emit()
         # Ensure we set an ActiveStatus for the charm
         self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
-        # Make sure the port is opened and the service is started
+        # Make sure the port is opened and both the socket and the service are started
         self.assertEqual(_call.call_args_list, [call(["open-port", "80/TCP"])])
-        _resume.assert_called_with("hello-juju")
+        self.assertEqual(_resume.call_args_list, [call("hello-juju.socket"), call("hello-juju")])
 
+        # nginx is started as well when it proxies to the application
+        _resume.reset_mock()
+        with mock.patch.object(self.harness.charm, "_on_config_changed"):
+            self.harness.update_config({"proxy": True})
+        self.harness.charm.on.start.emit()
+        self.assertEqual(
+            _resume.call_args_list,
+            [call("hello-juju.socket"), call("hello-juju"), call("nginx")],
+        )
+        self.assertTrue(self.harness.charm._stored.proxy)
+
+    @mock.patch.object(Path, "exists", return_value=True)
+    @mock.patch("charm.HelloJujuCharm._install_dependencies", Mock())
+    @mock.patch("charm.HelloJujuCharm._reload_application")
     @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
     @mock.patch("charm.check_call")
     @mock.patch("charm.HelloJujuCharm._setup_application")
-    @mock.patch("charm.HelloJujuCharm._render_systemd_unit")
-    def test_on_config_changed(self, _render, _setup, _call, _restart):
+    @mock.patch("charm.HelloJujuCharm._render_systemd_units")
+    def test_on_config_changed(self, _render, _setup, _call, _restart, _reload, _exists):
+        # A successful deploy records what it deployed
+        def deploy():
+            self.harness.charm._stored.repo = self.harness.charm.config["application-repo"]
+            self.harness.charm._stored.ref = self.harness.charm.config["application-ref"]
+
+        _setup.side_effect = deploy
         # Check first run, no change to values set by install/start
         self.harness.charm._stored.repo = "https://github.com/juju/hello-juju"
         self.harness.charm._stored.port = 80
+        self.harness.charm._stored.gunicorn = self.harness.charm._gunicorn_options()
+        # The rendered units are unchanged unless the port changes
+        _render.return_value = set()
         # Run the handler
         self.harness.charm.on.config_changed.emit()
         _setup.assert_not_called()
         _call.assert_not_called()
+        _restart.assert_not_called()
+        _reload.assert_not_called()
         self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
 
-        # Change the application repo, should prompt a restart
+        # Nothing deployed, for example after a failed install, deploys again
+        _exists.return_value = False
+        self.harness.charm.on.config_changed.emit()
+        _setup.assert_called_once()
+        _exists.return_value = True
+
+        # Change the application repo, should prompt a graceful reload
         _setup.reset_mock()
         _call.reset_mock()
         self.harness.update_config({"application-repo": "DIFFERENT"})
         self.assertEqual(self.harness.charm._stored.repo, "DIFFERENT")
         _setup.assert_called_once()
+        # Changing only the requested revision also redeploys the application
+        _setup.reset_mock()
+        self.harness.update_config({"application-ref": "v2"})
+        self.assertEqual(self.harness.charm._stored.ref, "v2")
+        _setup.assert_called_once()
         # This also ensures that the port change code wasn't run
-        _render.assert_not_called()
-        _restart.assert_called_with("hello-juju")
+        _call.assert_not_called()
+        _reload.assert_called_with()
+        _restart.assert_not_called()
         self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
 
-        # Change the port, should prompt a restart
+        # A release with different dependencies needs a new gunicorn master
+        _reload.reset_mock()
+        with mock.patch(
+            "charm.HelloJujuCharm._live_requirements_hash", side_effect=["old", "new"]
+        ):
+            self.harness.update_config({"application-ref": "v3"})
+        _restart.assert_called_once_with("hello-juju")
+        _reload.assert_not_called()
+        _restart.reset_mock()
+
+        # Change the port, should prompt a restart of the socket and the service
         _setup.reset_mock()
         _call.reset_mock()
-        _restart.reset_mock()
-        self.harness.update_config({"port": 8080})
+        _reload.reset_mock()
+        _render.reset_mock()
+        _render.return_value = {"hello-juju.socket"}
+        manager = Mock()
+        with mock.patch(
+            "charms.operator_libs_linux.v0.systemd.service_stop", manager.stop
+        ), mock.patch("charms.operator_libs_linux.v0.systemd.service_start", manager.start):
+            manager.attach_mock(_restart, "restart")
+            self.harness.update_config({"port": 8080})
         self.assertEqual(self.harness.charm._stored.port, 8080)
         _render.assert_called_once()
         _setup.assert_not_called()
@@ -122,10 +309,463 @@ class TestCharm(unittest.TestCase):
                 call(["open-port", "8080/TCP"]),
             ],
         )
+        # The service has to be stopped before systemd lets the socket restart
+        self.assertEqual(
+            manager.mock_calls,
+            [
+                call.stop("hello-juju"),
+                call.restart("hello-juju.socket"),
+                call.start("hello-juju"),
+            ],
+        )
+        _reload.assert_not_called()
+
+        # A change to the service alone leaves the socket listening
+        _restart.reset_mock()
+        _render.return_value = {"hello-juju.service"}
+        self.harness.update_config({"timeout": 60})
+        _restart.assert_called_once_with("hello-juju")
+
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charm.HelloJujuCharm._install_dependencies")
+    @mock.patch("charm.HelloJujuCharm._render_systemd_units")
+    def test_on_config_changed_gunicorn(self, _render, _install, _restart):
+        self.harness.charm._stored.repo = "https://github.com/juju/hello-juju"
+        self.harness.charm._stored.port = 80
+        self.harness.charm._stored.gunicorn = self.harness.charm._gunicorn_options()
+        _render.return_value = {"hello-juju.service"}
+
+        # Switching to gevent workers installs gevent and restarts with the new unit
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"worker-class": "gevent", "workers": "4"})
+        self.assertEqual(self.harness.charm._extra_packages(), ["gunicorn", "gevent"])
+        _install.assert_called_once_with()
+        _render.assert_called_once()
         _restart.assert_called_with("hello-juju")
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+        # Invalid values block the unit without touching the service
+        _render.reset_mock()
+        self.harness.update_config({"worker-class": "eventlet"})
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("invalid worker-class 'eventlet'")
+        )
+        self.harness.update_config({"worker-class": "sync", "workers": "many"})
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("invalid workers 'many'"))
+        self.harness.update_config({"workers": "4", "db-pool-size": "lots"})
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("invalid db-pool-size 'lots'")
+        )
+        _render.assert_not_called()
 
+    @mock.patch("charm.HelloJujuCharm._render_proxy_config")
+    @mock.patch("charm.HelloJujuCharm._install_nginx")
+    @mock.patch("charm.HelloJujuCharm._render_systemd_units")
+    def test_on_config_changed_proxy(self, _render, _install, _render_proxy):
+        self.harness.charm._stored.repo = "https://github.com/juju/hello-juju"
+        self.harness.charm._stored.port = 80
+        self.harness.charm._stored.gunicorn = self.harness.charm._gunicorn_options()
+        manager = Mock()
+        patches = [
+            mock.patch(f"charms.operator_libs_linux.v0.systemd.service_{action}", method)
+            for action, method in (
+                ("stop", manager.stop),
+                ("restart", manager.restart),
+                ("start", manager.start),
+                ("resume", manager.resume),
+                ("pause", manager.pause),
+                ("reload", manager.reload),
+            )
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        # An invalid cache size blocks the charm
+        self.harness.update_config({"proxy-cache-size": "lots"})
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("invalid proxy-cache-size 'lots'")
+        )
+
+        # Switching the proxy on installs nginx, which takes over the port once the
+        # socket has moved to the unix socket
+        _render.return_value = {"hello-juju.socket"}
+        _render_proxy.return_value = True
+        with mock.patch.object(Path, "exists", side_effect=[True, False, True]):
+            self.harness.update_config({"proxy": True, "proxy-cache-size": "100m"})
+        _install.assert_called_once()
+        self.assertEqual(
+            manager.mock_calls,
+            [
+                call.stop("hello-juju"),
+                call.restart("hello-juju.socket"),
+                call.start("hello-juju"),
+                call.resume("nginx"),
+            ],
+        )
+        self.assertTrue(self.harness.charm._stored.proxy)
         self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
 
+        # Changes to the proxy alone reload nginx
+        manager.reset_mock()
+        _render.return_value = set()
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"proxy-cache-ttl": 5})
+        self.assertEqual(manager.mock_calls, [call.reload("nginx", restart_on_failure=True)])
+
+        # Switching the proxy off stops nginx before the socket takes the port back
+        manager.reset_mock()
+        _render.return_value = {"hello-juju.socket"}
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"proxy": False})
+        self.assertEqual(
+            manager.mock_calls,
+            [
+                call.stop("hello-juju"),
+                call.pause("nginx"),
+                call.restart("hello-juju.socket"),
+                call.start("hello-juju"),
+            ],
+        )
+        self.assertFalse(self.harness.charm._stored.proxy)
+
+        # The charm stops if nginx could not be installed
+        _install.reset_mock()
+        _render.reset_mock()
+        with mock.patch.object(Path, "exists", side_effect=[True, False, False]):
+            self.harness.update_config({"proxy": True})
+        _install.assert_called_once()
+        _render.assert_not_called()
+
+    @mock.patch("charm.HelloJujuCharm._install_apt_packages")
+    def test_install_nginx(self, _install):
+        self.assertEqual(NGINX_PATH, Path("/etc/nginx"))
+        self.assertEqual(POLICY_RC_PATH, Path("/usr/sbin/policy-rc.d"))
+        with tempfile.TemporaryDirectory() as tmp:
+            nginx, policy = Path(tmp, "nginx"), Path(tmp, "policy-rc.d")
+            Path(nginx, "sites-enabled").mkdir(parents=True)
+            Path(nginx, "sites-enabled", "default").symlink_to(Path(tmp, "missing"))
+
+            def install(packages):
+                # Services may not be started while the package is installed
+                self.assertEqual(packages, ["nginx"])
+                self.assertEqual(policy.read_text(), "#!/bin/sh\nexit 101\n")
+                self.assertEqual(policy.stat().st_mode & 0o777, 0o755)
+
+            _install.side_effect = install
+            with mock.patch("charm.NGINX_PATH", nginx), mock.patch("charm.POLICY_RC_PATH", policy):
+                self.harness.charm._install_nginx()
+                _install.assert_called_once()
+                # The policy is removed again, as is the default site
+                self.assertFalse(policy.exists())
+                self.assertFalse(Path(nginx, "sites-enabled", "default").is_symlink())
+
+                # An existing policy is left alone
+                _install.side_effect = None
+                policy.write_text("#!/bin/sh\nexit 0\n")
+                self.harness.charm._install_nginx()
+                self.assertEqual(policy.read_text(), "#!/bin/sh\nexit 0\n")
+
+                # A failed install blocks the unit
+                _install.side_effect = apt.PackageError
+                self.harness.charm._install_nginx()
+                self.assertEqual(
+                    self.harness.charm.unit.status, BlockedStatus("Failed to install packages")
+                )
+
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    def test_render_proxy_config(self):
+        self.assertEqual(NGINX_SITE_PATH, Path("/etc/nginx/conf.d/hello-juju.conf"))
+        with tempfile.TemporaryDirectory() as tmp:
+            site = Path(tmp, "hello-juju.conf")
+            with mock.patch("charm.NGINX_SITE_PATH", site):
+                # Nothing to render or remove without the proxy
+                self.assertFalse(self.harness.charm._render_proxy_config())
+                self.assertFalse(site.exists())
+
+                self.harness.update_config({"proxy": True})
+                self.assertTrue(self.harness.charm._render_proxy_config())
+                self.assertEqual(site.read_text(), RENDERED_NGINX_CONFIG)
+                self.assertEqual(site.stat().st_mode & 0o777, 0o644)
+                self.assertFalse(self.harness.charm._render_proxy_config())
+
+                self.harness.update_config(
+                    {"port": 8080, "proxy-cache-size": "1g", "proxy-cache-ttl": 10}
+                )
+                self.assertTrue(self.harness.charm._render_proxy_config())
+                rendered = site.read_text()
+                self.assertIn("listen 8080;", rendered)
+                self.assertIn("max_size=1g", rendered)
+                self.assertIn("proxy_cache_valid 200 301 302 10s;", rendered)
+
+                # Switching the proxy off removes the site
+                self.harness.update_config({"proxy": False})
+                self.assertTrue(self.harness.charm._render_proxy_config())
+                self.assertFalse(site.exists())
+
+    @mock.patch("charm.HelloJujuCharm._reload_application")
+    @mock.patch("charm.HelloJujuCharm._render_settings_file")
+    @mock.patch("charm.HelloJujuCharm._render_systemd_units", Mock(return_value=set()))
+    def test_on_config_changed_database_pool(self, _render, _reload):
+        self.harness.charm._stored.repo = "https://github.com/juju/hello-juju"
+        self.harness.charm._stored.port = 80
+        self.harness.charm._stored.gunicorn = self.harness.charm._gunicorn_options()
+
+        # Without database settings there is nothing to render
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"db-pool-recycle": 600})
+        _render.assert_not_called()
+
+        # New pool options are picked up by a graceful reload
+        self.harness.charm._stored.conn_str = "postgresql://test_connection_string"
+        _render.return_value = True
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"db-pool-recycle": 300})
+        _render.assert_called_once_with()
+        _reload.assert_called_once_with()
+
+        # Unchanged settings leave the workers alone
+        _reload.reset_mock()
+        _render.return_value = False
+        with mock.patch.object(Path, "exists", return_value=True):
+            self.harness.update_config({"db-pool-pre-ping": True})
+        _reload.assert_not_called()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch("charm.HelloJujuCharm._healthy", Mock(return_value=True))
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    @mock.patch("pgsql.opslib.pgsql.client._leader_get", Mock(return_value={}))
+    def test_rolling_restarts_leader(self, _restart):
+        def grants():
+            return json.loads(peers.data[self.harness.charm.app]["restart-grants"])
+
+        self.harness.set_leader(True)
+        self.harness.update_config({"max-concurrent-restarts": 2})
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        for unit in ("hello-juju/1", "hello-juju/2", "hello-juju/3"):
+            self.harness.add_relation_unit(peers, unit)
+        peers = self.harness.model.get_relation("cluster", peers)
+
+        # Only as many units as allowed get a slot at once
+        for unit in ("hello-juju/1", "hello-juju/2", "hello-juju/3"):
+            self.harness.update_relation_data(peers.id, unit, {"restart-request": "1"})
+        self.assertEqual(grants(), {"hello-juju/1": "1", "hello-juju/2": "1"})
+
+        # The leader waits for a slot like every other unit
+        self.assertFalse(self.harness.charm._request_restart("service"))
+        self.assertEqual(
+            self.harness.charm.unit.status, WaitingStatus("waiting for a restart slot")
+        )
+        self.assertEqual(peers.data[self.harness.charm.unit]["restart-request"], "1")
+        _restart.assert_not_called()
+
+        # A healthy unit frees its slot for the next one, here the leader, which
+        # restarts and hands its own slot on once it is healthy again
+        self.harness.update_relation_data(peers.id, "hello-juju/1", {"restart-done": "1"})
+        _restart.assert_called_once_with("hello-juju")
+        self.assertEqual(peers.data[self.harness.charm.unit]["restart-done"], "1")
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+        self.assertEqual(grants(), {"hello-juju/2": "1", "hello-juju/3": "1"})
+
+        # Units that leave give up their slot
+        self.harness.remove_relation_unit(peers.id, "hello-juju/2")
+        self.assertEqual(grants(), {"hello-juju/3": "1"})
+
+        # A new request is only granted once the previous one is done
+        self.harness.update_relation_data(peers.id, "hello-juju/1", {"restart-request": "2"})
+        self.assertEqual(grants(), {"hello-juju/1": "2", "hello-juju/3": "1"})
+
+    @mock.patch("charm.HelloJujuCharm._schema_fingerprint", Mock(return_value="abc"))
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    @mock.patch("pgsql.opslib.pgsql.client._leader_get", Mock(return_value={}))
+    def test_cluster_changed_publishes_schema(self):
+        # A leader that initialised the database before it had peers publishes it
+        # once they arrive
+        self.harness.set_leader(True)
+        self.harness.charm._stored.conn_str = "postgresql+pg8000://TEST"
+        self.harness.charm._stored.schema = "abc"
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        self.harness.add_relation_unit(peers, "hello-juju/1")
+        self.harness.update_relation_data(peers, "hello-juju/1", {"restart-request": "0"})
+        self.assertEqual(
+            self.harness.get_relation_data(peers, "hello-juju")["schema-database"],
+            hashlib.sha256(b"postgresql+pg8000://TEST").hexdigest(),
+        )
+        # Nothing is published for a schema that hasn't been initialised yet
+        self.harness.update_relation_data(
+            peers, "hello-juju", {"schema-fingerprint": "", "schema-database": ""}
+        )
+        self.harness.charm._stored.schema = "old"
+        self.harness.charm.on.update_status.emit()
+        self.assertEqual(self.harness.get_relation_data(peers, "hello-juju"), {})
+
+    @mock.patch("charm.HelloJujuCharm._restart_socket")
+    @mock.patch("charm.HelloJujuCharm._healthy")
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    def test_rolling_restarts_non_leader(self, _healthy, _restart_socket):
+        self.harness.set_leader(False)
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        self.harness.add_relation_unit(peers, "hello-juju/1")
+        data = self.harness.model.get_relation("cluster", peers).data[self.harness.charm.unit]
+
+        # Units wait for the leader to grant them a slot
+        self.assertFalse(self.harness.charm._request_restart("socket"))
+        self.assertEqual(data["restart-request"], "1")
+        self.assertEqual(
+            self.harness.charm.unit.status, WaitingStatus("waiting for a restart slot")
+        )
+        # Further requests are covered by the pending one, which keeps restarting
+        # the socket as well
+        self.assertFalse(self.harness.charm._request_restart("service"))
+        self.assertEqual(data["restart-request"], "1")
+        self.assertEqual(self.harness.charm._stored.restart, "socket")
+        _restart_socket.assert_not_called()
+
+        # The slot is kept while the application fails its health check
+        _healthy.return_value = False
+        self.harness.update_relation_data(
+            peers, "hello-juju", {"restart-grants": json.dumps({"hello-juju/0": "1"})}
+        )
+        _restart_socket.assert_called_once()
+        self.assertNotIn("restart-done", data)
+        self.assertEqual(
+            self.harness.charm.unit.status, BlockedStatus("application unhealthy after restart")
+        )
+
+        # Later hooks check again without restarting again, and free the slot
+        _healthy.return_value = True
+        self.harness.charm.on.update_status.emit()
+        _restart_socket.assert_called_once()
+        self.assertEqual(data["restart-done"], "1")
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch("time.sleep", Mock())
+    @mock.patch("charm.HTTPConnection")
+    def test_healthy(self, _connection):
+        self.harness.charm._stored.port = 8080
+        response = _connection.return_value.getresponse
+        # The application is polled until it answers
+        _connection.return_value.request.side_effect = [ConnectionRefusedError, None]
+        response.return_value.status = 200
+        self.assertTrue(self.harness.charm._healthy())
+        _connection.assert_called_with("127.0.0.1", 8080, timeout=5)
+        _connection.return_value.request.assert_called_with("GET", "/greetings")
+        self.assertEqual(_connection.return_value.close.call_count, 2)
+        # An application that never answers, or answers with errors, fails the check
+        _connection.return_value.request.side_effect = ConnectionRefusedError
+        with mock.patch("charm.HEALTH_CHECK_TIMEOUT", 0):
+            self.assertFalse(self.harness.charm._healthy())
+        _connection.return_value.request.side_effect = None
+        response.return_value.status = 500
+        with mock.patch("charm.HEALTH_CHECK_TIMEOUT", 0):
+            self.assertFalse(self.harness.charm._healthy())
+
+    @mock.patch("time.sleep", Mock())
+    def test_healthy_proxy(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path == "/greetings" else 404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        # Behind the proxy gunicorn is checked on its socket, bypassing nginx
+        self.harness.charm._stored.proxy = True
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, "hello-juju.sock")
+            with mock.patch("charm.GUNICORN_SOCKET_PATH", path):
+                with mock.patch("charm.HEALTH_CHECK_TIMEOUT", 0):
+                    self.assertFalse(self.harness.charm._healthy())
+                server = socketserver.UnixStreamServer(str(path), Handler)
+                self.addCleanup(server.server_close)
+                thread = threading.Thread(target=server.serve_forever, daemon=True)
+                thread.start()
+                self.addCleanup(server.shutdown)
+                self.assertTrue(self.harness.charm._healthy())
+
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    @mock.patch("charm.available_cpus", Mock(return_value=4))
+    def test_engine_options(self):
+        self.assertEqual(
+            self.harness.charm._engine_options(),
+            {"pool_size": 1, "max_overflow": 0, "pool_recycle": 3600, "pool_pre_ping": True},
+        )
+        # Threaded workers get a connection per thread
+        self.harness.update_config({"worker-class": "gthread", "threads": 4})
+        self.assertEqual(self.harness.charm._engine_options()["pool_size"], 4)
+        # Gevent workers serve many requests at once from a fixed pool
+        self.harness.update_config({"worker-class": "gevent"})
+        self.assertEqual(self.harness.charm._engine_options()["pool_size"], 5)
+        # Explicit values win, and a statement timeout is passed to the driver
+        self.harness.update_config(
+            {
+                "db-pool-size": "3",
+                "db-max-overflow": 2,
+                "db-pool-recycle": -1,
+                "db-pool-pre-ping": False,
+                "db-statement-timeout": 5000,
+            }
+        )
+        self.assertEqual(
+            self.harness.charm._engine_options(),
+            {
+                "pool_size": 3,
+                "max_overflow": 2,
+                "pool_recycle": -1,
+                "pool_pre_ping": False,
+                "connect_args": {"startup_params": {"statement_timeout": "5000"}},
+            },
+        )
+
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    @mock.patch("charm.available_cpus", Mock(return_value=4))
+    def test_gunicorn_options(self):
+        options = self.harness.charm._gunicorn_options()
+        self.assertEqual(
+            options,
+            {
+                "workers": 9,
+                "threads": 1,
+                "worker_class": "sync",
+                "keepalive": 2,
+                "timeout": 30,
+            },
+        )
+        self.harness.update_config({"worker-class": "gevent"})
+        self.assertEqual(self.harness.charm._gunicorn_options()["workers"], 4)
+        self.harness.update_config({"workers": "3", "threads": 8, "worker-class": "gthread"})
+        self.assertEqual(self.harness.charm._gunicorn_options()["workers"], 3)
+        self.assertEqual(self.harness.charm._gunicorn_options()["threads"], 8)
+
+    @mock.patch("os.sched_getaffinity", Mock(return_value={0, 1, 2, 3, 4, 5, 6, 7}))
+    def test_available_cpus(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch("charm.CGROUP_PATH", Path(tmp)):
+                # No cgroup CPU controller at all
+                self.assertEqual(available_cpus(), 8)
+                # cgroup v1 with and without a quota
+                Path(tmp, "cpu").mkdir()
+                Path(tmp, "cpu/cpu.cfs_quota_us").write_text("-1\n")
+                Path(tmp, "cpu/cpu.cfs_period_us").write_text("100000\n")
+                self.assertEqual(available_cpus(), 8)
+                Path(tmp, "cpu/cpu.cfs_quota_us").write_text("150000\n")
+                self.assertEqual(available_cpus(), 2)
+                # cgroup v2 takes precedence
+                Path(tmp, "cpu.max").write_text("max 100000\n")
+                self.assertEqual(available_cpus(), 8)
+                Path(tmp, "cpu.max").write_text("50000 100000\n")
+                self.assertEqual(available_cpus(), 1)
+        # Platforms without CPU affinity fall back to the CPU count
+        with mock.patch("os.sched_getaffinity", Mock(side_effect=AttributeError)), mock.patch(
+            "os.cpu_count", Mock(return_value=3)
+        ), mock.patch("charm.CGROUP_PATH", Path("/nonexistent")):
+            self.assertEqual(available_cpus(), 3)
+
     @mock.patch("pgsql.opslib.pgsql.client._leader_get")
     @mock.patch("pgsql.opslib.pgsql.client._leader_set")
     def test_on_database_relation_joined_leader(self, _leader_set, _leader_get):
@@ -162,9 +802,74 @@ class TestCharm(unittest.TestCase):
             {},
         )
 
+    @mock.patch("loadtest.run")
+    def test_on_load_test_action(self, _run):
+        # Nothing to test before the application listens
+        with self.assertRaises(Exception) as error:
+            self.harness.run_action("load-test")
+        self.assertIn("not listening", str(error.exception))
+
+        self.harness.charm._stored.port = 8080
+        result = loadtest.Result(2.0)
+        result.latencies = [i / 1000 for i in range(1, 101)]
+        result.errors = 1
+        _run.return_value = result
+        output = self.harness.run_action("load-test", {"duration": 2, "concurrency": 4})
+        _run.assert_called_once_with("127.0.0.1", 8080, 2, 4, "/greetings", unix_socket=None)
+        self.assertEqual(
+            output.results,
+            {
+                "requests": 101,
+                "errors": 1,
+                "error-rate": "0.0099",
+                "throughput": "50.0",
+                "latency-ms": {"p50": "50.0", "p95": "95.0", "p99": "99.0"},
+            },
+        )
+
+        # Behind the proxy gunicorn is loaded directly rather than nginx's cache
+        _run.reset_mock()
+        self.harness.charm._stored.proxy = True
+        self.harness.run_action("load-test", {"duration": 2, "concurrency": 4})
+        _run.assert_called_once_with(
+            "127.0.0.1", 8080, 2, 4, "/greetings", unix_socket="/run/hello-juju.sock"
+        )
+
+    @mock.patch.dict("os.environ", {"JUJU_DISPATCH_PATH": "hooks/install"})
+    def test_trace_hooks(self):
+        self.addCleanup(tracing.disable)
+        # Tracing is off by default
+        self.assertFalse(tracing.enabled())
+
+        with tempfile.TemporaryDirectory() as tmp, mock.patch("charm.TRACE_PATH", Path(tmp)):
+            harness = Harness(HelloJujuCharm)
+            self.addCleanup(harness.cleanup)
+            harness.update_config({"trace-hooks": True})
+            harness.begin()
+            self.assertTrue(tracing.enabled())
+            self.assertEqual(tracing.current_phase(), "install")
+
+            # Nothing has been traced yet
+            action = harness.run_action
+            with self.assertRaises(Exception) as error:
+                action("hook-profile")
+            self.assertIn("enable the trace-hooks option", str(error.exception))
+
+            # The commands run by the hook are written out when it commits
+            subprocess.check_call(["sleep", "0.01"])
+            subprocess.check_call(["true"])
+            harness.framework.on.commit.emit()
+            self.assertEqual(len(list(Path(tmp).glob("*.json"))), 1)
+
+            output = action("hook-profile", {"limit": 1})
+            self.assertEqual(output.results["traces"], 1)
+            self.assertRegex(
+                output.results["slowest"], r"^ +[0-9.]+ms  install  sleep 0.01 \(exit 0\)$"
+            )
+
     @mock.patch("charm.HelloJujuCharm._render_settings_file")
     @mock.patch("charm.HelloJujuCharm._create_database_tables")
-    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charm.HelloJujuCharm._reload_application")
     @mock.patch("pgsql.opslib.pgsql.client._leader_get")
     @mock.patch("pgsql.opslib.pgsql.client._leader_set")
     def test_on_database_master_changed(
@@ -172,6 +877,7 @@ class TestCharm(unittest.TestCase):
         # Setup the mocks for leader-get and leader-set in the pgsql library
         _leader_get.return_value = {}
         _leader_set.return_value = None
+        _createdb.return_value = "abc"
         # Test as a leader first
         self.harness.set_leader(True)
         # Setup the relation
@@ -180,18 +886,47 @@ class TestCharm(unittest.TestCase):
 
         # Trigger the on_database_master_changed event with some data
         test_event = Mock()
+        test_event.handle.key = "10"
         test_event.database = "hello-juju"
         test_event.master.uri = "postgresql://TEST"
+        test_event.standbys = [
+            Mock(uri="postgresql://STANDBY2"),
+            Mock(uri="postgresql://STANDBY1"),
+        ]
 
         # Run the handler
         self.harness.charm._on_database_master_changed(test_event)
-        # Check the connection string was updated to use pg8000
+        # Check the connection strings were updated to use pg8000
         self.assertEqual(self.harness.charm._stored.conn_str, "postgresql+pg8000://TEST")
+        self.assertEqual(
+            self.harness.charm._stored.standbys,
+            ["postgresql+pg8000://STANDBY1", "postgresql+pg8000://STANDBY2"],
+        )
         _render.assert_called_once()
-        _createdb.assert_called_once()
-        _restart.assert_called_with("hello-juju")
+        # The tables are created by the leader and the schema recorded
+        _createdb.assert_called_once_with(APP_PATH, True, "")
+        self.assertEqual(self.harness.charm._stored.schema, "abc")
+        _restart.assert_called_once_with()
         self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
 
+        # A repeated event with connection details already applied does nothing
+        _render.reset_mock()
+        _createdb.reset_mock()
+        _restart.reset_mock()
+        self.harness.charm._on_database_master_changed(test_event)
+        _render.assert_not_called()
+        _createdb.assert_not_called()
+        _restart.assert_not_called()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+        # New details whose rendered settings match the file don't reload the application
+        test_event.standbys = []
+        _render.return_value = False
+        self.harness.charm._on_database_master_changed(test_event)
+        _render.assert_called_once()
+        _createdb.assert_not_called()
+        _restart.assert_not_called()
+
         # Check where the database hasn't yet been set
         # Reset some stuff
         _render.reset_mock()
@@ -200,144 +935,400 @@ class TestCharm(unittest.TestCase):
         self.harness.charm._on_database_master_changed(test_event)
         _render.assert_not_called()
 
-        # Check where the database hasn't yet been set
-        # Reset some stuff
+        # Without a master the event is deferred until one is available
         _restart.reset_mock()
         test_event = Mock()
+        test_event.handle.key = "11"
         test_event.database = "hello-juju"
         test_event.master = None
         # Run the handler
         self.harness.charm._on_database_master_changed(test_event)
+        test_event.defer.assert_called_once_with()
         _restart.assert_not_called()
 
+        # A burst of events during the outage is coalesced into the newest one
+        newer = Mock()
+        newer.handle.key = "12"
+        newer.database = "hello-juju"
+        newer.master = None
+        self.harness.charm._on_database_master_changed(newer)
+        newer.defer.assert_called_once_with()
+        self.assertEqual(self.harness.charm._stored.master_deferred, 12)
+        # Once the master is back, the older deferred event is dropped and the newer applied
+        test_event.master = newer.master = Mock(uri="postgresql://FAILOVER")
+        newer.standbys = []
+        test_event.defer.reset_mock()
+        self.harness.charm._on_database_master_changed(test_event)
+        test_event.defer.assert_not_called()
+        _render.assert_not_called()
+        _render.return_value = True
+        self.harness.charm._on_database_master_changed(newer)
+        self.assertEqual(self.harness.charm._stored.conn_str, "postgresql+pg8000://FAILOVER")
+        _render.assert_called_once()
+        _restart.assert_called_once_with()
+
+    @mock.patch("charm.HelloJujuCharm._render_settings_file")
+    @mock.patch("charm.HelloJujuCharm._reload_application")
+    def test_on_database_master_changed_non_leader(self, _reload, _render):
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        test_event = Mock()
+        test_event.handle.key = "3"
+        test_event.database = "hello-juju"
+        test_event.master.uri = "postgresql://TEST"
+        test_event.standbys = []
+
+        # Until the leader has initialised the database the event waits
+        self.harness.charm._on_database_master_changed(test_event)
+        test_event.defer.assert_called_once_with()
+        _render.assert_not_called()
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            WaitingStatus("waiting for leader to initialise database"),
+        )
+        # The new connection details aren't considered applied while waiting
+        self.assertEqual(self.harness.charm._stored.conn_str, "")
+
+        # A database published by the leader before a failover doesn't release it
+        old = hashlib.sha256(b"postgresql+pg8000://OLD").hexdigest()
+        self.harness.update_relation_data(peers, "hello-juju", {"schema-database": old})
+        self.harness.charm._on_database_master_changed(test_event)
+        self.assertEqual(test_event.defer.call_count, 2)
+
+        # The leader publishing this database releases it, whatever schema code
+        # this unit has checked out
+        test_event.defer.reset_mock()
+        database = hashlib.sha256(b"postgresql+pg8000://TEST").hexdigest()
+        self.harness.update_relation_data(
+            peers, "hello-juju", {"schema-fingerprint": "abc", "schema-database": database}
+        )
+        self.harness.charm._on_database_master_changed(test_event)
+        test_event.defer.assert_not_called()
+        _render.assert_called_once_with()
+        _reload.assert_called_once_with()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @mock.patch("charm.HelloJujuCharm._render_settings_file")
+    @mock.patch("charm.HelloJujuCharm._reload_application")
+    def test_on_database_standby_changed(self, _reload, _render):
+        test_event = Mock()
+        test_event.database = "hello-juju"
+        test_event.standbys = [Mock(uri="postgresql://STANDBY")]
+
+        # Standbys seen before the master are only stored
+        self.harness.charm._on_database_standby_changed(test_event)
+        self.assertEqual(self.harness.charm._stored.standbys, ["postgresql+pg8000://STANDBY"])
+        _render.assert_not_called()
+
+        # Once the master is known the settings are rendered and workers replaced
+        self.harness.charm._stored.conn_str = "postgresql+pg8000://TEST"
+        test_event.standbys.append(Mock(uri="postgresql://STANDBY2"))
+        _render.return_value = True
+        self.harness.charm._on_database_standby_changed(test_event)
+        _render.assert_called_once_with()
+        _reload.assert_called_once_with()
+
+        # Losing every standby falls back to the master
+        _reload.reset_mock()
+        test_event.standbys = []
+        self.harness.charm._on_database_standby_changed(test_event)
+        self.assertEqual(self.harness.charm._stored.standbys, [])
+        _reload.assert_called_once_with()
+        # Standbys that are already applied are skipped, unchanged settings don't reload
+        _render.reset_mock()
+        _reload.reset_mock()
+        self.harness.charm._on_database_standby_changed(test_event)
+        _render.assert_not_called()
+        test_event.standbys = [Mock(uri="postgresql://OTHER")]
+        _render.return_value = False
+        self.harness.charm._on_database_standby_changed(test_event)
+        _render.assert_called_once_with()
+        _reload.assert_not_called()
+
+        # Events for a database that isn't ours yet are ignored
+        _render.reset_mock()
+        self.harness.charm._on_database_standby_changed(Mock())
+        _render.assert_not_called()
+
+    @mock.patch("pgsql.opslib.pgsql.client._leader_get", Mock(return_value={}))
+    @mock.patch("pgsql.opslib.pgsql.client._leader_set", Mock())
     @mock.patch("subprocess.call")
     def test_create_database_tables(self, _mock):
-        # Define the args that 'check_call' should be called with
-        args = ["sudo", "-u", "www-data", f"{VENV_ROOT}/bin/python3", f"{APP_PATH}/init.py"]
+        def create(release):
+            # As after a pipeline, the step's result is recorded from the main thread
+            charm = self.harness.charm
+            charm._record_schema(
+                charm._create_database_tables(
+                    release, charm.unit.is_leader(), charm._published_schema()
+                )
+            )
+
         # Successful command execution returns 0
         _mock.return_value = 0
-        # Execute the method
-        self.harness.charm._create_database_tables()
-        # Check that check_call was invoked with the correct args
-        _mock.assert_called_once_with(args)
-        # Ensure the unit status is set correctly
-        self.assertEqual(
-            self.harness.charm.unit.status, MaintenanceStatus("creating database tables")
-        )
+        self.harness.set_leader(True)
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        self.harness.charm._stored.conn_str = "postgresql+pg8000://TEST"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            release = Path(tmp)
+            Path(release, "init.py").write_text("db.create_all()\n")
+            # Define the args that 'check_call' should be called with
+            args = ["sudo", "-u", "www-data", f"{tmp}/venv/bin/python3", f"{tmp}/init.py"]
+            # Execute the method
+            create(release)
+            # Check that check_call was invoked with the correct args
+            _mock.assert_called_once_with(args)
+            # The fingerprint is recorded and published to the other units
+            fingerprint = self.harness.charm._schema_fingerprint(release)
+            self.assertEqual(self.harness.charm._stored.schema, fingerprint)
+            published = {
+                "schema-fingerprint": fingerprint,
+                "schema-database": hashlib.sha256(b"postgresql+pg8000://TEST").hexdigest(),
+            }
+            self.assertEqual(self.harness.get_relation_data(peers, "hello-juju"), published)
+
+            # Nothing changed, so the database isn't initialised again, but the
+            # fingerprint is still published for peers that arrived since
+            _mock.reset_mock()
+            self.harness.update_relation_data(
+                peers, "hello-juju", {"schema-fingerprint": "", "schema-database": ""}
+            )
+            create(release)
+            _mock.assert_not_called()
+            self.assertEqual(self.harness.get_relation_data(peers, "hello-juju"), published)
+            # Values the peers already have are not written again
+            with mock.patch("ops.model.RelationDataContent.__setitem__") as _set:
+                create(release)
+            _set.assert_not_called()
+
+            # New migrations or a different database need a fresh initialisation
+            Path(release, "migrations").mkdir()
+            Path(release, "migrations", "0001.sql").write_text("ALTER TABLE ...\n")
+            create(release)
+            self.assertEqual(_mock.call_count, 1)
+            self.harness.charm._stored.conn_str = "postgresql+pg8000://OTHER"
+            create(release)
+            self.assertEqual(_mock.call_count, 2)
+
+            # A fingerprint published by a previous leader is also honoured
+            _mock.reset_mock()
+            self.harness.charm._stored.schema = ""
+            create(release)
+            _mock.assert_not_called()
+
+            # Other units never initialise the database themselves
+            self.harness.charm._stored.conn_str = "postgresql+pg8000://THIRD"
+            self.harness.set_leader(False)
+            self.assertIsNone(self.harness.charm._create_database_tables(release, False, ""))
+            _mock.assert_not_called()
+
+            # Without a database relation every unit initialises its own database,
+            # and nothing is published for the others
+            published = dict(self.harness.get_relation_data(peers, "hello-juju"))
+            self.harness.charm._stored.conn_str = ""
+            create(release)
+            _mock.assert_called_once_with(args)
+            self.assertEqual(self.harness.get_relation_data(peers, "hello-juju"), published)
+            _mock.reset_mock()
+            create(release)
+            _mock.assert_not_called()
+            # The database lives in the release, so a new release starts empty even
+            # with the same schema code
+            with tempfile.TemporaryDirectory() as other:
+                Path(other, "init.py").write_text("db.create_all()\n")
+                Path(other, "migrations").mkdir()
+                Path(other, "migrations", "0001.sql").write_text("ALTER TABLE ...\n")
+                create(Path(other))
+                _mock.assert_called_once_with(
+                    ["sudo", "-u", "www-data", f"{other}/venv/bin/python3", f"{other}/init.py"]
+                )
+            _mock.reset_mock()
+            self.harness.charm._stored.conn_str = "postgresql+pg8000://THIRD"
+
+            # Without peers the fingerprint is only recorded locally
+            self.harness.remove_relation(peers)
+            self.harness.set_leader(True)
+            create(release)
+            _mock.assert_called_once_with(args)
+            self.assertEqual(
+                self.harness.charm._stored.schema,
+                self.harness.charm._schema_fingerprint(release),
+            )
+
+    def test_schema_fingerprint(self):
+        self.harness.charm._stored.conn_str = "postgresql+pg8000://TEST"
+        with tempfile.TemporaryDirectory() as tmp:
+            release = Path(tmp)
+            empty = self.harness.charm._schema_fingerprint(release)
+            Path(release, "init.py").write_text("db.create_all()\n")
+            with_init = self.harness.charm._schema_fingerprint(release)
+            self.assertNotEqual(empty, with_init)
+            # Unrelated application code doesn't affect the fingerprint
+            Path(release, "app.py").write_text("app = Flask(__name__)\n")
+            self.assertEqual(self.harness.charm._schema_fingerprint(release), with_init)
+        # Without a peer relation nothing has been published
+        self.assertEqual(self.harness.charm._published_schema(), "")
 
-    @mock.patch("os.chmod")
     @mock.patch("os.chown")
     @mock.patch("charms.operator_libs_linux.v0.passwd.user_exists")
-    def test_render_settings_file(self, _userexists, _chown, _chmod):
+    def test_render_settings_file(self, _userexists, _chown):
         # Set the value that will be written into the settings file
         self.harness.charm._stored.conn_str = "postgresql://test_connection_string"
+        # Set the uid/gid return values for lookup of 'www-data' user
+        _userexists.return_value.pw_uid = 35
+        _userexists.return_value.pw_gid = 35
+
+        with tempfile.TemporaryDirectory() as tmp:
+            settings = Path(tmp, "settings.py")
+            # Call the method, the file is written as it didn't exist
+            self.assertTrue(self.harness.charm._render_settings_file(Path(tmp)))
+            # Ensure the correct rendered template is written to file
+            self.assertEqual(settings.read_text(), RENDERED_SETTINGS)
+            # Ensure the file has the correct permissions and no temporary file is left
+            self.assertEqual(settings.stat().st_mode & 0o777, 0o644)
+            self.assertEqual([p.name for p in Path(tmp).iterdir()], ["settings.py"])
+            # Ensure that the correct user is lookup up
+            _userexists.assert_called_with("www-data")
+            # Ensure the file is chown'd correctly before being moved into place
+            _chown.assert_called_with(Path(tmp, ".settings.py.tmp"), uid=35, gid=35)
+
+            # Rendering the same settings again leaves the file alone
+            _chown.reset_mock()
+            self.assertFalse(self.harness.charm._render_settings_file(Path(tmp)))
+            _chown.assert_not_called()
 
-        # Setup a mock for the `open` method, set returned data to settings template
-        with open("templates/settings.py.j2", "r") as f:
-            m = mock_open(read_data=f.read())
-
-        # Patch the `open` method with our mock
-        with patch("builtins.open", m, create=True):
-            # Set the uid/gid return values for lookup of 'www-data' user
-            _userexists.return_value.pw_uid = 35
-            _userexists.return_value.pw_gid = 35
-            # Call the method
-            self.harness.charm._render_settings_file()
-
-        # Check the template is opened read-only in the first call to open
-        self.assertEqual(m.call_args_list[0][0], ("templates/settings.py.j2", "r"))
-        # Check the settings file is opened with "w+" mode in the second call to open
-        self.assertEqual(m.call_args_list[1][0], (f"{APP_PATH}/settings.py", "w+"))
-        # Ensure the correct rendered template is written to file
-        m.return_value.write.assert_called_with(RENDERED_SETTINGS)
-        # Ensure that the correct user is lookup up
-        _userexists.assert_called_with("www-data")
-        # Ensure the file is chmod'd correctly
-        _chmod.assert_called_with(f"{APP_PATH}/settings.py", 0o644)
-        # Ensure the file is chown'd correctly
-        _chown.assert_called_with(f"{APP_PATH}/settings.py", uid=35, gid=35)
+            # New connection details replace the file
+            self.harness.charm._stored.conn_str = "postgresql://other"
+            self.assertTrue(self.harness.charm._render_settings_file(Path(tmp)))
+            self.assertIn('DATABASE_URI = "postgresql://other"', settings.read_text())
 
+            # Standbys are listed for reads, with routing hinting at the replicas
+            self.harness.charm._stored.standbys = ["postgresql://a", "postgresql://b"]
+            self.assertTrue(self.harness.charm._render_settings_file(Path(tmp)))
+            self.assertIn(
+                "READ_REPLICA_URIS = ['postgresql://a', 'postgresql://b']", settings.read_text()
+            )
+            self.assertIn('READ_ROUTING = "replicas"', settings.read_text())
+
+    @mock.patch("charm.available_cpus", Mock(return_value=2))
     @mock.patch("charms.operator_libs_linux.v0.systemd.daemon_reload")
-    @mock.patch("os.chmod")
-    def test_render_systemd_unit(self, _chmod, _reload):
-        # Create a mock for the `open` method, set the return value of `read` to
-        # the contents of the systemd unit template
-        with open("templates/hello-juju.service.j2", "r") as f:
-            m = mock_open(read_data=f.read())
-
-        # Patch the `open` method with our mock
-        with patch("builtins.open", m, create=True):
-            # Ensure the stored value is clear to test it's set properly
-            self.harness.charm._stored.port = ""
-            # Mock the return value of the `check_call`
-            _reload.return_value = 0
-            # Call the method
-            self.harness.charm._render_systemd_unit()
-
-        # Check the unit path is correct
+    def test_render_systemd_units(self, _reload):
+        # Check the unit paths are correct
         self.assertEqual(UNIT_PATH, Path("/etc/systemd/system/hello-juju.service"))
-        # Check the state was updated with the port from the config
-        self.assertEqual(self.harness.charm._stored.port, self.harness.charm.config["port"])
-        # Check the template is opened read-only in the first call to open
-        self.assertEqual(m.call_args_list[0][0], ("templates/hello-juju.service.j2", "r"))
-        # Check the systemd unit file is opened with "w+" mode in the second call to open
-        self.assertEqual(m.call_args_list[1][0], (UNIT_PATH, "w+"))
-        # Ensure the correct rendered template is written to file
-        m.return_value.write.assert_called_with(RENDERED_SYSTEMD_UNIT)
-        # Check the file permissions are set correctly
-        _chmod.assert_called_with(UNIT_PATH, 0o755)
-        # Check that systemd is reloaded to register the changes to the unit
-        _reload.assert_called_once()
+        self.assertEqual(SOCKET_PATH, Path("/etc/systemd/system/hello-juju.socket"))
 
-        # Now check that any existing port in state is respected
-        # Patch the `open` method with our mock
-        with patch("builtins.open", m, create=True):
-            # Ensure the stored value is clear to test it's set properly
-            self.harness.charm._stored.port = 8080
-            # Mock the return value of the `check_call`
-            _reload.return_value = 0
-            # Call the method
-            self.harness.charm._render_systemd_unit()
-        # Ensure the rendered template is adjusted to take into consideration the port
-        m.return_value.write.assert_called_with(RENDERED_SYSTEMD_UNIT.replace(":80", ":8080"))
-        self.assertEqual(self.harness.charm._stored.port, 8080)
+        with tempfile.TemporaryDirectory() as tmp:
+            unit = Path(tmp, "hello-juju.service")
+            socket = Path(tmp, "hello-juju.socket")
+            with mock.patch("charm.UNIT_PATH", unit), mock.patch("charm.SOCKET_PATH", socket):
+                # Ensure the stored value is clear to test it's set properly
+                self.harness.charm._stored.port = ""
+                # Call the method
+                self.assertEqual(
+                    self.harness.charm._render_systemd_units(),
+                    {"hello-juju.service", "hello-juju.socket"},
+                )
+                # Check the state was updated with the port from the config
+                self.assertEqual(
+                    self.harness.charm._stored.port, self.harness.charm.config["port"]
+                )
+                # Ensure the correct rendered templates are written to file
+                self.assertEqual(unit.read_text(), RENDERED_SYSTEMD_UNIT)
+                self.assertEqual(socket.read_text(), RENDERED_SYSTEMD_SOCKET)
+                # Check the file permissions are set correctly
+                self.assertEqual(unit.stat().st_mode & 0o777, 0o755)
+                self.assertEqual(socket.stat().st_mode & 0o777, 0o644)
+                # Check that systemd is reloaded to register the changes to the units
+                _reload.assert_called_once()
+
+                # Unchanged units don't reload systemd
+                _reload.reset_mock()
+                self.assertEqual(self.harness.charm._render_systemd_units(), set())
+                _reload.assert_not_called()
+
+                # Now check that any existing port in state is respected, which
+                # only concerns the socket
+                self.harness.charm._stored.port = 8080
+                self.assertEqual(
+                    self.harness.charm._render_systemd_units(), {"hello-juju.socket"}
+                )
+                self.assertEqual(
+                    socket.read_text(), RENDERED_SYSTEMD_SOCKET.replace(":80", ":8080")
+                )
+                self.assertEqual(self.harness.charm._stored.port, 8080)
+                _reload.assert_called_once()
+
+                # The backlog is a property of the socket as well
+                with mock.patch.object(self.harness.charm, "_on_config_changed"):
+                    self.harness.update_config({"backlog": 128})
+                self.assertEqual(
+                    self.harness.charm._render_systemd_units(), {"hello-juju.socket"}
+                )
+                self.assertIn("Backlog=128\n", socket.read_text())
+
+                # Worker settings only change the service
+                with mock.patch.object(self.harness.charm, "_on_config_changed"):
+                    self.harness.update_config({"timeout": 60})
+                self.assertEqual(
+                    self.harness.charm._render_systemd_units(), {"hello-juju.service"}
+                )
+
+                # Behind the proxy, gunicorn listens on a unix socket for nginx
+                with mock.patch.object(self.harness.charm, "_on_config_changed"):
+                    self.harness.update_config({"proxy": True})
+                self.assertEqual(
+                    self.harness.charm._render_systemd_units(), {"hello-juju.socket"}
+                )
+                self.assertIn("ListenStream=/run/hello-juju.sock\n", socket.read_text())
+
+    def test_template_environment(self):
+        # Templates are parsed once per process and reused
+        first = self.harness.charm._template("settings.py.j2")
+        self.assertIs(self.harness.charm._template("settings.py.j2"), first)
+        # Compiled bytecode is cached in the charm state directory for later hooks
+        self.assertEqual(len(list(Path(self.state_path, "jinja").iterdir())), 1)
+
+        # Without a usable state directory templates are still rendered
+        template_environment.cache_clear()
+        with mock.patch.object(Path, "mkdir", side_effect=PermissionError):
+            env = template_environment(str(self.harness.charm.charm_dir / "templates"))
+        self.assertIsNone(env.bytecode_cache)
+        self.assertIn("DATABASE_URI", env.get_template("settings.py.j2").render(conn_str="x"))
 
     @mock.patch("charms.operator_libs_linux.v0.apt.update")
     @mock.patch("charms.operator_libs_linux.v0.apt.add_package")
-    # @mock.patch("charm.check_output")
     def test_install_apt_packages(self, _add_package, _update):
         # Call the method with some packages to install
         self.harness.charm._install_apt_packages(["curl", "vim"])
         # Check that apt is called with the correct arguments
-        _update.assert_called_once()
+        _update.assert_called_once_with(max_age=APT_UPDATE_MAX_AGE)
         _add_package.assert_called_with(["curl", "vim"])
-        # Now check that if an exception is raised we do the right logging
-        _add_package.reset_mock()
-        _add_package.return_value = 1
-        _add_package.side_effect = apt.PackageNotFoundError
-        self.harness.charm._install_apt_packages(["curl", "vim"])
-        self.assertEqual(
-            self.harness.charm.unit.status, BlockedStatus("Failed to install packages")
-        )
-        # Now check that if an exception is raised we do the right logging
-        _add_package.reset_mock()
-        _add_package.return_value = 1
-        _add_package.side_effect = apt.PackageError
-        self.harness.charm._install_apt_packages(["curl", "vim"])
-        self.assertEqual(
-            self.harness.charm.unit.status, BlockedStatus("Failed to install packages")
-        )
+        # Failures are raised for the caller, the status is left alone as this may
+        # run in a pipeline thread
+        status = self.harness.charm.unit.status
+        for error in (apt.PackageNotFoundError, apt.PackageError):
+            _add_package.side_effect = error
+            with self.assertRaises(error):
+                self.harness.charm._install_apt_packages(["curl", "vim"])
+        self.assertEqual(self.harness.charm.unit.status, status)
 
+    @mock.patch("charm.HelloJujuCharm._prune_releases")
+    @mock.patch("charm.HelloJujuCharm._activate_release")
     @mock.patch("charm.HelloJujuCharm._create_database_tables")
     @mock.patch("charm.HelloJujuCharm._render_settings_file")
-    @mock.patch("charm.check_output")
-    @mock.patch("charm.Repo.clone_from")
-    @mock.patch("charm.Path")
-    @mock.patch("shutil.rmtree")
-    def test_setup_application(self, _rmtree, _path, _clone, _check_output, _render, _createdb):
+    @mock.patch("charm.HelloJujuCharm._install_dependencies")
+    @mock.patch("charm.HelloJujuCharm._checkout_application")
+    @mock.patch("charm.HelloJujuCharm._fetch_application")
+    @mock.patch("pgsql.opslib.pgsql.client._leader_get", Mock(return_value={}))
+    @mock.patch("charm.HelloJujuCharm._on_config_changed", Mock())
+    def test_setup_application(
+        self, _fetch, _checkout, _install, _render, _createdb, _activate, _prune
+    ):
         # Setup to dive into all the if branches on the first run
-        # Make sure we try to remove the directory that "exists"
-        _path.return_value.is_dir.return_value = True
+        _fetch.return_value = "abc123"
+        _createdb.return_value = "fingerprint"
+        self.harness.set_leader(True)
+        peers = self.harness.add_relation("cluster", "hello-juju")
+        release = Path("/srv/app-releases/abc123")
         # Set a connection string so that we render the settings file
         self.harness.charm._stored.conn_str = "my_connection_string"
         # Call the method
@@ -345,48 +1336,562 @@ class TestCharm(unittest.TestCase):
         # Check the default paths
         self.assertEqual(APP_PATH, Path("/srv/app"))
         self.assertEqual(VENV_ROOT, Path(f"{APP_PATH}/venv"))
+        self.assertEqual(MIRROR_PATH, Path("/var/cache/hello-juju/app.git"))
         # Ensure we set the charm status correctly
         self.assertEqual(
             self.harness.charm.unit.status, MaintenanceStatus("fetching application code")
         )
-        # Check we try to remove the directory
-        _rmtree.assert_called_with("/srv/app")
-        # Check we set the stored repository where none exists
+        # Check the configured repository is recorded as deployed
         self.assertEqual(self.harness.charm._stored.repo, "https://github.com/juju/hello-juju")
-        # Ensure we clone the repo
-        _clone.assert_called_with("https://github.com/juju/hello-juju", APP_PATH)
-        # Ensure we initialise the Python deps correctly
+        self.assertEqual(self.harness.charm._stored.ref, "")
+        # Ensure we fetch the code and check out the resolved commit into a new release
+        _fetch.assert_called_once_with("https://github.com/juju/hello-juju", "")
+        _checkout.assert_called_with("abc123", release)
+        # Ensure we install the Python deps
+        _install.assert_called_once_with(release)
+        # Check we render the settings file with the stored connection string
+        _render.assert_called_once_with(release)
+        # Check that the database table method is called, with leadership and the
+        # published schema looked up before the steps started
+        _createdb.assert_called_once_with(release, True, "")
+        # The schema is recorded and published once all steps are done
+        self.assertEqual(self.harness.charm._stored.schema, "fingerprint")
         self.assertEqual(
-            _check_output.call_args_list,
-            [
-                call(["python3", "-m", "virtualenv", f"{VENV_ROOT}"]),
-                call([f"{VENV_ROOT}/bin/pip3", "install", "gunicorn"]),
-                call(
-                    [
-                        f"{VENV_ROOT}/bin/pip3",
-                        "install",
-                        "-r",
-                        f"{APP_PATH}/requirements.txt",
-                        "--force",
-                    ]
-                ),
-            ],
+            self.harness.get_relation_data(peers, "hello-juju")["schema-fingerprint"],
+            "fingerprint",
         )
-        # Check we render the settings file with the stored connection string
-        _render.assert_called_once()
-        # Check that the database table method is called
-        _createdb.assert_called_once()
+        # Check the release is made live, recorded and old ones are cleaned up
+        _activate.assert_called_once_with(release)
+        self.assertEqual(list(self.harness.charm._stored.releases), ["abc123"])
+        _prune.assert_called_once()
         #
         # Run again covering different branches
         #
-        # Make sure we don't try to remove the directory
-        _path.return_value.is_dir.return_value = False
-        self.harness.charm._stored.repo = "https://myrepo"
+        self.harness.update_config({"application-repo": "https://myrepo"})
         self.harness.charm._stored.conn_str = ""
-        _rmtree.reset_mock()
         _render.reset_mock()
+        _fetch.reset_mock()
         # Call the method
         self.harness.charm._setup_application()
         _render.assert_not_called()
-        _rmtree.assert_not_called()
+        _fetch.assert_called_once_with("https://myrepo", "")
         self.assertEqual(self.harness.charm._stored.repo, "https://myrepo")
+
+        # A failed deploy is not recorded, so the next config-changed retries it
+        self.harness.update_config({"application-repo": "https://broken"})
+        _install.side_effect = CalledProcessError(1, "pip")
+        with self.assertRaises(CalledProcessError):
+            self.harness.charm._setup_application()
+        self.assertEqual(self.harness.charm._stored.repo, "https://myrepo")
+
+    @mock.patch("charm.HelloJujuCharm._prune_releases")
+    @mock.patch("charm.HelloJujuCharm._activate_release")
+    @mock.patch("charm.HelloJujuCharm._create_database_tables")
+    @mock.patch("charm.HelloJujuCharm._install_dependencies")
+    @mock.patch("charm.HelloJujuCharm._extract_bundle")
+    @mock.patch("charm.HelloJujuCharm._fetch_application")
+    def test_setup_application_bundle(
+        self, _fetch, _extract, _install, _createdb, _activate, _prune
+    ):
+        release = Path("/srv/app-releases/bundle-abc123")
+        _extract.return_value = release
+        # An empty resource has never been uploaded, so the code comes from git
+        harness = Harness(HelloJujuCharm)
+        self.addCleanup(harness.cleanup)
+        harness.add_resource("application-bundle", b"")
+        harness.begin()
+        self.assertIsNone(harness.charm._application_bundle())
+        # An attached bundle replaces the git fetch and checkout
+        self.harness.add_resource("application-bundle", b"bundle")
+        bundle = self.harness.charm._application_bundle()
+        self.assertEqual(bundle.read_bytes(), b"bundle")
+        _createdb.return_value = None
+        self.harness.charm._setup_application()
+        _fetch.assert_not_called()
+        _extract.assert_called_once_with(bundle)
+        _install.assert_called_once_with(release)
+        _createdb.assert_called_once_with(release, False, "")
+        _activate.assert_called_once_with(release)
+        # Nothing is recorded for a schema left to the leader
+        self.assertEqual(self.harness.charm._stored.schema, "")
+        self.assertEqual(list(self.harness.charm._stored.releases), ["bundle-abc123"])
+
+    def test_extract_bundle(self):
+        def add(tar, name, data=b"", **attrs):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            for attr, value in attrs.items():
+                setattr(info, attr, value)
+            tar.addfile(info, io.BytesIO(data))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            bundle, releases = Path(tmp, "hello-juju.tar.gz"), Path(tmp, "releases")
+            with tarfile.open(bundle, "w:gz") as tar:
+                add(tar, "init.py", b"print('init')\n")
+                add(tar, "wheelhouse/flask-2.0.1-py3-none-any.whl", b"wheel")
+                add(tar, "static", type=tarfile.SYMTYPE, linkname="wheelhouse")
+            with mock.patch("charm.RELEASES_PATH", releases):
+                release = self.harness.charm._extract_bundle(bundle)
+                # Releases are named after the content of the bundle
+                self.assertEqual(release, self.harness.charm._bundle_release(bundle))
+                self.assertTrue(release.name.startswith("bundle-"))
+                self.assertEqual(Path(release, "init.py").read_text(), "print('init')\n")
+                self.assertTrue(Path(release, "wheelhouse/flask-2.0.1-py3-none-any.whl").is_file())
+                self.assertEqual([p.name for p in releases.iterdir()], [release.name])
+
+                # An already extracted bundle is reused as is
+                Path(release, "init.py").write_text("changed")
+                self.assertEqual(self.harness.charm._extract_bundle(bundle), release)
+                self.assertEqual(Path(release, "init.py").read_text(), "changed")
+
+                # Members escaping the release directory are refused
+                with tarfile.open(bundle, "w") as tar:
+                    add(tar, "../escape.py")
+                with self.assertRaises(ValueError):
+                    self.harness.charm._extract_bundle(bundle)
+                self.assertFalse(Path(tmp, "escape.py").exists())
+
+                # So are chains of links that each look harmless on their own
+                with tarfile.open(bundle, "w") as tar:
+                    add(tar, "d", type=tarfile.SYMTYPE, linkname=".")
+                    add(tar, "d/e", type=tarfile.SYMTYPE, linkname="..")
+                    add(tar, "d/e/f", type=tarfile.SYMTYPE, linkname="..")
+                    add(tar, "d/e/f/escape.py")
+                with self.assertRaises(ValueError):
+                    self.harness.charm._extract_bundle(bundle)
+                self.assertFalse(Path(tmp, "escape.py").exists())
+
+    def test_bundle_member_safe(self):
+        def member(name, type=tarfile.REGTYPE, linkname=""):
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            return info
+
+        self.assertTrue(bundle_member_safe(member("app/init.py")))
+        self.assertTrue(bundle_member_safe(member("app", tarfile.DIRTYPE)))
+        self.assertTrue(bundle_member_safe(member("app/static", tarfile.SYMTYPE, "../assets")))
+        self.assertTrue(bundle_member_safe(member("app/copy.py", tarfile.LNKTYPE, "app/init.py")))
+        self.assertFalse(bundle_member_safe(member("/etc/passwd")))
+        self.assertFalse(bundle_member_safe(member("app/../../etc/passwd")))
+        self.assertFalse(bundle_member_safe(member("static", tarfile.SYMTYPE, "../etc")))
+        self.assertFalse(bundle_member_safe(member("static", tarfile.SYMTYPE, "/etc")))
+        self.assertFalse(bundle_member_safe(member("passwd", tarfile.LNKTYPE, "../etc/passwd")))
+        self.assertFalse(bundle_member_safe(member("null", tarfile.CHRTYPE)))
+
+        # Links already extracted are followed when checking against the directory
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp, "release")
+            root.mkdir()
+            Path(root, "d").symlink_to(".")
+            self.assertTrue(bundle_member_safe(member("d/init.py"), str(root)))
+            self.assertTrue(bundle_member_safe(member("d/e", tarfile.SYMTYPE, "app"), str(root)))
+            self.assertFalse(bundle_member_safe(member("d/e", tarfile.SYMTYPE, ".."), str(root)))
+            Path(root, "up").symlink_to("..")
+            self.assertFalse(bundle_member_safe(member("up/escape.py"), str(root)))
+            self.assertFalse(
+                bundle_member_safe(member("copy", tarfile.LNKTYPE, "up/passwd"), str(root))
+            )
+
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charm.HelloJujuCharm._reload_application")
+    @mock.patch("charm.HelloJujuCharm._setup_application")
+    @mock.patch("pgsql.opslib.pgsql.client._leader_get", Mock(return_value={}))
+    def test_on_upgrade_charm(self, _setup, _reload, _restart):
+        # Without a bundle the application is left alone
+        self.harness.charm.on.upgrade_charm.emit()
+        _setup.assert_not_called()
+
+        # A new bundle is deployed and picked up with a reload
+        self.harness.add_resource("application-bundle", b"bundle")
+        release = self.harness.charm._bundle_release(self.harness.charm._application_bundle())
+        self.harness.charm._stored.releases = ["abc123"]
+        self.harness.charm.on.upgrade_charm.emit()
+        _setup.assert_called_once()
+        _reload.assert_called_once()
+        _restart.assert_not_called()
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+        # New requirements need a fresh gunicorn master
+        _setup.reset_mock()
+        _reload.reset_mock()
+        with mock.patch.object(
+            HelloJujuCharm, "_live_requirements_hash", side_effect=["old", "new"]
+        ):
+            self.harness.charm.on.upgrade_charm.emit()
+        _restart.assert_called_once_with("hello-juju")
+        _reload.assert_not_called()
+
+        # The live bundle is not deployed again
+        _setup.reset_mock()
+        self.harness.charm._stored.releases = ["abc123", release.name]
+        self.harness.charm.on.upgrade_charm.emit()
+        _setup.assert_not_called()
+
+    @mock.patch("charm.check_output")
+    def test_install_dependencies(self, _check_output):
+        failures = []
+
+        def run(args):
+            # Stand in for virtualenv creating the environment, and for pip failing
+            # with the queued errors
+            if args[:3] == ["python3", "-m", "virtualenv"]:
+                Path(args[3], "bin").mkdir(parents=True)
+                Path(args[3], "bin", "python3").touch()
+            elif args[1] == "install" and failures:
+                raise failures.pop()
+            return b""
+
+        _check_output.side_effect = run
+        with tempfile.TemporaryDirectory() as tmp:
+            app, venvs, wheels = Path(tmp, "app"), Path(tmp, "venvs"), Path(tmp, "wheels")
+            app.mkdir()
+            Path(app, "requirements.txt").write_text("flask\n")
+            with mock.patch("charm.WHEEL_CACHE_PATH", wheels), mock.patch(
+                "charm.VENVS_PATH", venvs
+            ):
+                # First install creates a venv keyed by the interpreter and the
+                # requirements, installs from the wheel cache and links the release to it
+                self.harness.charm._install_dependencies(app)
+                soabi = sysconfig.get_config_var("SOABI")
+                requirements_hash = self.harness.charm._requirements_hash(app)
+                venv = Path(venvs, f"{soabi}-{requirements_hash[:16]}")
+                abi_wheels = f"{wheels}/{soabi}"
+                install = [
+                    f"{venv}/bin/pip3",
+                    "install",
+                    "--no-index",
+                    "--find-links",
+                    abi_wheels,
+                    "-r",
+                    f"{app}/requirements.txt",
+                    "gunicorn",
+                ]
+                self.assertEqual(
+                    _check_output.call_args_list,
+                    [call(["python3", "-m", "virtualenv", f"{venv}"]), call(install)],
+                )
+                self.assertTrue(Path(abi_wheels).is_dir())
+                self.assertEqual(Path(venv, ".requirements-hash").read_text(), requirements_hash)
+                self.assertTrue(Path(app, "venv").is_symlink())
+                self.assertEqual(Path(app, "venv").resolve(), venv.resolve())
+
+                # Unchanged requirements reuse the installed venv
+                _check_output.reset_mock()
+                self.harness.charm._install_dependencies(app)
+                _check_output.assert_not_called()
+
+                # So does a new release with the same requirements
+                other = Path(tmp, "other")
+                other.mkdir()
+                Path(other, "requirements.txt").write_text("flask\n")
+                self.harness.charm._install_dependencies(other)
+                _check_output.assert_not_called()
+                self.assertEqual(Path(other, "venv").resolve(), venv.resolve())
+
+                # Changed requirements with an incomplete wheel cache fetch missing
+                # wheels into a new venv, which the release is switched to
+                Path(app, "requirements.txt").write_text("flask\nrequests\n")
+                failures.append(CalledProcessError(1, "pip3"))
+                self.harness.charm._install_dependencies(app)
+                requirements_hash = self.harness.charm._requirements_hash(app)
+                new_venv = Path(venvs, f"{soabi}-{requirements_hash[:16]}")
+                install[0] = f"{new_venv}/bin/pip3"
+                wheel = [
+                    f"{new_venv}/bin/pip3",
+                    "wheel",
+                    "--wheel-dir",
+                    abi_wheels,
+                    "--find-links",
+                    abi_wheels,
+                    "-r",
+                    f"{app}/requirements.txt",
+                    "gunicorn",
+                ]
+                self.assertEqual(
+                    _check_output.call_args_list[1:],
+                    [call(install), call(wheel), call(install)],
+                )
+                self.assertEqual(
+                    Path(new_venv, ".requirements-hash").read_text(), requirements_hash
+                )
+                self.assertEqual(Path(app, "venv").resolve(), new_venv.resolve())
+                # The other release keeps its venv
+                self.assertEqual(Path(other, "venv").resolve(), venv.resolve())
+
+                # Bundled releases install from their wheelhouse and never fetch wheels
+                Path(app, "requirements.txt").write_text("flask\ngevent\n")
+                Path(app, "wheelhouse").mkdir()
+                _check_output.reset_mock()
+                self.harness.charm._install_dependencies(app)
+                requirements_hash = self.harness.charm._requirements_hash(app)
+                install[0] = f"{venvs}/{soabi}-{requirements_hash[:16]}/bin/pip3"
+                self.assertEqual(
+                    _check_output.call_args_list[1],
+                    call([*install[:5], "--find-links", f"{app}/wheelhouse", *install[5:]]),
+                )
+
+            # Releases from before shared venvs have their own, which is replaced
+            legacy = Path(tmp, "legacy")
+            Path(legacy, "venv", "bin").mkdir(parents=True)
+            self.harness.charm._link_virtualenv(legacy, venv)
+            self.assertTrue(Path(legacy, "venv").is_symlink())
+            self.assertEqual(Path(legacy, "venv").resolve(), venv.resolve())
+
+    @mock.patch("charm.check_output")
+    def test_prefetch_wheels(self, _check_output):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch("charm.WHEEL_CACHE_PATH", Path(tmp)):
+                self.harness.charm._prefetch_wheels(None)
+            wheels = f"{tmp}/{sysconfig.get_config_var('SOABI')}"
+            self.assertTrue(Path(wheels).is_dir())
+        _check_output.assert_called_once_with(
+            [
+                "python3",
+                "-m",
+                "pip",
+                "wheel",
+                "--wheel-dir",
+                wheels,
+                "--find-links",
+                wheels,
+                "gunicorn",
+            ]
+        )
+
+        # The wheelhouse of an attached bundle provides the extra packages
+        _check_output.reset_mock()
+        self.harness.charm._prefetch_wheels(Path("/var/lib/juju/resources/hello-juju.tar.gz"))
+        _check_output.assert_not_called()
+
+    @mock.patch("shutil.rmtree")
+    @mock.patch("charm.Repo")
+    def test_fetch_application(self, _repo, _rmtree):
+        _repo.return_value.commit.return_value.hexsha = "abc123"
+        _repo.return_value.git.ls_remote.return_value = "ref: refs/heads/main\tHEAD\nabc123\tHEAD"
+        # An existing mirror is repointed at the remote and fetched incrementally
+        self.assertEqual(self.harness.charm._fetch_application("https://myrepo", ""), "abc123")
+        _repo.assert_called_with(MIRROR_PATH)
+        remote = _repo.return_value.remote.return_value
+        remote.set_url.assert_called_with("https://myrepo")
+        remote.fetch.assert_called_with(MIRROR_REFSPECS, prune=True)
+        _repo.return_value.commit.assert_called_with("HEAD")
+        _repo.clone_from.assert_not_called()
+        # The mirror is closed, stopping GitPython's helper processes within the hook
+        _repo.return_value.__exit__.assert_called_once()
+        # HEAD follows the remote's default branch, which may have changed
+        _repo.return_value.git.ls_remote.assert_called_with("--symref", "https://myrepo", "HEAD")
+        self.assertEqual(_repo.return_value.head.reference.path, "refs/heads/main")
+        # A pinned ref doesn't need to know the default branch
+        _repo.return_value.git.ls_remote.reset_mock()
+        self.harness.charm._fetch_application("https://myrepo", "v1.0")
+        _repo.return_value.git.ls_remote.assert_not_called()
+
+        # A mirror that fails to fetch is only cloned again when it is corrupt
+        remote.fetch.side_effect = GitCommandError("fetch", 128)
+        with self.assertRaises(GitCommandError):
+            self.harness.charm._fetch_application("https://myrepo", "v1.0")
+        _repo.return_value.git.fsck.assert_called_with("--connectivity-only")
+        _repo.clone_from.assert_not_called()
+        _repo.return_value.git.fsck.side_effect = GitCommandError("fsck", 2)
+        _repo.clone_from.return_value.commit.return_value.hexsha = "def456"
+        with mock.patch.object(Path, "exists", return_value=True):
+            commit = self.harness.charm._fetch_application("https://myrepo", "v1.0")
+        self.assertEqual(commit, "def456")
+        _rmtree.assert_called_with(MIRROR_PATH)
+        _repo.clone_from.assert_called_with("https://myrepo", MIRROR_PATH, bare=True)
+        _rmtree.reset_mock()
+        _repo.clone_from.reset_mock()
+
+        # A missing or unreadable mirror falls back to a full clone
+        _repo.side_effect = InvalidGitRepositoryError
+        _repo.clone_from.return_value.commit.return_value.hexsha = "def456"
+        with mock.patch.object(Path, "exists", return_value=True):
+            commit = self.harness.charm._fetch_application("https://myrepo", "v1.0")
+        self.assertEqual(commit, "def456")
+        _rmtree.assert_called_with(MIRROR_PATH)
+        _repo.clone_from.assert_called_with("https://myrepo", MIRROR_PATH, bare=True)
+        _repo.clone_from.return_value.commit.assert_called_with("v1.0")
+        # Nothing to clean up when there is no mirror at all
+        _rmtree.reset_mock()
+        _repo.side_effect = NoSuchPathError
+        with mock.patch.object(Path, "exists", return_value=False):
+            self.harness.charm._fetch_application("https://myrepo", "v1.0")
+        _rmtree.assert_not_called()
+
+    @mock.patch("shutil.rmtree")
+    @mock.patch("charm.Repo")
+    def test_checkout_application(self, _repo, _rmtree):
+        release = Path("/srv/app-releases/abc123")
+        for repo in (_repo.return_value, _repo.clone_from.return_value):
+            repo.__enter__.return_value = repo
+        # An existing checkout is updated in place, and the repo closed again
+        self.harness.charm._checkout_application("abc123", release)
+        _repo.return_value.__exit__.assert_called_once()
+        _repo.assert_called_with(release)
+        _repo.return_value.git.checkout.assert_called_with("--force", "abc123")
+        _repo.clone_from.assert_not_called()
+        _rmtree.assert_not_called()
+
+        # An unusable checkout is replaced by a shared clone of the mirror
+        _repo.return_value.git.checkout.side_effect = GitCommandError("checkout", 128)
+        with mock.patch.object(Path, "is_dir", return_value=True):
+            self.harness.charm._checkout_application("abc123", release)
+        _rmtree.assert_called_with(release)
+        _repo.clone_from.assert_called_with(
+            str(MIRROR_PATH), release, shared=True, no_checkout=True
+        )
+        _repo.clone_from.return_value.git.checkout.assert_called_with("--force", "abc123")
+        _repo.clone_from.return_value.__exit__.assert_called_once()
+        # A new release has no checkout to remove
+        _rmtree.reset_mock()
+        _repo.side_effect = NoSuchPathError
+        with mock.patch.object(Path, "is_dir", return_value=False):
+            self.harness.charm._checkout_application("abc123", release)
+        _rmtree.assert_not_called()
+
+    def test_activate_and_prune_releases(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            app, releases = Path(tmp, "app"), Path(tmp, "releases")
+            for name in ("r1", "r2", "r3", "stale"):
+                Path(releases, name).mkdir(parents=True)
+            # Deployments from before release directories have a real directory
+            Path(app, "venv").mkdir(parents=True)
+            # A leftover link from an interrupted activation is replaced
+            Path(f"{app}.new").symlink_to(Path(releases, "stale"))
+            # Nothing else changes, so config-changed does not redeploy
+            self.harness.charm._stored.repo = "https://github.com/juju/hello-juju"
+            self.harness.charm._stored.port = 80
+            self.harness.charm._stored.gunicorn = self.harness.charm._gunicorn_options()
+            with mock.patch.object(Path, "exists", return_value=True):
+                self.harness.update_config({"releases-to-keep": 2})
+            with mock.patch("charm.APP_PATH", app), mock.patch("charm.RELEASES_PATH", releases):
+                for name in ("r1", "r2", "r3"):
+                    self.harness.charm._activate_release(Path(releases, name))
+                    self.assertTrue(app.is_symlink())
+                    self.assertEqual(app.resolve(), Path(releases, name).resolve())
+                    # The history is only recorded separately, from the main thread
+                    self.assertEqual(len(self.harness.charm._stored.releases), 0)
+                for name in ("r1", "r2", "r3"):
+                    self.harness.charm._record_release(Path(releases, name))
+                self.assertEqual(list(self.harness.charm._stored.releases), ["r1", "r2", "r3"])
+
+                # Re-recording a release moves it to the end of the history
+                self.harness.charm._record_release(Path(releases, "r2"))
+                self.assertEqual(list(self.harness.charm._stored.releases), ["r1", "r3", "r2"])
+
+                # Shared venvs are removed once no kept release links to them
+                venvs = Path(tmp, "venvs")
+                for name, venv in (("r1", "old"), ("r2", "new"), ("r3", "new")):
+                    Path(venvs, venv).mkdir(parents=True, exist_ok=True)
+                    Path(releases, name, "venv").symlink_to(Path(venvs, venv))
+                Path(venvs, "unused").mkdir()
+
+                with mock.patch("charm.VENVS_PATH", venvs), mock.patch(
+                    "charm.VENV_ROOT", Path(app, "venv")
+                ):
+                    self.harness.charm._prune_releases()
+                self.assertEqual(list(self.harness.charm._stored.releases), ["r3", "r2"])
+                self.assertEqual(sorted(p.name for p in releases.iterdir()), ["r2", "r3"])
+                self.assertEqual([p.name for p in venvs.iterdir()], ["new"])
+
+            # Nothing to prune before the first release
+            with mock.patch("charm.RELEASES_PATH", Path(tmp, "missing")), mock.patch(
+                "charm.VENVS_PATH", Path(tmp, "missing-venvs")
+            ):
+                self.harness.charm._prune_releases()
+
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charm.HelloJujuCharm._reload_application")
+    @mock.patch("charm.HelloJujuCharm._activate_release")
+    @mock.patch("charm.HelloJujuCharm._render_settings_file")
+    def test_on_rollback_action(self, _render, _activate, _reload, _restart):
+        # Nothing to roll back to with a single release
+        self.harness.charm._stored.releases = ["r1"]
+        event = Mock()
+        self.harness.charm._on_rollback_action(event)
+        event.fail.assert_called_once()
+        _activate.assert_not_called()
+
+        # Roll back to the previous release, re-rendering its settings
+        self.harness.charm._stored.releases = ["r1", "r2"]
+        self.harness.charm._stored.conn_str = "postgresql+pg8000://TEST"
+        event = Mock()
+        self.harness.charm._on_rollback_action(event)
+        _render.assert_called_once_with(Path("/srv/app-releases/r1"))
+        _activate.assert_called_once_with(Path("/srv/app-releases/r1"))
+        _reload.assert_called_once_with()
+        _restart.assert_not_called()
+        event.set_results.assert_called_once_with({"release": "r1", "previous": "r2"})
+        # The release rolled back from is kept before r1, so rolling back again
+        # rolls forward
+        self.assertEqual(list(self.harness.charm._stored.releases), ["r2", "r1"])
+        _activate.reset_mock()
+        self.harness.charm._on_rollback_action(Mock())
+        _activate.assert_called_once_with(Path("/srv/app-releases/r2"))
+
+        # Settings are left alone without a database
+        _render.reset_mock()
+        self.harness.charm._stored.releases = ["r1", "r2"]
+        self.harness.charm._stored.conn_str = ""
+        self.harness.charm._on_rollback_action(Mock())
+        _render.assert_not_called()
+
+        # Rolling back across a dependency change restarts gunicorn
+        _reload.reset_mock()
+        self.harness.charm._stored.releases = ["r1", "r2"]
+        with mock.patch(
+            "charm.HelloJujuCharm._live_requirements_hash", side_effect=["new", "old"]
+        ):
+            self.harness.charm._on_rollback_action(Mock())
+        _restart.assert_called_once_with("hello-juju")
+        _reload.assert_not_called()
+
+    @mock.patch("time.sleep", Mock())
+    @mock.patch("charm.HelloJujuCharm._worker_pids")
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_restart")
+    @mock.patch("charms.operator_libs_linux.v0.systemd.service_reload")
+    def test_reload_application(self, _reload, _restart, _workers):
+        self.harness.charm._stored.gunicorn = {"workers": 2}
+        # The reload completes once a full set of new workers has replaced the old
+        _reload.return_value = True
+        _workers.side_effect = [{10, 11}, {10, 11}, {10, 11, 12, 13}, {12, 13}]
+        self.assertTrue(self.harness.charm._reload_application())
+        _reload.assert_called_once_with("hello-juju")
+        _restart.assert_not_called()
+
+        # Old workers that never go away time out
+        _workers.side_effect = None
+        _workers.return_value = {10, 11}
+        with mock.patch("charm.RELOAD_TIMEOUT", 0):
+            self.assertFalse(self.harness.charm._reload_application())
+
+        # A failed reload falls back to a restart
+        _reload.return_value = False
+        _restart.return_value = True
+        self.assertTrue(self.harness.charm._reload_application())
+        _restart.assert_called_once_with("hello-juju")
+
+    def test_worker_pids(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            pid_file = Path(tmp, "hello-juju.pid")
+            with mock.patch("charm.PROC_PATH", Path(tmp)), mock.patch("charm.PID_PATH", pid_file):
+                # No master process, no workers
+                self.assertEqual(self.harness.charm._worker_pids(), set())
+
+                pid_file.write_text("100\n")
+                for pid, ppid in ((100, 1), (101, 100), (102, 100), (200, 1)):
+                    Path(tmp, str(pid)).mkdir()
+                    name = "gunicorn: worker [hello_juju:app]"
+                    Path(tmp, str(pid), "stat").write_text(f"{pid} ({name}) S {ppid} 100 100\n")
+                # Processes that exit while scanning are skipped
+                Path(tmp, "300").mkdir()
+                Path(tmp, "300", "stat").write_text("")
+                self.assertEqual(self.harness.charm._worker_pids(), {101, 102})
+
+    def test_live_requirements_hash(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with mock.patch("charm.VENV_ROOT", Path(tmp)):
+                self.assertEqual(self.harness.charm._live_requirements_hash(), "")
+                Path(tmp, ".requirements-hash").write_text("abc")
+                self.assertEqual(self.harness.charm._live_requirements_hash(), "abc")
@@ -0,0 +1,136 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+import socket
+import socketserver
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import loadtest
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def hello_app(environ, start_response):
+    """A tiny stand-in for the Flask application"""
+    if environ["PATH_INFO"] == "/error":
+        start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+        return [b"oops"]
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"Hello, Juju!"]
+
+
+class KeepAliveHandler(socketserver.StreamRequestHandler):
+    """Serve chunked HTTP/1.1 responses over a persistent connection"""
+
+    def handle(self):
+        while True:
+            request = self.rfile.readline()
+            if not request:
+                return
+            while self.rfile.readline() not in (b"\r\n", b""):
+                pass
+            if request.startswith(b"GET /close "):
+                # A body without a length ends with the connection
+                self.wfile.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nbye")
+                return
+            self.wfile.write(
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nHello\r\n0\r\n\r\n"
+            )
+
+
+class TestLoadTest(unittest.TestCase):
+    def serve(self, server: socketserver.BaseServer) -> int:
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def test_wsgi_application(self):
+        server = make_server(
+            "127.0.0.1", 0, hello_app, server_class=ThreadingWSGIServer, handler_class=QuietHandler
+        )
+        port = self.serve(server)
+
+        result = loadtest.run("127.0.0.1", port, 0.3, 4)
+        self.assertGreater(result.requests, 0)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.error_rate, 0.0)
+        self.assertGreater(result.throughput, 0)
+        self.assertLessEqual(result.percentile(50), result.percentile(99))
+
+        # Server errors are counted but don't contribute latencies
+        result = loadtest.run("127.0.0.1", port, 0.2, 2, "/error")
+        self.assertGreater(result.errors, 0)
+        self.assertEqual(result.error_rate, 1.0)
+        self.assertEqual(result.throughput, 0.0)
+        self.assertEqual(result.percentile(50), 0.0)
+
+    def test_keep_alive_and_chunked_responses(self):
+        connections = []
+
+        class Handler(KeepAliveHandler):
+            def setup(self):
+                connections.append(self.client_address)
+                super().setup()
+
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        port = self.serve(server)
+
+        result = loadtest.run("127.0.0.1", port, 0.2, 2)
+        self.assertEqual(result.errors, 0)
+        # Every worker reuses a single connection
+        self.assertGreater(result.requests, len(connections))
+        self.assertEqual(len(connections), 2)
+
+        # Connections closed by the server are opened again for the next request
+        result = loadtest.run("127.0.0.1", port, 0.2, 1, "/close")
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(len(connections), 2 + result.requests)
+
+    def test_unix_socket(self):
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = str(Path(tmp, "app.sock"))
+            self.serve(Server(path, KeepAliveHandler))
+            # The port only names the server, nothing listens on it
+            result = loadtest.run("127.0.0.1", 1, 0.2, 2, unix_socket=path)
+        self.assertGreater(result.requests, 0)
+        self.assertEqual(result.errors, 0)
+
+    def test_unreachable_listener(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        result = loadtest.run("127.0.0.1", port, 0.05, 1)
+        self.assertGreater(result.errors, 0)
+        self.assertEqual(result.error_rate, 1.0)
+
+    def test_timeouts(self):
+        # A listener that accepts connections but never answers
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            sock.listen()
+            with mock.patch("loadtest.REQUEST_TIMEOUT", 0.05):
+                result = loadtest.run("127.0.0.1", sock.getsockname()[1], 0.01, 1)
+        self.assertEqual((result.requests, result.errors), (1, 1))
+
+    def test_empty_result(self):
+        result = loadtest.Result(0)
+        self.assertEqual((result.requests, result.throughput, result.error_rate), (0, 0.0, 0.0))
@@ -0,0 +1,71 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+import threading
+import unittest
+
+import tracing
+from pipeline import Pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run_respects_dependencies(self):
+        order = []
+        pipeline = Pipeline("test")
+        pipeline.add("c", lambda: order.append("c"), after=["a", "b"])
+        pipeline.add("a", lambda: order.append("a") or 1)
+        pipeline.add("b", lambda: order.append("b") or 2, after=["a"])
+        timings = pipeline.run()
+        self.assertEqual(order, ["a", "b", "c"])
+        # Results of each step are available to the steps that depend on them
+        self.assertEqual(pipeline.results, {"a": 1, "b": 2, "c": None})
+        self.assertEqual(sorted(timings), ["a", "b", "c"])
+        self.assertEqual(pipeline.critical_path(), ["a", "b", "c"])
+
+    def test_independent_steps_run_concurrently(self):
+        # Each step waits for the other to start, which only works if they overlap
+        barrier = threading.Barrier(2, timeout=5)
+        pipeline = Pipeline("test")
+        pipeline.add("apt", barrier.wait)
+        pipeline.add("fetch", barrier.wait)
+        pipeline.add("install", lambda: None, after=["apt", "fetch"])
+        pipeline.run()
+        self.assertEqual(len(pipeline.critical_path()), 2)
+        self.assertEqual(pipeline.critical_path()[-1], "install")
+
+    def test_failure_stops_dependent_steps(self):
+        ran = []
+
+        def fail():
+            raise RuntimeError("boom")
+
+        pipeline = Pipeline("test")
+        pipeline.add("fail", fail)
+        pipeline.add("after", lambda: ran.append("after"), after=["fail"])
+        with self.assertRaisesRegex(RuntimeError, "boom"):
+            pipeline.run()
+        self.assertEqual(ran, [])
+
+    def test_invalid_graphs(self):
+        pipeline = Pipeline("test")
+        pipeline.add("a", lambda: None)
+        with self.assertRaises(ValueError):
+            pipeline.add("a", lambda: None)
+
+        pipeline.add("b", lambda: None, after=["missing"])
+        with self.assertRaisesRegex(ValueError, "unknown steps"):
+            pipeline.run()
+
+        pipeline = Pipeline("test")
+        pipeline.add("a", lambda: None, after=["b"])
+        pipeline.add("b", lambda: None, after=["a"])
+        with self.assertRaisesRegex(ValueError, "cycle"):
+            pipeline.run()
+
+        self.assertEqual(Pipeline("empty").critical_path(), [])
+
+    def test_steps_set_tracing_phase(self):
+        pipeline = Pipeline("setup")
+        pipeline.add("fetch", tracing.current_phase)
+        pipeline.run()
+        self.assertTrue(pipeline.results["fetch"].endswith("/setup:fetch"))
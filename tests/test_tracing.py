@@ -0,0 +1,91 @@
+# Copyright 2021 Canonical
+# See LICENSE file for licensing details.
+
+import json
+import subprocess
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import tracing
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(tracing.disable)
+
+    def test_records_processes(self):
+        tracing.enable("install")
+        self.assertTrue(tracing.enabled())
+        subprocess.check_call(["true"])
+        with tracing.phase("setup:fetch"):
+            self.assertEqual(tracing.current_phase(), "install/setup:fetch")
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_output(["sh", "-c", "exit 3"])
+        # Processes started directly through Popen are finished by poll() as well
+        proc = subprocess.Popen(["true"])
+        while proc.poll() is None:
+            pass
+        proc.poll()
+
+        spans = tracing.spans()
+        self.assertEqual([s["name"] for s in spans], ["true", "sh", "true"])
+        self.assertEqual(
+            spans[0]["args"], {"command": ["true"], "phase": "install", "returncode": 0}
+        )
+        self.assertEqual(spans[1]["args"]["phase"], "install/setup:fetch")
+        self.assertEqual(spans[1]["args"]["returncode"], 3)
+        for span in spans:
+            self.assertEqual(span["ph"], "X")
+            self.assertGreaterEqual(span["dur"], 0)
+            self.assertNotIn("start", span)
+
+        # Commands that can't be started are recorded without an exit code
+        with self.assertRaises(OSError):
+            subprocess.call(["/nonexistent/command"])
+        self.assertEqual(tracing.spans()[-1]["args"]["returncode"], None)
+        self.assertIn("error", tracing.spans()[-1]["args"])
+
+        # Once disabled nothing more is recorded
+        tracing.disable()
+        self.assertFalse(tracing.enabled())
+        subprocess.check_call(["true"])
+        self.assertEqual(tracing.spans(), [])
+
+    def test_phases_are_per_thread(self):
+        tracing.enable("config-changed")
+        phases = []
+        with tracing.phase("setup:checkout"):
+            thread = threading.Thread(target=lambda: phases.append(tracing.current_phase()))
+            thread.start()
+            thread.join()
+        self.assertEqual(phases, ["config-changed"])
+        self.assertEqual(tracing.current_phase(), "config-changed")
+
+    def test_write_and_slowest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            directory = Path(tmp, "traces")
+            self.assertEqual(tracing.slowest(directory), [])
+
+            tracing.enable("install")
+            tracing.enable("install")
+            subprocess.check_call(["true"])
+            subprocess.check_call(["sleep", "0.05"])
+            path = tracing.write(directory)
+
+            trace = json.loads(path.read_text())
+            events = trace["traceEvents"]
+            self.assertEqual([e["name"] for e in events], ["install", "true", "sleep"])
+            self.assertEqual(events[0]["cat"], "hook")
+            self.assertGreaterEqual(events[0]["dur"], events[2]["dur"])
+
+            slowest = tracing.slowest(directory, limit=1)
+            self.assertEqual([s["name"] for s in slowest], ["sleep"])
+            # Unreadable files are skipped
+            Path(directory, "0-broken.json").write_text("{")
+            self.assertEqual(len(tracing.slowest(directory)), 2)
+
+            # Only the most recent traces are kept
+            tracing.write(directory, keep=1)
+            self.assertEqual(len(list(directory.glob("*.json"))), 1)